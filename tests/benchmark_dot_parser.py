@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+#
+#    Benchmark for the topology file parsers
+#       compares the native DOT parser against the pydotplus fallback on the
+#       example topologies and on a synthetic leaf/spine fabric.
+#
+#    Run from the root of the repository:
+#       python ./tests/benchmark_dot_parser.py
+#       python ./tests/benchmark_dot_parser.py --spines 32 --leaves 256 --hosts 6
+#
+import os
+import sys
+import glob
+import time
+import argparse
+import tempfile
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+import topology_converter
+
+
+def write_fabric(path, spines, leaves, hosts):
+    # Every leaf has one link to every spine plus "hosts" single attached servers.
+    with open(path, 'w') as dot:
+        dot.write('graph fabric {\n')
+        for s in range(1, spines + 1):
+            dot.write(' "spine%s" [function="spine" config="./helper_scripts/extra_switch_config.sh"]\n' % s)
+        for l in range(1, leaves + 1):
+            dot.write(' "leaf%s" [function="leaf" config="./helper_scripts/extra_switch_config.sh"]\n' % l)
+            for h in range(1, hosts + 1):
+                dot.write(' "server%s-%s" [function="host" config="./helper_scripts/extra_server_config.sh"]\n' % (l, h))
+        for l in range(1, leaves + 1):
+            for s in range(1, spines + 1):
+                dot.write('   "leaf%s":"swp%s" -- "spine%s":"swp%s"\n' % (l, 48 + s, s, l))
+            for h in range(1, hosts + 1):
+                dot.write('   "server%s-%s":"eth1" -- "leaf%s":"swp%s" [left_mtu="9000"]\n' % (l, h, l, h))
+        dot.write('}\n')
+    return spines + leaves + leaves * hosts, leaves * (spines + hosts)
+
+
+def normalize(records):
+    # pydotplus re-quotes some names, the inventory strips quotes either way.
+    return [(r[0],) + tuple(f.replace('"', '') if isinstance(f, str) else f for f in r[1:]) for r in records]
+
+
+def time_parser(parser, topology_file, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        records = list(parser(topology_file))
+        elapsed = time.time() - start
+        if best is None or elapsed < best: best = elapsed
+    return best, records
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the native DOT parser against pydotplus')
+    parser.add_argument('--spines', type=int, default=16, help='spines in the synthetic fabric')
+    parser.add_argument('--leaves', type=int, default=128, help='leaves in the synthetic fabric')
+    parser.add_argument('--hosts', type=int, default=4, help='hosts attached to each leaf')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement, best time is reported')
+    parser.add_argument('--skip-pydotplus-fabric', action='store_true',
+                        help='only time the native parser on the synthetic fabric')
+    args = parser.parse_args()
+
+    topology_files = sorted(glob.glob(os.path.join(repo_dir, 'examples', '*.dot')))
+
+    tmp_dir = tempfile.mkdtemp()
+    fabric = os.path.join(tmp_dir, 'fabric.dot')
+    nodes, links = write_fabric(fabric, args.spines, args.leaves, args.hosts)
+    topology_files.append(fabric)
+
+    print("%-28s %8s %12s %12s %9s" % ("topology", "records", "native(s)", "pydotplus(s)", "speedup"))
+    failed = False
+    for topology_file in topology_files:
+        native_time, native_records = time_parser(topology_converter.read_dot_records, topology_file, args.repeat)
+        name = os.path.basename(topology_file)
+        if topology_file == fabric:
+            name = "fabric (%s nodes/%s links)" % (nodes, links)
+            if args.skip_pydotplus_fabric:
+                print("%-28s %8s %12.4f %12s %9s" % (name, len(native_records), native_time, "-", "-"))
+                continue
+        pydot_time, pydot_records = time_parser(topology_converter.read_dot_records_pydotplus, topology_file, 1)
+        if normalize(native_records) != normalize(pydot_records):
+            print("  MISMATCH: parsers disagree on %s" % topology_file)
+            failed = True
+        print("%-28s %8s %12.4f %12.4f %8.1fx" % (name, len(native_records), native_time, pydot_time,
+                                                   pydot_time / max(native_time, 1e-9)))
+    os.remove(fabric)
+    os.rmdir(tmp_dir)
+    if failed: exit(1)
+
+
+if __name__ == "__main__":
+    main()
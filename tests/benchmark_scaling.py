@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+#
+#    Scaling benchmark for the whole conversion
+#       generates leaf/spine, 3-tier Clos, fat-tree and ring topologies, and
+#       rings of switches with ports=128, of a given number of nodes, converts
+#       each one for every provider with and without "-c", and reports the
+#       time taken. For every series the growth exponent (time ~
+#       nodes^exponent) is fitted over its sizes, so a change that makes some
+#       phase quadratic shows up even on a fast machine.
+#       Results can be saved as a JSON baseline and later runs compared
+#       against it. Vagrant is not needed.
+#
+#    Run from the root of the repository:
+#       python ./tests/benchmark_scaling.py
+#       python ./tests/benchmark_scaling.py --sizes 10,100,1000,10000 --save-baseline ./scaling_baseline.json
+#       python ./tests/benchmark_scaling.py --baseline ./scaling_baseline.json
+#       python ./tests/benchmark_scaling.py --families fat-tree --providers libvirt --no-mgmt
+#       python ./tests/benchmark_scaling.py --families port-ranges --sizes 1000 --providers libvirt
+#
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+import topology_converter
+
+# Ports a single libvirt tunnel_ip can hand out with the default start_port
+single_host_ports = 50000
+
+
+def leaf_spine(target):
+    # 2-16 spines, every leaf has one link to every spine and 4 hosts
+    spines = max(2, min(16, target // 40))
+    leaves = max(2, int(round((target - spines) / 5.0)))
+    nodes = [("spine%s" % s, "spine") for s in range(1, spines + 1)]
+    links = []
+    for l in range(1, leaves + 1):
+        nodes.append(("leaf%s" % l, "leaf"))
+        for s in range(1, spines + 1):
+            links.append(("leaf%s" % l, "swp%s" % (48 + s), "spine%s" % s, "swp%s" % l))
+        for h in range(1, 5):
+            nodes.append(("server%s-%s" % (l, h), "host"))
+            links.append(("server%s-%s" % (l, h), "eth1", "leaf%s" % l, "swp%s" % h))
+    return nodes, links
+
+
+def clos_3tier(target):
+    # 4 superspines above pods of 2 spines, 4 leaves and 16 hosts
+    pods = max(1, int(round((target - 4) / 22.0)))
+    nodes = [("superspine%s" % s, "superspine") for s in range(1, 5)]
+    links = []
+    for p in range(1, pods + 1):
+        for s in range(1, 3):
+            spine = "pod%s-spine%s" % (p, s)
+            nodes.append((spine, "spine"))
+            for u in range(1, 5):
+                links.append((spine, "swp%s" % (48 + u), "superspine%s" % u, "swp%s" % ((p - 1) * 2 + s)))
+        for l in range(1, 5):
+            leaf = "pod%s-leaf%s" % (p, l)
+            nodes.append((leaf, "leaf"))
+            for s in range(1, 3):
+                links.append((leaf, "swp%s" % (48 + s), "pod%s-spine%s" % (p, s), "swp%s" % l))
+            for h in range(1, 5):
+                host = "pod%s-server%s-%s" % (p, l, h)
+                nodes.append((host, "host"))
+                links.append((host, "eth1", leaf, "swp%s" % h))
+    return nodes, links
+
+
+def fat_tree_size(k):
+    return 5 * k * k // 4 + k * k * k // 4
+
+
+def fat_tree(target):
+    # k-ary fat-tree, the even k (4..32) whose node count is closest to target
+    k = min(range(4, 34, 2), key=lambda k: abs(fat_tree_size(k) - target))
+    half = k // 2
+    nodes = [("core%s" % c, "superspine") for c in range(1, half * half + 1)]
+    links = []
+    for p in range(1, k + 1):
+        for a in range(1, half + 1):
+            aggregation = "pod%s-agg%s" % (p, a)
+            nodes.append((aggregation, "spine"))
+            for c in range(1, half + 1):
+                core = (a - 1) * half + c
+                links.append((aggregation, "swp%s" % (half + c), "core%s" % core, "swp%s" % p))
+        for e in range(1, half + 1):
+            edge = "pod%s-edge%s" % (p, e)
+            nodes.append((edge, "leaf"))
+            for a in range(1, half + 1):
+                links.append((edge, "swp%s" % (half + a), "pod%s-agg%s" % (p, a), "swp%s" % e))
+            for h in range(1, half + 1):
+                host = "pod%s-server%s-%s" % (p, e, h)
+                nodes.append((host, "host"))
+                links.append((host, "eth1", edge, "swp%s" % h))
+    return nodes, links
+
+
+def ring(target):
+    # 3switch_circular scaled up: a ring of leaves, each with one host
+    switches = max(3, target // 2)
+    nodes = []
+    links = []
+    for s in range(1, switches + 1):
+        nodes.append(("leaf%s" % s, "leaf"))
+        nodes.append(("server%s" % s, "host"))
+        links.append(("leaf%s" % s, "swp2", "leaf%s" % (s % switches + 1), "swp1"))
+        links.append(("server%s" % s, "eth1", "leaf%s" % s, "swp3"))
+    return nodes, links
+
+
+def port_ranges(target):
+    # A ring of switches with 16 links to each neighbour that fill out the
+    # rest of swp0-swp128 with "ports", so most of their interfaces are
+    # created by the converter rather than listed as links
+    switches = max(3, target)
+    nodes = [("leaf%s" % s, "leaf", {"ports": 128}) for s in range(1, switches + 1)]
+    links = []
+    for s in range(1, switches + 1):
+        for p in range(1, 17):
+            links.append(("leaf%s" % s, "swp%s" % p, "leaf%s" % (s % switches + 1), "swp%s" % (16 + p)))
+    return nodes, links
+
+
+families = [("leaf-spine", leaf_spine), ("clos-3tier", clos_3tier), ("fat-tree", fat_tree), ("ring", ring),
+            ("port-ranges", port_ranges)]
+
+
+def udp_port_count(nodes, links, mgmt):
+    # UDP ports a libvirt conversion needs at most: both ends of every link
+    # and of every management link with "-c" (an unconnected eth0 without),
+    # and one for each port of the port ranges
+    ports = sum(node[2].get("ports", 0) for node in nodes if len(node) > 2)
+    return 2 * len(links) + (2 * (len(nodes) + 1) if mgmt else len(nodes)) + ports
+
+
+def write_topology(path, nodes, links, mgmt):
+    with open(path, 'w') as dot:
+        dot.write('graph scaling {\n')
+        if mgmt:
+            # The default 192.168.200.0/24 management subnet only holds 253 devices
+            dot.write(' "oob-mgmt-server" [function="oob-server" mgmt_ip="10.128.255.254/9"]\n')
+        for node in nodes:
+            attributes = dict(node[2]) if len(node) > 2 else {}
+            attributes["function"] = node[1]
+            dot.write(' "%s" [%s]\n' % (node[0], " ".join('%s="%s"' % (key, attributes[key]) for key in sorted(attributes))))
+        for left, left_port, right, right_port in links:
+            dot.write('   "%s":"%s" -- "%s":"%s"\n' % (left, left_port, right, right_port))
+        dot.write('}\n')
+
+
+def convert(topology_file, provider, mgmt, hypervisors):
+    options = dict(provider=provider, create_mgmt_network=mgmt, force=True)
+    if hypervisors > 1:
+        options['hypervisors'] = ["127.0.1.%s" % h for h in range(1, hypervisors + 1)]
+    real_stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    start = time.time()
+    try:
+        topology_converter.Converter(topology_file, **options).run()
+    except topology_converter.ConversionError:
+        return None
+    finally:
+        sys.stdout.close()
+        sys.stdout = real_stdout
+    return time.time() - start
+
+
+def growth_exponent(points):
+    # Least squares slope of log(seconds) over log(nodes). Runs shorter than
+    # 10ms are mostly noise and are left out.
+    points = [(math.log(nodes), math.log(seconds)) for nodes, seconds in points if seconds >= 0.01]
+    if len(points) < 2: return None
+    mean_x = sum(x for x, y in points) / len(points)
+    mean_y = sum(y for x, y in points) / len(points)
+    spread = sum((x - mean_x) ** 2 for x, y in points)
+    if spread == 0: return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / spread
+
+
+def series_key(result):
+    return "%s/%s/%s" % (result['family'], result['provider'], "mgmt" if result['mgmt'] else "no-mgmt")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark how the conversion time grows with the size of the topology')
+    parser.add_argument('--sizes', default='10,100,1000',
+                        help='comma separated target node counts, default 10,100,1000 (the full suite is 10,100,1000,10000)')
+    parser.add_argument('--families', default=",".join(name for name, generator in families),
+                        help='comma separated topology families, default all of: %s' % ", ".join(name for name, generator in families))
+    parser.add_argument('--providers', default='virtualbox,libvirt', help='comma separated providers, default both')
+    parser.add_argument('--no-mgmt', action='store_true', help='skip the runs with "-c"')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per measurement, best time is reported')
+    parser.add_argument('--max-exponent', type=float, default=1.3,
+                        help='flag series whose time grows faster than nodes^max-exponent, default 1.3')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='flag runs more than this fraction slower than the baseline, default 0.5')
+    parser.add_argument('--baseline', help='compare against a JSON baseline saved by an earlier run')
+    parser.add_argument('--save-baseline', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    generators = dict(families)
+    selected = [name.strip() for name in args.families.split(',')]
+    for name in selected:
+        if name not in generators: parser.error("unknown family %s" % name)
+    providers = [provider.strip() for provider in args.providers.split(',')]
+    mgmt_modes = [False] if args.no_mgmt else [False, True]
+
+    # Conversions write relative to the current directory, so work in a copy
+    work_dir = tempfile.mkdtemp()
+    for name in ['templates', 'helper_scripts']:
+        shutil.copytree(os.path.join(repo_dir, name), os.path.join(work_dir, name))
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+
+    # Compile the templates first so the smallest runs do not pay for it
+    warm_up = os.path.join(work_dir, "warm-up.dot")
+    nodes, links = ring(10)
+    write_topology(warm_up, nodes, links, True)
+    for provider in providers: convert(warm_up, provider, True, 1)
+    os.remove(warm_up)
+
+    results = []
+    print("%-12s %-11s %-8s %8s %8s %8s %11s" % ("family", "provider", "mgmt", "target", "nodes", "links", "time(s)"))
+    try:
+        for family in selected:
+            for target in sizes:
+                nodes, links = generators[family](target)
+                for mgmt in mgmt_modes:
+                    topology_file = os.path.join(work_dir, "%s-%s%s.dot" % (family, target, "-mgmt" if mgmt else ""))
+                    write_topology(topology_file, nodes, links, mgmt)
+                    for provider in providers:
+                        # One libvirt tunnel_ip runs out of UDP ports on the largest topologies
+                        hypervisors = 1
+                        if provider == "libvirt":
+                            hypervisors = int(math.ceil(1.0 * udp_port_count(nodes, links, mgmt) / single_host_ports))
+                        best = None
+                        for i in range(args.repeat):
+                            seconds = convert(topology_file, provider, mgmt, hypervisors)
+                            if seconds is None: break
+                            if best is None or seconds < best: best = seconds
+                        result = dict(family=family, provider=provider, mgmt=mgmt, target=target,
+                                      nodes=len(nodes), links=len(links), hypervisors=hypervisors, seconds=best)
+                        results.append(result)
+                        print("%-12s %-11s %-8s %8s %8s %8s %11s" % (family, provider, "-c" if mgmt else "-", target, len(nodes),
+                                                                      len(links), "FAILED" if best is None else "%.4f" % best))
+                    os.remove(topology_file)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
+
+    series = {}
+    for result in results:
+        if result['seconds'] is not None: series.setdefault(series_key(result), []).append((result['nodes'], result['seconds']))
+    exponents = dict((key, growth_exponent(points)) for key, points in series.items())
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    baseline_results = {}
+    if baseline:
+        for result in baseline['results']:
+            baseline_results[(series_key(result), result['target'])] = result['seconds']
+
+    flagged = []
+    for result in results:
+        if result['seconds'] is None:
+            flagged.append("%s at %s nodes failed to convert" % (series_key(result), result['nodes']))
+            continue
+        previous = baseline_results.get((series_key(result), result['target']))
+        # Runs well under a second swing by more than the tolerance between runs
+        if previous and previous >= 0.1 and result['seconds'] > previous * (1 + args.tolerance):
+            flagged.append("%s at %s nodes took %.4fs, %.1fx the baseline %.4fs" % (series_key(result), result['nodes'], result['seconds'],
+                                                                                  result['seconds'] / previous, previous))
+
+    # Exponents fitted over other sizes are not comparable
+    baseline_exponents = {}
+    if baseline and baseline.get('sizes') == sizes: baseline_exponents = baseline.get('exponents', {})
+    elif baseline: print("\nThe baseline was measured at sizes %s, only times at matching sizes are compared." % baseline.get('sizes'))
+
+    print("\n%-36s %9s %9s" % ("series", "exponent", "baseline"))
+    for key in sorted(exponents):
+        previous = baseline_exponents.get(key)
+        exponent = exponents[key]
+        print("%-36s %9s %9s" % (key, "-" if exponent is None else "%.2f" % exponent, "-" if previous is None else "%.2f" % previous))
+        if exponent is None: continue
+        if exponent > args.max_exponent:
+            flagged.append("%s grows as nodes^%.2f, more than nodes^%.2f" % (key, exponent, args.max_exponent))
+        elif previous is not None and exponent > previous + 0.2:
+            flagged.append("%s grows as nodes^%.2f, up from nodes^%.2f in the baseline" % (key, exponent, previous))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            baseline_file.write(json.dumps({'version': topology_converter.version,
+                                            'python': platform.python_version(),
+                                            'sizes': sizes,
+                                            'results': results,
+                                            'exponents': exponents}, indent=2, sort_keys=True) + "\n")
+        print("\nBaseline written to %s" % args.save_baseline)
+
+    if flagged:
+        print("\nREGRESSIONS:")
+        for message in flagged: print("  " + message)
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
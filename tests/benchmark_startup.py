@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#
+#    Benchmark for the startup time of topology_converter.py
+#       times new interpreter runs of --version, --lint-only over the example
+#       topologies and a full conversion, and checks that the fast paths do
+#       not import the rendering stack (jinja2) or pydotplus/pyparsing.
+#
+#    Run from the root of the repository:
+#       python ./tests/benchmark_startup.py
+#       python ./tests/benchmark_startup.py --repeat 20 --max-lint-time 0.5
+#
+import os
+import sys
+import glob
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+heavy_modules = ['jinja2', 'pydotplus', 'pyparsing', 'multiprocessing', 'pprint']
+
+# Runs topology_converter.py as __main__ and reports the heavy modules it
+# imported on stderr.
+runner = '''
+import sys, runpy
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+except SystemExit as e:
+    code = e.code
+else:
+    code = 0
+sys.stderr.write('LOADED:' + ','.join(m for m in %r if m in sys.modules) + '\\n')
+sys.exit(code)
+''' % heavy_modules
+
+
+def run(arguments, cwd):
+    start = time.time()
+    process = subprocess.Popen([sys.executable, '-c', runner, os.path.join(cwd, 'topology_converter.py')] + arguments,
+                               cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, errors = process.communicate()
+    elapsed = time.time() - start
+    loaded = []
+    for line in errors.decode('utf-8', 'replace').splitlines():
+        if line.startswith('LOADED:'): loaded = [m for m in line[len('LOADED:'):].split(',') if m]
+    return elapsed, process.returncode, loaded
+
+
+def best_of(repeat, arguments, cwd):
+    best = None
+    for i in range(repeat):
+        elapsed, returncode, loaded = run(arguments, cwd)
+        if best is None or elapsed < best: best = elapsed
+    return best, returncode, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the startup time of topology_converter.py')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measurement, best time is reported')
+    parser.add_argument('--max-lint-time', type=float,
+                        help='fail when --lint-only over the examples takes longer than this many seconds')
+    args = parser.parse_args()
+
+    # Work on a copy so the conversion does not leave files in the repository
+    work_dir = tempfile.mkdtemp()
+    for name in ['topology_converter.py', 'templates', 'helper_scripts', 'examples']:
+        source = os.path.join(repo_dir, name)
+        if os.path.isdir(source): shutil.copytree(source, os.path.join(work_dir, name))
+        else: shutil.copy(source, work_dir)
+    examples = sorted(os.path.relpath(path, work_dir) for path in glob.glob(os.path.join(work_dir, 'examples', '*.dot')))
+
+    fast_path = ['jinja2', 'pydotplus', 'pyparsing']
+    measurements = [("--help", ) + best_of(args.repeat, ['--help'], work_dir) + (fast_path,),
+                    ("--version", ) + best_of(args.repeat, ['--version'], work_dir) + (fast_path,),
+                    ("--lint-only (%s files)" % len(examples), ) + best_of(args.repeat, ['--lint-only'] + examples, work_dir) + (fast_path,),
+                    ("convert 2switch.dot", ) + best_of(args.repeat, ['examples/2switch.dot'], work_dir) + ([],)]
+    shutil.rmtree(work_dir)
+
+    failed = False
+    print("%-28s %10s  %s" % ("run", "time(s)", "heavy modules loaded"))
+    for name, elapsed, returncode, loaded, forbidden in measurements:
+        print("%-28s %10.4f  %s" % (name, elapsed, ", ".join(loaded) or "-"))
+        if returncode != 0:
+            print("  FAILED: %s exited with %s" % (name, returncode))
+            failed = True
+        for module in forbidden:
+            if module in loaded:
+                print("  FAILED: %s imported %s" % (name, module))
+                failed = True
+    lint_time = measurements[2][1]
+    if args.max_lint_time is not None and lint_time > args.max_lint_time:
+        print("  FAILED: --lint-only took %.4fs, more than %.4fs" % (lint_time, args.max_lint_time))
+        failed = True
+    if failed: exit(1)
+
+
+if __name__ == "__main__":
+    main()
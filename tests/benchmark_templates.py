@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#
+#    Benchmark for template loading
+#       compares compiling every template from source (the old per-run
+#       jinja2.Template behaviour) against the shared Environment with a
+#       cold, warm on-disk and warm in-memory bytecode cache.
+#
+#    Run from the root of the repository:
+#       python ./tests/benchmark_templates.py
+#       python ./tests/benchmark_templates.py --repeat 20
+#
+import os
+import sys
+import glob
+import time
+import shutil
+import argparse
+import tempfile
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+import jinja2
+import topology_converter
+
+
+def template_files():
+    files = [os.path.join(repo_dir, topology_converter.VAGRANTFILE_template),
+             os.path.join(repo_dir, topology_converter.VAGRANTFILE_common_template)]
+    files += sorted(glob.glob(os.path.join(repo_dir, 'templates', 'auto_mgmt_network', '*.j2')))
+    return files
+
+
+def load_from_source(files):
+    for path in files:
+        with open(path) as template_file:
+            jinja2.Template(template_file.read())
+
+
+def load_from_environment(files, environment):
+    for path in files:
+        environment.get_template(topology_converter.template_name(path))
+
+
+def fresh_environment():
+    # Forget the per-process Environment, like starting a new process would
+    topology_converter.template_environments.clear()
+    return topology_converter.template_environment(True)
+
+
+def best_of(repeat, function):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best: best = elapsed
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark template loading with and without the compiled-template cache')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measurement, best time is reported')
+    args = parser.parse_args()
+
+    files = template_files()
+    cache_dir = tempfile.mkdtemp()
+    topology_converter.template_cache_dir = cache_dir
+
+    def cold():
+        for name in os.listdir(cache_dir): os.remove(os.path.join(cache_dir, name))
+        load_from_environment(files, fresh_environment())
+
+    def warm_disk():
+        load_from_environment(files, fresh_environment())
+
+    environment = fresh_environment()
+    load_from_environment(files, environment)
+
+    timings = [("compile from source", best_of(args.repeat, lambda: load_from_source(files))),
+               ("cold cache", best_of(args.repeat, cold)),
+               ("warm cache (new process)", best_of(args.repeat, warm_disk)),
+               ("warm cache (same process)", best_of(args.repeat, lambda: load_from_environment(files, environment)))]
+    shutil.rmtree(cache_dir)
+
+    print("%s templates" % len(files))
+    print("%-28s %12s %9s" % ("mode", "load(s)", "speedup"))
+    for mode, elapsed in timings:
+        print("%-28s %12.5f %8.1fx" % (mode, elapsed, timings[0][1] / max(elapsed, 1e-9)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#
+#    Shared test helpers
+#       copy_simulation() copies templates, helper_scripts and examples into a
+#       directory so a conversion can run there without touching the
+#       repository, working_directory() runs a block in that directory and
+#       captured_stdout() collects what the converter prints. The simulation
+#       fixture combines them for a test that converts in its own tmpdir.
+#
+import os
+import sys
+import shutil
+import contextlib
+
+import pytest
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if repo_dir not in sys.path: sys.path.insert(0, repo_dir)
+
+
+def copy_simulation(directory):
+    # helper_scripts/auto_mgmt_network is generated output, left behind by
+    # conversions run in the repository itself
+    for name in ['templates', 'helper_scripts', 'examples']:
+        shutil.copytree(os.path.join(repo_dir, name), os.path.join(directory, name),
+                        ignore=shutil.ignore_patterns('auto_mgmt_network') if name == 'helper_scripts' else None)
+    return directory
+
+
+@contextlib.contextmanager
+def working_directory(directory):
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        yield directory
+    finally:
+        os.chdir(cwd)
+
+
+@contextlib.contextmanager
+def captured_stdout():
+    real_stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        yield sys.stdout
+    finally:
+        sys.stdout = real_stdout
+
+
+@pytest.fixture
+def simulation(tmpdir, monkeypatch):
+    copy_simulation(str(tmpdir))
+    monkeypatch.chdir(str(tmpdir))
+    return tmpdir
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#
+#    Address pool tests
+#       checks that AddressPool hands out the same host addresses as
+#       network.hosts() at the /30, /31 and /8 edges, that reserved addresses
+#       are skipped, and that an exhausted pool returns None.
+#
+#    Run from the root of the repository:
+#       python -m pytest -q ./tests/test_address_pool.py
+#
+import ipaddress
+
+import pytest
+
+import topology_converter
+
+
+def pool(network):
+    return topology_converter.AddressPool(ipaddress.ip_network(network))
+
+
+def drain(address_pool):
+    addresses = []
+    while True:
+        address = address_pool.allocate()
+        if address is None: return addresses
+        addresses.append(address)
+
+
+@pytest.mark.parametrize('network', [u'192.168.0.0/30', u'192.168.0.0/31', u'192.168.0.1/32',
+                                     u'192.168.0.0/29', u'fd00::/126', u'fd00::/127'])
+def test_small_networks_match_hosts(network):
+    assert drain(pool(network)) == list(ipaddress.ip_network(network).hosts())
+
+
+def test_slash_30_edges():
+    address_pool = pool(u'10.0.0.0/30')
+    assert not address_pool.reserve(ipaddress.ip_address(u'10.0.0.0'))
+    assert not address_pool.reserve(ipaddress.ip_address(u'10.0.0.3'))
+    assert address_pool.reserve(ipaddress.ip_address(u'10.0.0.1'))
+    assert not address_pool.reserve(ipaddress.ip_address(u'10.0.0.1'))
+    assert drain(address_pool) == [ipaddress.ip_address(u'10.0.0.2')]
+
+
+def test_slash_31_has_no_network_or_broadcast():
+    address_pool = pool(u'10.0.0.0/31')
+    assert address_pool.reserve(ipaddress.ip_address(u'10.0.0.0'))
+    assert drain(address_pool) == [ipaddress.ip_address(u'10.0.0.1')]
+
+
+def test_slash_8_edges():
+    address_pool = pool(u'10.0.0.0/8')
+    assert address_pool.reserve(ipaddress.ip_address(u'10.0.0.1'))
+    assert address_pool.reserve(ipaddress.ip_address(u'10.0.0.2'))
+    assert address_pool.allocate() == ipaddress.ip_address(u'10.0.0.3')
+    assert address_pool.reserve(ipaddress.ip_address(u'10.255.255.254'))
+    assert not address_pool.reserve(ipaddress.ip_address(u'10.255.255.255'))
+    assert not address_pool.reserve(ipaddress.ip_address(u'11.0.0.1'))
+    # whole blocks reserved cost one range each
+    address_pool.used.add_range(int(ipaddress.ip_address(u'10.0.0.4')), int(ipaddress.ip_address(u'10.255.255.254')))
+    assert len(address_pool.used.starts) == 1
+    assert address_pool.allocate() is None
+
+
+def test_nth_matches_indexing():
+    network = ipaddress.ip_network(u'10.0.0.0/8')
+    address_pool = topology_converter.AddressPool(network)
+    for index in [0, 1, 65536, network.num_addresses - 1]:
+        assert address_pool.nth(index) == network[index]
+    for index in [-1, network.num_addresses]:
+        with pytest.raises(IndexError):
+            address_pool.nth(index)
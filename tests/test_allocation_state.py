@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#
+#    Allocation state tests
+#       converts a topology with --state-file, changes its links and converts
+#       it again, checking that the links and interfaces both runs share keep
+#       their net_number, libvirt UDP ports and MACs, and that a state file
+#       which is corrupt or no longer matches the topology is handled.
+#
+#    Run from the root of the repository:
+#       python -m pytest -q ./tests/test_allocation_state.py
+#
+import json
+
+import pytest
+
+import topology_converter
+from conftest import captured_stdout
+
+nodes = ''' "leaf1" [function="leaf" os="CumulusCommunity/cumulus-vx"]
+ "leaf2" [function="leaf" os="CumulusCommunity/cumulus-vx"]
+ "leaf3" [function="leaf" os="CumulusCommunity/cumulus-vx"]
+'''
+links = ['   "leaf1":"swp1" -- "leaf2":"swp1"\n',
+         '   "leaf1":"swp2" -- "leaf3":"swp1"\n',
+         '   "leaf2":"swp2" -- "leaf3":"swp2"\n']
+
+
+def write_topology(links):
+    with open('state.dot', 'w') as dot:
+        dot.write('graph dc1 {\n' + nodes + ''.join(links) + '}\n')
+
+
+def convert(**options):
+    # Returns (stdout, saved state) of one run
+    with captured_stdout() as output:
+        topology_converter.Converter('state.dot', provider='libvirt', inventory_cache=False,
+                                     state_file='state.json', **options).run()
+    with open('state.json') as state:
+        return output.getvalue(), json.load(state)
+
+
+def shared(first, second, section):
+    keys = set(first[section]) & set(second[section])
+    assert keys
+    return dict((key, first[section][key]) for key in keys), dict((key, second[section][key]) for key in keys)
+
+
+def test_added_link_keeps_allocations(simulation):
+    write_topology(links[1:])
+    output, first = convert()
+    # The new link sorts ahead of the others and would take net1 without the state
+    write_topology(links)
+    output, second = convert()
+    before, after = shared(first, second, 'links')
+    assert after == before
+    before, after = shared(first, second, 'macs')
+    assert after == before
+    new = second['links']['leaf1:swp1 -- leaf2:swp1']
+    assert new['net_number'] not in [link['net_number'] for link in first['links'].values()]
+    assert not set(new['ports']) & set(port for link in first['links'].values() for port in link['ports'])
+
+
+def test_removed_link_keeps_allocations(simulation):
+    write_topology(links)
+    output, first = convert()
+    write_topology(links[1:])
+    output, second = convert()
+    assert 'leaf1:swp1 -- leaf2:swp1' not in second['links']
+    before, after = shared(first, second, 'links')
+    assert after == before
+    before, after = shared(first, second, 'macs')
+    assert after == before
+
+
+def test_corrupt_state_file_is_an_error(simulation):
+    write_topology(links)
+    with open('state.json', 'w') as state:
+        state.write('{"links": {')
+    with pytest.raises(topology_converter.ConversionError) as error:
+        convert()
+    assert 'is not valid JSON' in str(error.value)
+
+
+def test_stale_state_file_is_ignored_where_it_no_longer_fits(simulation):
+    write_topology(links)
+    output, first = convert()
+    stale = dict(first)
+    # an entry that is not a link, a net_number and a UDP port held twice
+    # and the MAC of leaf1:swp2 saved for an interface that is gone
+    stale['links'] = dict(first['links'])
+    stale['links']['leaf9:swp1 -- leaf9:swp2'] = 5
+    stale['links']['leaf2:swp2 -- leaf3:swp2'] = dict(first['links']['leaf1:swp1 -- leaf2:swp1'],
+                                                     left='leaf2:swp2')
+    stale['macs'] = dict(first['macs'])
+    stale['macs']['leaf9,swp1'] = stale['macs'].pop('leaf1,swp2')
+    with open('state.json', 'w') as state:
+        json.dump(stale, state)
+    output, second = convert()
+    assert second['links']['leaf1:swp1 -- leaf2:swp1'] == first['links']['leaf1:swp1 -- leaf2:swp1']
+    numbers = [link['net_number'] for link in second['links'].values()]
+    assert len(set(numbers)) == len(numbers) == 3
+    ports = [port for link in second['links'].values() for port in link['ports']]
+    assert len(set(ports)) == len(ports) == 6
+    macs = list(second['macs'].values())
+    assert len(set(macs)) == len(macs)
+    assert 'leaf9,swp1' not in second['macs']
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+#
+#    Command line tests
+#       runs topology_converter.py the way a user would, through main() with
+#       a command line, and checks the options that only exist there.
+#
+#    Run from the root of the repository:
+#       python -m pytest -q ./tests/test_command_line.py
+#
+import os
+import re
+import json
+import sys
+
+import topology_converter
+from conftest import captured_stdout
+
+
+def run(*arguments):
+    # Returns (exit code, stdout without terminal colors) of one run
+    argv = sys.argv
+    sys.argv = ['topology_converter.py'] + list(arguments)
+    code = 0
+    try:
+        with captured_stdout() as output:
+            try:
+                topology_converter.main()
+            except SystemExit as e:
+                code = e.code
+    finally:
+        sys.argv = argv
+    return code, re.sub(r'\033\[[0-9;]*m', '', output.getvalue())
+
+
+def test_batch_converts_every_topology(simulation):
+    simulation.join('broken.dot').write('graph dc1 {\n "leaf1" [function="leaf"]\n   "leaf1":"swp1" -- "leaf9":"swp1"\n}\n')
+    simulation.join('topology_list').write('# topology_file output_dir provider\n'
+                                           'examples/2switch.dot out/two libvirt\n'
+                                           'broken.dot\n'
+                                           'examples/3switch_circular.dot\n')
+    code, output = run('--batch', 'topology_list', '-o', 'batch', '-j', '2')
+    assert code == 1
+    summary = [line.strip() for line in output.splitlines() if line.strip().startswith(('OK', 'ERROR'))]
+    assert summary[0] == 'OK     examples/2switch.dot --> out/two (libvirt)'
+    assert summary[1].startswith('ERROR  broken.dot --> batch/broken (virtualbox): ### ERROR: device leaf9')
+    assert summary[2] == 'OK     examples/3switch_circular.dot --> batch/3switch_circular (virtualbox)'
+    assert '2 of 3 topologies converted' in output
+    assert "libvirt__tunnel_type" in simulation.join('out', 'two', 'Vagrantfile').read()
+    assert simulation.join('batch', '3switch_circular', 'Vagrantfile').check()
+    assert not simulation.join('batch', 'broken', 'Vagrantfile').check()
+    assert not simulation.join('Vagrantfile').check()
+    # the provisioning scripts the Vagrantfiles refer to come along
+    for output_dir in [simulation.join('out', 'two'), simulation.join('batch', '3switch_circular')]:
+        assert './helper_scripts/extra_switch_config.sh' in output_dir.join('Vagrantfile').read()
+        assert output_dir.join('helper_scripts', 'extra_switch_config.sh').read() == \
+            simulation.join('helper_scripts', 'extra_switch_config.sh').read()
+
+
+def test_batch_comments_need_whitespace(simulation):
+    simulation.join('topology_list').write('# topology_file output_dir\n'
+                                           'examples/2switch.dot out/#2 # switches\n')
+    code, output = run('--batch', 'topology_list')
+    assert code == 0
+    assert 'OK     examples/2switch.dot --> out/#2 (virtualbox)' in output
+    assert simulation.join('out', '#2', 'Vagrantfile').check()
+
+
+def test_output_dir_gets_helper_scripts(simulation):
+    stale = simulation.join('helper_scripts', 'auto_mgmt_network', 'dhcpd.hosts')
+    stale.write('stale', ensure=True)
+    code, output = run('examples/2switch.dot', '-c', '-o', 'out')
+    assert code == 0
+    helper_scripts = simulation.join('out', 'helper_scripts')
+    assert helper_scripts.join('extra_switch_config.sh').read() == \
+        simulation.join('helper_scripts', 'extra_switch_config.sh').read()
+    assert helper_scripts.join('extra_switch_config.sh').stat().mode == \
+        simulation.join('helper_scripts', 'extra_switch_config.sh').stat().mode
+    # the generated files win over a stale copy in the working directory
+    assert 'stale' not in helper_scripts.join('auto_mgmt_network', 'dhcpd.hosts').read()
+
+
+def set_epoch_time(manifest, epoch_time):
+    with open(manifest) as manifest_file:
+        content = json.load(manifest_file)
+    content['epoch_time'] = epoch_time
+    with open(manifest, 'w') as manifest_file:
+        json.dump(content, manifest_file)
+
+
+def test_unchanged_inputs_leave_files_alone(simulation):
+    assert run('examples/2switch.dot', '-o', 'out')[0] == 0
+    vagrantfile = simulation.join('out', 'Vagrantfile')
+    manifest = str(simulation.join('out', '.topology_converter_manifest'))
+    # an epoch_time no run of the test could come up with on its own
+    set_epoch_time(manifest, 12345)
+    vagrantfile.write(re.sub('simid = [0-9]+', 'simid = 12345', vagrantfile.read()))
+    content = vagrantfile.read()
+    os.utime(str(vagrantfile), (1000000000, 1000000000))
+
+    assert run('examples/2switch.dot', '-o', 'out')[0] == 0
+    assert vagrantfile.read() == content
+    assert vagrantfile.mtime() == 1000000000
+
+    # -v is part of the arguments hash, so this run starts a new simulation
+    assert run('examples/2switch.dot', '-o', 'out', '-v')[0] == 0
+    assert 'simid = 12345' not in vagrantfile.read()
+    assert vagrantfile.mtime() != 1000000000
+
+
+def test_force_rewrites_everything(simulation):
+    assert run('examples/2switch.dot', '-o', 'out')[0] == 0
+    vagrantfile = simulation.join('out', 'Vagrantfile')
+    set_epoch_time(str(simulation.join('out', '.topology_converter_manifest')), 12345)
+    os.utime(str(vagrantfile), (1000000000, 1000000000))
+    assert run('examples/2switch.dot', '-o', 'out', '--force')[0] == 0
+    with open(str(simulation.join('out', '.topology_converter_manifest'))) as manifest:
+        assert json.load(manifest)['epoch_time'] != 12345
+    assert vagrantfile.mtime() != 1000000000
+
+
+def test_rewritten_outputs_keep_their_mode(simulation):
+    simulation.join('script.j2').write('#!/bin/sh\necho {{ devices|length }} devices\n')
+    assert run('examples/2switch.dot', '-t', 'script.j2', 'script.sh')[0] == 0
+    script = simulation.join('script.sh')
+    script.chmod(0o755)
+    script.write('#!/bin/sh\n')
+    assert run('examples/2switch.dot', '-t', 'script.j2', 'script.sh')[0] == 0
+    assert script.read() == '#!/bin/sh\necho 2 devices'
+    assert script.stat().mode & 0o777 == 0o755
+
+
+def test_rewritten_outputs_follow_symlinks(simulation):
+    simulation.join('shared', 'Vagrantfile').write('', ensure=True)
+    simulation.join('Vagrantfile').mksymlinkto(simulation.join('shared', 'Vagrantfile'))
+    assert run('examples/2switch.dot')[0] == 0
+    assert simulation.join('Vagrantfile').islink()
+    assert 'config.vm.define' in simulation.join('shared', 'Vagrantfile').read()
+
+
+def test_diff_reports_vms_to_reload(simulation):
+    devices = ''' "leaf1" [function="leaf" os="CumulusCommunity/cumulus-vx"%s]
+ "leaf2" [function="leaf" os="CumulusCommunity/cumulus-vx"]
+ "%s" [function="leaf" os="CumulusCommunity/cumulus-vx"]
+'''
+    simulation.join('diff.dot').write('graph dc1 {\n' + devices % ('', 'leaf3') +
+                                      '   "leaf1":"swp1" -- "leaf2":"swp1"\n}\n')
+    assert run('diff.dot', '-p', 'libvirt', '--state-file', 'state.json')[0] == 0
+    simulation.join('diff.dot').write('graph dc1 {\n' + devices % (' memory="1024"', 'leaf4') +
+                                      '   "leaf1":"swp1" -- "leaf2":"swp1"\n'
+                                      '   "leaf2":"swp2" -- "leaf4":"swp1"\n}\n')
+    code, output = run('diff.dot', '-p', 'libvirt', '--state-file', 'state.json',
+                       '--diff', 'state.json', '--diff-json', 'changes.json')
+    assert code == 0
+    with open('changes.json') as changes:
+        report = json.load(changes)
+    assert report['added'] == ['leaf4']
+    assert report['removed'] == ['leaf3']
+    assert report['changed'] == {'leaf1': {'attributes': ['memory'], 'interfaces': []},
+                                 'leaf2': {'attributes': [], 'interfaces': ['swp2']}}
+    assert report['reload'] == ['leaf1', 'leaf2']
+    assert 'changed:   leaf1 (attributes: memory)' in output
+    assert 'VMs to reload: leaf1 leaf2' in output
+
+    # the state file now holds this run, so nothing is left to reload
+    code, output = run('diff.dot', '-p', 'libvirt', '--state-file', 'state.json', '--diff', 'state.json')
+    assert 'unchanged: 3' in output
+    assert 'VMs to reload: (none)' in output
+
+
+def test_shard_writes_a_vagrantfile_per_hypervisor(simulation):
+    code, output = run('examples/2switch.dot', '-p', 'libvirt', '--shard',
+                       '--hypervisors', '127.0.1.1:512,127.0.1.2:512')
+    assert code == 0
+    assert '127.0.1.1: 1 devices --> ./hypervisor_127.0.1.1/Vagrantfile' in output
+    assert not simulation.join('Vagrantfile').check()
+    for local, remote in [('127.0.1.1', '127.0.1.2'), ('127.0.1.2', '127.0.1.1')]:
+        vagrantfile = simulation.join('hypervisor_' + local, 'Vagrantfile').read()
+        assert vagrantfile.count('config.vm.define') == 1
+        # four links to the other hypervisor and a tunnel of its own for eth0
+        assert vagrantfile.count(":libvirt__tunnel_ip => '%s'" % remote) == 4
+        assert vagrantfile.count(":libvirt__tunnel_ip => '%s'" % local) == 1
+        assert ":libvirt__tunnel_local_ip => '%s'" % remote not in vagrantfile
+        # the provisioning scripts the Vagrantfile refers to come along
+        assert './helper_scripts/extra_switch_config.sh' in vagrantfile
+        assert simulation.join('hypervisor_' + local, 'helper_scripts', 'extra_switch_config.sh').read() == \
+            simulation.join('helper_scripts', 'extra_switch_config.sh').read()
+
+
+def test_shard_copies_generated_helper_scripts(simulation):
+    code, output = run('examples/2switch.dot', '-p', 'libvirt', '--shard', '-c', '-o', 'out',
+                       '--hypervisors', '127.0.1.1,127.0.1.2')
+    assert code == 0
+    generated = simulation.join('out', 'helper_scripts', 'auto_mgmt_network', 'dhcpd.hosts').read()
+    for host in ['127.0.1.1', '127.0.1.2']:
+        shard = simulation.join('out', 'hypervisor_' + host, 'helper_scripts')
+        assert shard.join('auto_mgmt_network', 'dhcpd.hosts').read() == generated
+        assert shard.join('oob_switch_config.sh').check()
+
+
+def test_render_jobs_give_the_same_output(simulation):
+    outputs = {}
+    for jobs in ['1', '4']:
+        code, output = run('examples/2switch_auto_mgmt.dot', '-c', '-p', 'libvirt', '-o', 'jobs' + jobs,
+                           '--render-jobs', jobs)
+        assert code == 0
+        files = {}
+        for directory, subdirectories, names in os.walk(str(simulation.join('jobs' + jobs))):
+            for name in names:
+                if name == '.topology_converter_manifest': continue
+                path = os.path.join(directory, name)
+                with open(path) as generated:
+                    content = generated.read()
+                # the command line and the simid are the only things allowed to differ
+                content = re.sub(r'built with the following args: .*', '', content)
+                content = re.sub(r'simid = [0-9]+', '', content)
+                files[os.path.relpath(path, str(simulation.join('jobs' + jobs)))] = content
+        outputs[jobs] = (output, files)
+    assert 'helper_scripts/auto_mgmt_network/dhcpd.hosts' in outputs['1'][1]
+    assert 'Vagrantfile' in outputs['1'][1]
+    assert outputs['4'] == outputs['1']
+
+
+def test_lint_only_reports_every_file(simulation):
+    simulation.join('undefined.dot').write('graph dc1 {\n "leaf1" [function="leaf"]\n   "leaf1":"swp1" -- "leaf9":"swp1"\n}\n')
+    code, output = run('--lint-only', 'examples/2switch.dot', 'undefined.dot', 'examples/3switch_circular.dot')
+    assert code == 1
+    assert 'OK     examples/2switch.dot (2 devices, 4 links)' in output
+    assert 'device leaf9 is referred to in list of edges/links but not defined as a node' in output
+    assert 'ERROR  undefined.dot' in output
+    assert 'OK     examples/3switch_circular.dot' in output
+    assert not simulation.join('Vagrantfile').check()
+
+
+def test_lint_only_reports_option_errors(simulation):
+    code, output = run('--lint-only', '-t', 'missing.j2', 'out', 'examples/2switch.dot', 'examples/3switch_circular.dot')
+    assert code == 1
+    assert output.count('"missing.j2" does not exist') == 2
+    assert 'ERROR  examples/2switch.dot' in output
+    assert 'ERROR  examples/3switch_circular.dot' in output
+
+
+def test_timings_json(simulation):
+    code, output = run('examples/2switch.dot', '-p', 'libvirt', '-o', 'out', '--timings-json', 'timings.json')
+    assert code == 0
+    assert 'TIMINGS:' in output
+    with open(str(simulation.join('out', 'timings.json'))) as timings:
+        report = json.load(timings)
+    assert report['topology_file'] == 'examples/2switch.dot'
+    assert report['provider'] == 'libvirt'
+    names = [phase['name'] for phase in report['phases']]
+    assert names[:2] == ['read inventory cache', 'parse topology (native, with lint)']
+    assert 'render out/Vagrantfile' in names
+    assert all(phase['seconds'] >= 0 for phase in report['phases'])
+    assert report['total_seconds'] >= sum(phase['seconds'] for phase in report['phases'])
+    assert report['counters']['nodes'] == 2
+    assert report['counters']['edges'] == 4
+
+
+def test_memory_is_only_traced_when_asked(simulation):
+    assert run('examples/2switch.dot', '--timings-json', 'timings.json')[0] == 0
+    with open('timings.json') as timings:
+        assert all(phase['peak_bytes'] is None for phase in json.load(timings)['phases'])
+    assert run('examples/2switch.dot', '--timings-memory', '--timings-json', 'timings.json')[0] == 0
+    with open('timings.json') as timings:
+        assert all(phase['peak_bytes'] > 0 for phase in json.load(timings)['phases'])
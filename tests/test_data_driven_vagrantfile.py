@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#
+#    Data-driven Vagrantfile tests
+#       converts every examples/*.dot with and without --data-driven and
+#       checks that the Vagrantfile.json written beside the fixed Vagrantfile
+#       holds the same devices and interfaces as the unrolled Vagrantfile.
+#       When ruby is installed both Vagrantfiles are also loaded against a
+#       stand-in for Vagrant that records every call made on the config, and
+#       the two recordings must be identical.
+#
+#    Run from the root of the repository:
+#       python -m pytest -q ./tests/test_data_driven_vagrantfile.py
+#
+import os
+import re
+import json
+import subprocess
+
+import pytest
+
+from conftest import copy_simulation, working_directory, captured_stdout
+from test_golden_output import topology_converter, examples, providers, modes, case_dir
+
+cases = [(example, provider, mode) for example in examples for provider in providers for mode in [m[0] for m in modes]]
+
+# Loads the Vagrantfile given as its argument and prints one line per call
+# made on the Vagrant config, with the arguments it was given.
+recorder = '''
+$calls = []
+class Recorder < BasicObject
+  def initialize(path) @path = path end
+  def method_missing(name, *args, **kwargs, &block)
+    call = "#{@path}.#{name}"
+    call += args.inspect unless args.empty?
+    call += kwargs.inspect unless kwargs.empty?
+    $calls << call if !args.empty? || !kwargs.empty? || block
+    child = ::Recorder.new(call)
+    block.call(child) if block
+    child
+  end
+end
+module Vagrant
+  def self.configure(version, &block) block.call(Recorder.new("config")) end
+  def self.require_version(*args) end
+  def self.has_plugin?(name) true end
+end
+load ARGV[0]
+puts $calls
+'''
+
+
+def has_ruby():
+    try:
+        return subprocess.call(['ruby', '-e', 'exit 0']) == 0
+    except OSError:
+        return False
+
+
+def convert(example, provider, mode, work_dir, data_driven):
+    # Returns the directory holding the output
+    options = [m[2] for m in modes if m[0] == mode][0]
+    simulation_dir = copy_simulation(os.path.join(work_dir, 'data' if data_driven else 'unrolled'))
+    with working_directory(simulation_dir), captured_stdout():
+        converter = topology_converter.Converter("examples/%s.dot" % example, provider=provider,
+                                                 data_driven=data_driven, **options)
+        # Both runs share one simid so the recordings can be compared
+        converter.epoch_time = "1500000000"
+        converter.run()
+    return simulation_dir
+
+
+def pytest_generate_tests(metafunc):
+    if 'case' in metafunc.fixturenames:
+        metafunc.parametrize('case', cases, ids=["%s-%s-%s" % case for case in cases])
+
+
+def test_data_matches_unrolled_vagrantfile(case, tmpdir):
+    if os.path.isfile(os.path.join(case_dir(*case), 'ERROR')): pytest.skip("the example does not convert with these options")
+    unrolled = convert(*case, work_dir=str(tmpdir), data_driven=False)
+    data = convert(*case, work_dir=str(tmpdir), data_driven=True)
+    with open(os.path.join(unrolled, 'Vagrantfile')) as vagrantfile:
+        unrolled_vagrantfile = vagrantfile.read()
+    with open(os.path.join(data, topology_converter.VAGRANTFILE_data)) as data_file:
+        vagrant_data = json.load(data_file)
+
+    hostnames = re.findall(r'config\.vm\.define "([^"]+)"', unrolled_vagrantfile)
+    assert [vm['hostname'] for vm in vagrant_data['devices']] == hostnames
+    macs = re.findall(r':mac => "([0-9a-f:]+)"', unrolled_vagrantfile)
+    data_macs = [link['mac'] for vm in vagrant_data['devices'] for link in vm['interfaces']]
+    if case[1] == 'virtualbox': data_macs = [mac.replace(':', '') for mac in data_macs]
+    assert data_macs == macs
+    with open(os.path.join(data, 'dhcp_mac_map')) as data_map, open(os.path.join(unrolled, 'dhcp_mac_map')) as unrolled_map:
+        assert data_map.read() == unrolled_map.read()
+
+    if not has_ruby(): return
+    recordings = []
+    for directory in [unrolled, data]:
+        process = subprocess.Popen(['ruby', '-e', recorder, os.path.join(directory, 'Vagrantfile')],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, errors = process.communicate()
+        assert process.returncode == 0, errors.decode('utf-8', 'replace')
+        recordings.append(output.decode('utf-8'))
+    assert recordings[0] == recordings[1]
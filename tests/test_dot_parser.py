@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#
+#    DOT parser tests
+#       reads small topologies with the native DOT parser and with pydotplus
+#       and checks that both return the same raw records, that syntax outside
+#       the native subset raises DotSyntaxUnsupported so the converter falls
+#       back to pydotplus, that lint errors name the line they are on, and
+#       that large files read through mmap give the same records.
+#
+#    Run from the root of the repository:
+#       python -m pytest -q ./tests/test_dot_parser.py
+#
+import os
+import glob
+
+import pytest
+
+import topology_converter
+from conftest import captured_stdout, repo_dir
+
+nodes = ''' "leaf1" [function="leaf" os="CumulusCommunity/cumulus-vx"]
+ "leaf2" [function="leaf" os="CumulusCommunity/cumulus-vx"]
+ "leaf3" [function="leaf" os="CumulusCommunity/cumulus-vx"]
+'''
+
+
+def write_topology(directory, text):
+    topology = directory.join('parser.dot')
+    topology.write(text)
+    return str(topology)
+
+
+def both_parsers(topology_file):
+    # pydotplus lists every node before the edges
+    native = list(topology_converter.read_dot_records(topology_file))
+    native = [record for record in native if record[0] == 'node'] + [record for record in native if record[0] == 'edge']
+    with captured_stdout():
+        fallback = list(topology_converter.read_dot_records_pydotplus(topology_file))
+    return native, fallback
+
+
+def test_comments_and_multi_line_attributes(tmpdir):
+    native, fallback = both_parsers(write_topology(tmpdir, '''graph dc1 {
+ // a line comment
+ "leaf1" [function="leaf" os="CumulusCommunity/cumulus-vx" memory="768"] # a shell comment
+ /* a block
+    comment */ "leaf2" [function="leaf",
+                       os="CumulusCommunity/cumulus-vx"
+                       memory=512]
+   "leaf1":"swp1" -- "leaf2":"swp1" [left_mtu="9000" right_mac="44:38:39:00:00:01"];
+   "leaf1":"swp2" -- "leaf2":"swp2" /* between the ends */ [right_mtu="1500"]
+}
+'''))
+    assert native == fallback
+    assert native[1] == ('node', '"leaf2"', {'function': '"leaf"', 'os': '"CumulusCommunity/cumulus-vx"', 'memory': '512'})
+    assert len(native) == 4
+
+
+def test_unquoted_names_and_graph_attributes(tmpdir):
+    native, fallback = both_parsers(write_topology(tmpdir, '''strict graph "dc 1" {
+ rankdir=LR
+ leaf1 [function=leaf, memory=512 weight=-1.5 os="CumulusCommunity/cumulus-vx"]
+ "leaf2" [function="leaf" os="CumulusCommunity/cumulus-vx"]
+   leaf1:swp1 -- "leaf2":"swp1" [left_mtu=9000]
+}
+'''))
+    assert native == fallback
+    assert native[0] == ('node', 'leaf1', {'function': 'leaf', 'memory': '512', 'weight': '-1.5',
+                                           'os': '"CumulusCommunity/cumulus-vx"'})
+    assert native[2] == ('edge', 'leaf1:swp1', '"leaf2":"swp1"', {'left_mtu': '9000'})
+
+
+@pytest.mark.parametrize('statement, near', [
+    (' node [os="CumulusCommunity/cumulus-vx"]', 'node'),
+    (' edge [left_mtu="9000"]', 'edge'),
+    (' subgraph rack1 { "leaf4" [function="leaf"] }', 'subgraph'),
+    ('   "leaf1":"swp3" -- "leaf2":"swp3" -- "leaf3":"swp3"', '--'),
+    (' "leaf4" [function="leaf" config="say \\"hi\\" now"]', '\\" now"]'),
+])
+def test_unsupported_syntax(tmpdir, statement, near):
+    topology_file = write_topology(tmpdir, 'graph dc1 {\n' + nodes + statement + '\n}\n')
+    with pytest.raises(topology_converter.DotSyntaxUnsupported) as error:
+        list(topology_converter.read_dot_records(topology_file))
+    assert str(error.value) == 'Line 5: unsupported syntax near "%s"' % near
+
+
+def test_unterminated_block_comment(tmpdir):
+    topology_file = write_topology(tmpdir, 'graph dc1 {\n' + nodes + ' /* never closed\n}\n')
+    with pytest.raises(topology_converter.DotSyntaxUnsupported) as error:
+        list(topology_converter.read_dot_records(topology_file))
+    assert str(error.value) == 'Unexpected end of file'
+
+
+def test_converter_falls_back_to_pydotplus(simulation):
+    topology_file = write_topology(simulation, 'graph dc1 {\n' + nodes +
+                                   '   "leaf1":"swp1" -- "leaf2":"swp1" -- "leaf3":"swp1"\n}\n')
+    with captured_stdout() as output:
+        inventory, edges = topology_converter.Converter(topology_file, verbose=True).lint()
+    assert 'Line 5: unsupported syntax near "--" -- falling back to the pydotplus parser.' in output.getvalue()
+    assert sorted(inventory) == ['leaf1', 'leaf2', 'leaf3']
+    assert edges == [('"leaf1":"swp1"', '"leaf2":"swp1"', {}), ('"leaf2":"swp1"', '"leaf3":"swp1"', {})]
+
+
+def test_escaped_quotes_are_a_syntax_error(simulation):
+    # pydotplus does not unescape \" either, so the fallback cannot read it
+    topology_file = write_topology(simulation, 'graph dc1 {\n' + nodes +
+                                   ' "leaf4" [function="leaf" config="say \\"hi\\" now"]\n}\n')
+    with captured_stdout():
+        with pytest.raises(topology_converter.ConversionError) as error:
+            topology_converter.Converter(topology_file).lint()
+    assert 'There is a syntax error in your topology file' in str(error.value)
+
+
+@pytest.mark.parametrize('line, message', [
+    ('   "leaf1":"swp1" -- "leaf2:"swp1"', 'Line 5: Has an odd number of quotation characters (").'),
+    ("   'leaf1':'swp1' -- 'leaf2':swp1'", "Line 5: Has an odd number of quotation characters (')."),
+    ('   "leaf1":"swp1" - "leaf2":"swp1"',
+     'Line 5: Does not contain the following sequence " -- " to seperate the different ends of the link.'),
+])
+def test_lint_errors_name_the_line(tmpdir, line, message):
+    topology_file = write_topology(tmpdir, 'graph dc1 {\n' + nodes + line + '\n}\n')
+    with captured_stdout():
+        with pytest.raises(topology_converter.ConversionError) as error:
+            list(topology_converter.read_dot_records(topology_file))
+    assert str(error.value).startswith('### ERROR: ' + message)
+
+
+@pytest.mark.parametrize('topology_file', sorted(glob.glob(os.path.join(repo_dir, 'examples', '*.dot'))),
+                         ids=os.path.basename)
+def test_memory_mapped_read(monkeypatch, topology_file):
+    def read():
+        lines = list(topology_converter.topology_lines(topology_file))
+        return lines, list(topology_converter.read_dot_records(topology_file))
+    plain = read()
+    monkeypatch.setattr(topology_converter, 'mmap_threshold', 0)
+    assert read() == plain
+
+
+def test_memory_mapped_read_of_an_empty_file(tmpdir, monkeypatch):
+    monkeypatch.setattr(topology_converter, 'mmap_threshold', 0)
+    assert list(topology_converter.topology_lines(write_topology(tmpdir, ''))) == []
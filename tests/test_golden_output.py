@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+#    Golden output tests
+#       converts every examples/*.dot for both providers, without a
+#       management network, with "-c" and with "-cmd", and compares the
+#       Vagrantfile, dhcp_mac_map and helper_scripts/auto_mgmt_network/* files
+#       byte for byte with the files checked in under tests/golden/. The simid
+#       (epoch_time) of the Vagrantfile is the only thing normalized.
+#       Conversions that fail are expected to keep failing with the same error.
+#
+#    Run from the root of the repository:
+#       python -m pytest -q ./tests/test_golden_output.py
+#
+#    After a change that is meant to alter the output, regenerate the golden
+#    files and review the diff before committing them:
+#       python ./tests/test_golden_output.py --update
+#
+#    The golden files as first checked in are byte for byte what the original
+#    topology_converter.py (commit b925025, run on python 3 with "unicode =
+#    str" added) writes for the same cases, so they hold every later change
+#    to that output. Since then only the unconnected ports (the dummy eth0 of
+#    devices without a management network, "ports=") were changed on purpose:
+#    libvirt gives them a UDP tunnel of their own from the top of the port
+#    range and virtualbox an internal network named after the interface.
+#
+import os
+import re
+import sys
+import glob
+import shutil
+import difflib
+import tempfile
+
+from conftest import repo_dir, copy_simulation, working_directory, captured_stdout
+import topology_converter
+
+golden_dir = os.path.join(repo_dir, 'tests', 'golden')
+
+examples = sorted(os.path.splitext(os.path.basename(path))[0] for path in glob.glob(os.path.join(repo_dir, 'examples', '*.dot')))
+providers = ['virtualbox', 'libvirt']
+modes = [('default', [], {}),
+         ('c', ['-c'], {'create_mgmt_network': True}),
+         ('cmd', ['-cmd'], {'create_mgmt_device': True})]
+cases = [(example, provider, mode) for example in examples for provider in providers for mode in [m[0] for m in modes]]
+
+
+def convert(example, provider, mode, work_dir, topology_file=None):
+    # Returns {relative path: content} of the generated files, or
+    # {'ERROR': message} when the conversion fails. The conversion runs in
+    # <work_dir>/customer/simulation so the customer name that ends up in the
+    # mgmt templates does not depend on where the tests run. topology_file
+    # replaces examples/<example>.dot as the input.
+    flags, options = [(flags, options) for name, flags, options in modes if name == mode][0]
+    simulation_dir = copy_simulation(os.path.join(work_dir, 'customer', 'simulation'))
+
+    if topology_file is None: topology_file = "examples/%s.dot" % example
+    arg_string = " ".join(["topology_converter.py", topology_file, "-p", provider] + flags)
+    error = None
+    with working_directory(simulation_dir), captured_stdout() as captured:
+        try:
+            topology_converter.Converter(topology_file, provider=provider, arg_string=arg_string, **options).run()
+        except topology_converter.ConversionError:
+            error = topology_converter.batch_error_message(captured.getvalue())
+        except Exception as e:
+            error = "%s: %s" % (type(e).__name__, e)
+    if error is not None: return {'ERROR': error + "\n"}
+
+    outputs = {}
+    with open(os.path.join(simulation_dir, 'Vagrantfile')) as vagrantfile:
+        outputs['Vagrantfile'] = re.sub(r'simid = [0-9]+', 'simid = EPOCH', vagrantfile.read())
+    with open(os.path.join(simulation_dir, 'dhcp_mac_map')) as dhcp_mac_map:
+        outputs['dhcp_mac_map'] = dhcp_mac_map.read()
+    mgmt_dir = os.path.join(simulation_dir, 'helper_scripts', 'auto_mgmt_network')
+    if os.path.isdir(mgmt_dir):
+        for name in sorted(os.listdir(mgmt_dir)):
+            with open(os.path.join(mgmt_dir, name)) as mgmt_file:
+                outputs['auto_mgmt_network/' + name] = mgmt_file.read()
+    return outputs
+
+
+def case_dir(example, provider, mode):
+    return os.path.join(golden_dir, example, "%s-%s" % (provider, mode))
+
+
+def read_golden(directory):
+    golden = {}
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            with open(path) as golden_file:
+                golden[os.path.relpath(path, directory).replace(os.sep, '/')] = golden_file.read()
+    return golden
+
+
+def write_golden(directory, outputs):
+    if os.path.isdir(directory): shutil.rmtree(directory)
+    for name in outputs:
+        path = os.path.join(directory, *name.split('/'))
+        if not os.path.isdir(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as golden_file:
+            golden_file.write(outputs[name])
+
+
+def pytest_generate_tests(metafunc):
+    if 'case' in metafunc.fixturenames:
+        metafunc.parametrize('case', cases, ids=["%s-%s-%s" % case for case in cases])
+
+
+def test_golden_output(case, tmpdir):
+    example, provider, mode = case
+    directory = case_dir(example, provider, mode)
+    assert os.path.isdir(directory), "no golden files for %s, run python ./tests/test_golden_output.py --update" % (case,)
+    golden = read_golden(directory)
+    outputs = convert(example, provider, mode, str(tmpdir))
+    assert sorted(outputs) == sorted(golden), "generated files differ from the golden files"
+    for name in sorted(golden):
+        if outputs[name] != golden[name]:
+            diff = difflib.unified_diff(golden[name].splitlines(True), outputs[name].splitlines(True),
+                                        'golden/' + name, 'generated/' + name, n=2)
+            raise AssertionError("%s differs from the golden file:\n%s" % (name, "".join(list(diff)[:60])))
+
+
+def test_every_golden_case_is_tested():
+    # Golden files left behind by a removed example would otherwise go stale
+    known = set(case_dir(*case) for case in cases)
+    for directory in glob.glob(os.path.join(golden_dir, '*', '*')):
+        assert directory in known, "%s has no matching example, remove it" % directory
+
+
+def update():
+    if os.path.isdir(golden_dir): shutil.rmtree(golden_dir)
+    for case in cases:
+        work_dir = tempfile.mkdtemp()
+        try:
+            write_golden(case_dir(*case), convert(*case, work_dir=work_dir))
+        finally:
+            shutil.rmtree(work_dir)
+    print("Golden files for %s cases written to %s" % (len(cases), golden_dir))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ['--update']:
+        print("usage: python %s --update" % sys.argv[0])
+        exit(1)
+    update()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+#
+#    Hypervisor placement tests
+#       places devices on the hypervisors given with --hypervisors and checks
+#       that linked devices share a hypervisor as far as memory and cpus
+#       allow, that devices pinned with tunnel_ip stay put and pull their
+#       neighbours along, that a topology too big for the hypervisors is an
+#       error, and that every device is counted once, also when the topology
+#       falls back to the pydotplus parser.
+#
+#    Run from the root of the repository:
+#       python -m pytest -q ./tests/test_hypervisor_placement.py
+#
+import pytest
+
+import topology_converter
+from conftest import captured_stdout
+
+# The empty subgraph is not in the subset the native parser reads
+fallback_topology = '''graph dc1 {
+ "leaf1" [function="leaf" os="CumulusCommunity/cumulus-vx" memory="512"]
+ "leaf2" [function="leaf" os="CumulusCommunity/cumulus-vx" memory="512"]
+   "leaf1":"swp1" -- "leaf2":"swp1"
+ subgraph cluster0 { }
+}
+'''
+
+
+def test_pydotplus_fallback_counts_devices_once(tmpdir, capsys):
+    pytest.importorskip('pydotplus')
+    topology_file = tmpdir.join('fallback.dot')
+    topology_file.write(fallback_topology)
+    with pytest.raises(topology_converter.DotSyntaxUnsupported):
+        list(topology_converter.read_dot_records(str(topology_file)))
+    # Room for each device once, not twice
+    converter = topology_converter.Converter(str(topology_file), provider='libvirt',
+                                             hypervisors=['127.0.1.1:512', '127.0.1.2:512'])
+    inventory, edges = converter.read_inventory()
+    assert converter.unplaced_devices == ['leaf1', 'leaf2']
+    converter.place_devices(inventory, edges)
+    assert sorted(inventory[device]['tunnel_ip'] for device in inventory) == ['127.0.1.1', '127.0.1.2']
+    assert "ERROR" not in capsys.readouterr().out
+
+
+def clique(prefix, size):
+    names = ['%s%s' % (prefix, number) for number in range(size)]
+    return names, [(a, b) for position, a in enumerate(names) for b in names[position + 1:]]
+
+
+def test_greedy_placement_keeps_cliques_together():
+    left, left_links = clique('a', 4)
+    right, right_links = clique('b', 4)
+    nodes = [(name, 512, 1) for name in left + right]
+    links = left_links + right_links + [('a0', 'b0')]
+    # room for six devices on each, so either clique fits on one hypervisor
+    placement = topology_converter.place_nodes(nodes, links, [('10.0.0.1', 3072, None), ('10.0.0.2', 3072, None)])
+    assert len(set(placement[name] for name in left)) == 1
+    assert len(set(placement[name] for name in right)) == 1
+    assert placement['a0'] != placement['b0']
+
+
+def test_unlimited_hosts_share_the_load():
+    nodes = [('leaf%s' % number, 512, 1) for number in range(8)]
+    placement = topology_converter.place_nodes(nodes, [], [('10.0.0.1', None, None), ('10.0.0.2', None, None)])
+    assert sorted(placement.values()) == ['10.0.0.1'] * 4 + ['10.0.0.2'] * 4
+
+
+def test_node_that_does_not_fit_is_returned():
+    nodes = [('small', 512, 1), ('big', 4096, 1)]
+    assert topology_converter.place_nodes(nodes, [], [('10.0.0.1', 2048, 4), ('10.0.0.2', 2048, 4)]) == 'big'
+    # cpus count as well as memory
+    nodes = [('leaf1', 512, 2), ('leaf2', 512, 2)]
+    assert topology_converter.place_nodes(nodes, [], [('10.0.0.1', None, 2)], {'10.0.0.1': (0, 1)}) == 'leaf1'
+
+
+def test_pinned_neighbours_attract_placed_nodes():
+    nodes = [('leaf1', 512, 1), ('leaf2', 512, 1)]
+    links = [('leaf1', '@10.0.0.2'), ('leaf2', 'leaf1')]
+    placement = topology_converter.place_nodes(nodes, links, [('10.0.0.1', 4096, None), ('10.0.0.2', 4096, None)],
+                                               {'10.0.0.2': (512, 1)})
+    assert placement == {'leaf1': '10.0.0.2', 'leaf2': '10.0.0.2'}
+
+
+pinned_topology = '''graph dc1 {
+ "spine1" [function="spine" os="CumulusCommunity/cumulus-vx" memory="512" tunnel_ip="127.0.1.2"]
+ "leaf1" [function="leaf" os="CumulusCommunity/cumulus-vx" memory="512"]
+ "leaf2" [function="leaf" os="CumulusCommunity/cumulus-vx" memory="512"]
+   "leaf1":"swp1" -- "spine1":"swp1"
+   "leaf2":"swp1" -- "spine1":"swp2"
+}
+'''
+
+
+def place(tmpdir, hypervisors):
+    topology_file = tmpdir.join('pinned.dot')
+    topology_file.write(pinned_topology)
+    converter = topology_converter.Converter(str(topology_file), provider='libvirt', hypervisors=hypervisors)
+    inventory, edges = converter.read_inventory()
+    with captured_stdout() as output:
+        converter.place_devices(inventory, edges)
+    return inventory, output.getvalue()
+
+
+def test_pinned_hypervisor_is_kept(tmpdir):
+    inventory, output = place(tmpdir, ['127.0.1.1:2048', '127.0.1.2:2048'])
+    assert dict((device, inventory[device]['tunnel_ip']) for device in inventory) == \
+        {'spine1': '127.0.1.2', 'leaf1': '127.0.1.2', 'leaf2': '127.0.1.2'}
+    assert '0 of 2 links cross hypervisors' in output
+
+
+def test_pinned_hypervisor_counts_towards_capacity(tmpdir):
+    inventory, output = place(tmpdir, ['127.0.1.1:512', '127.0.1.2:1024'])
+    assert inventory['spine1']['tunnel_ip'] == '127.0.1.2'
+    assert sorted(inventory[device]['tunnel_ip'] for device in ['leaf1', 'leaf2']) == ['127.0.1.1', '127.0.1.2']
+
+
+def test_capacity_error(tmpdir):
+    with pytest.raises(topology_converter.ConversionError) as error:
+        place(tmpdir, ['127.0.1.1:512', '127.0.1.2:512'])
+    assert 'needs 1536 MB of memory' in str(error.value)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+#
+#    Inventory cache tests
+#       converts an example twice in the same directory and checks that the
+#       second run takes the inventory from .topology_converter_cache without
+#       reading the topology, yet prints and writes exactly the same thing,
+#       and that changed inputs (config files included), --no-cache and a
+#       broken or planted cache all fall back to parsing the topology.
+#
+#    Run from the root of the repository:
+#       python -m pytest -q ./tests/test_inventory_cache.py
+#
+import os
+
+import pytest
+
+import topology_converter
+from conftest import captured_stdout
+
+
+def convert(topology_file='examples/2switch_auto_mgmt.dot', **options):
+    # Returns (stdout, Vagrantfile, dhcp_mac_map) of one run
+    with captured_stdout() as output:
+        topology_converter.Converter(topology_file, provider='libvirt', create_mgmt_network=True, **options).run()
+    with open('Vagrantfile') as vagrantfile, open('dhcp_mac_map') as dhcp_mac_map:
+        return output.getvalue(), vagrantfile.read(), dhcp_mac_map.read()
+
+
+def refuse_parsing(monkeypatch):
+    def read_dot_records(topology_file):
+        raise AssertionError("the topology was parsed")
+    monkeypatch.setattr(topology_converter, 'read_dot_records', read_dot_records)
+
+
+def test_cache_hit_matches_full_run(simulation, monkeypatch):
+    first = convert(state_file='state.json')
+    second = convert(state_file='state.json')
+    refuse_parsing(monkeypatch)
+    assert convert(state_file='state.json') == first == second
+
+
+def test_changed_topology_is_parsed(simulation):
+    convert()
+    with open('examples/2switch_auto_mgmt.dot') as dot:
+        topology = dot.read()
+    with open('examples/2switch_auto_mgmt.dot', 'w') as dot:
+        dot.write(topology.replace('"leaf1":"swp3" -- "leaf2":"swp3"', '"leaf1":"swp3" -- "leaf2":"swp49"'))
+    output, vagrantfile, dhcp_mac_map = convert()
+    assert "swp49" in vagrantfile
+
+
+def test_changed_options_are_parsed(simulation, monkeypatch):
+    convert()
+    refuse_parsing(monkeypatch)
+    with pytest.raises(AssertionError):
+        convert(start_port=9000)
+
+
+def test_no_cache(simulation, monkeypatch):
+    convert(inventory_cache=False)
+    assert not os.path.exists(topology_converter.inventory_cache_file)
+    convert()
+    refuse_parsing(monkeypatch)
+    with pytest.raises(AssertionError):
+        convert(inventory_cache=False)
+
+
+def test_broken_cache_is_ignored(simulation):
+    first = convert()
+    with open(topology_converter.inventory_cache_file, 'wb') as cache:
+        cache.write(b'not a cache')
+    assert convert() == first
+
+
+def test_planted_pickle_is_not_loaded(simulation):
+    first = convert()
+    # Unpickling this would create the file
+    with open(topology_converter.inventory_cache_file, 'wb') as cache:
+        cache.write(b"cos\nsystem\n(S'touch planted'\ntR.")
+    assert convert() == first
+    assert not os.path.exists('planted')
+
+
+def test_config_file_is_part_of_the_key(simulation, monkeypatch):
+    with open('examples/2switch_auto_mgmt.dot') as dot:
+        topology = dot.read()
+    with open('examples/2switch_auto_mgmt.dot', 'w') as dot:
+        dot.write(topology.replace('"leaf1" [', '"leaf1" [config="./leaf1.sh" ', 1))
+    output, vagrantfile, dhcp_mac_map = convert()
+    assert "Config file for device does not exist" in output
+    with open('leaf1.sh', 'w') as config:
+        config.write("#!/bin/bash\n")
+    refuse_parsing(monkeypatch)
+    with pytest.raises(AssertionError):
+        convert()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+#
+#    Library use tests
+#       drives Converter directly, the way other Python code imports it, and
+#       checks that a topology which cannot be converted raises
+#       ConversionError instead of exiting the process, and that "-dd"
+#       returns after printing the datastructures without rendering.
+#
+#    Run from the root of the repository:
+#       python -m pytest -q ./tests/test_library.py
+#
+import sys
+
+import pytest
+
+import topology_converter
+from conftest import captured_stdout
+
+
+def test_conversion_error_is_raised(simulation):
+    simulation.join('bad.dot').write('graph dc1 {\n "leaf1" [function="leaf"]\n   "leaf1":"swp1" -- "leaf9":"swp1"\n}\n')
+    stdin = sys.stdin
+    with captured_stdout() as output:
+        with pytest.raises(topology_converter.ConversionError) as error:
+            topology_converter.Converter('bad.dot').run()
+    assert str(error.value) == '### ERROR: device leaf9 is referred to in list of edges/links but not defined as a node.'
+    assert 'device leaf9 is referred to' in output.getvalue()
+    assert sys.stdin is stdin and not getattr(sys.stdin, 'closed', False)
+
+
+def test_option_errors_are_raised(simulation):
+    with captured_stdout():
+        with pytest.raises(topology_converter.ConversionError):
+            topology_converter.Converter('examples/2switch.dot', templates=[['missing.j2', 'out']])
+        with pytest.raises(topology_converter.ConversionError):
+            topology_converter.Converter('examples/2switch.dot', provider='virtualbox', shard=True)
+
+
+def test_display_datastructures_returns(simulation):
+    with captured_stdout() as output:
+        topology_converter.Converter('examples/2switch.dot', display_datastructures=True).run()
+    assert 'DATASTRUCTURES SENT TO TEMPLATE' in output.getvalue()
+    assert not simulation.join('Vagrantfile').check()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+#
+#    MAC allocation tests
+#       checks the interval bookkeeping of RangeSet and that MacAllocator
+#       hands out MACs counting up from start_mac, one at a time or in
+#       blocks, without ever returning one that was reserved or fetched.
+#
+#    Run from the root of the repository:
+#       python -m pytest -q ./tests/test_mac_allocation.py
+#
+import topology_converter
+
+
+def ranges(range_set):
+    return list(zip(range_set.starts, range_set.ends))
+
+
+def test_range_set_merges_neighbours():
+    used = topology_converter.RangeSet()
+    assert used.add(5)
+    assert used.add(7)
+    assert not used.add(5)
+    assert ranges(used) == [(5, 6), (7, 8)]
+    used.add(6)
+    assert ranges(used) == [(5, 8)]
+    used.add_range(8, 10)
+    used.add_range(3, 5)
+    used.add_range(20, 30)
+    assert ranges(used) == [(3, 10), (20, 30)]
+    assert [value in used for value in [2, 3, 9, 10, 19, 20, 29, 30]] == \
+        [False, True, True, False, False, True, True, False]
+
+
+def test_range_set_lookups():
+    used = topology_converter.RangeSet()
+    assert used.next_free(4) == 4
+    assert used.next_used(4) is None
+    used.add_range(3, 10)
+    used.add_range(20, 30)
+    assert [used.next_free(value) for value in [0, 3, 9, 10, 25]] == [0, 10, 10, 10, 30]
+    assert [used.prev_free(value) for value in [2, 3, 9, 10, 25]] == [2, 2, 2, 10, 19]
+    assert [used.next_used(value) for value in [0, 3, 12, 29, 30]] == [3, 3, 20, 29, None]
+
+
+def test_mac_allocator_skips_reserved():
+    allocator = topology_converter.MacAllocator('443839000000')
+    assert allocator.reserve('44:38:39:00:00:02')
+    assert allocator.reserve('"443839000003"')
+    assert not allocator.reserve('44:38:39:00:00:02')
+    assert not allocator.reserve('not a mac')
+    assert [allocator.fetch() for count in range(3)] == [0x443839000001, 0x443839000004, 0x443839000005]
+
+
+def test_mac_allocator_fetch_block():
+    allocator = topology_converter.MacAllocator('443839000000')
+    for mac in ['443839000003', '443839000004', '443839000008']:
+        allocator.reserve(mac)
+    assert allocator.fetch_block(0) == []
+    block = allocator.fetch_block(6)
+    assert block == [0x443839000001, 0x443839000002, 0x443839000005, 0x443839000006,
+                     0x443839000007, 0x443839000009]
+    # one run past the last reservation, continuing after the block
+    assert allocator.fetch_block(3) == [0x44383900000a, 0x44383900000b, 0x44383900000c]
+    assert allocator.fetch() == 0x44383900000d
+    assert ranges(allocator.used) == [(0x443839000001, 0x44383900000e)]
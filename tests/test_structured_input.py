@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#
+#    Structured input tests
+#       writes every examples/*.dot as a JSON document, a YAML document and a
+#       CSV edge list with a node table, converts them for both providers and
+#       compares the output with the golden files of the .dot conversion.
+#       Only the name of the topology file, which the generated files quote,
+#       is expected to differ.
+#
+#    Run from the root of the repository:
+#       python -m pytest -q ./tests/test_structured_input.py
+#
+import os
+import csv
+import sys
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import test_golden_output
+from test_golden_output import topology_converter, examples, providers, convert, case_dir, read_golden
+
+formats = ['json', 'yaml', 'csv']
+cases = [(example, provider, format) for example in examples for provider in providers for format in formats]
+
+
+def unquote(value):
+    if len(value) > 1 and value[0] == '"' and value[-1] == '"': return value[1:-1]
+    return value
+
+
+def read_example(example):
+    # The example as ({node: attributes}, [link attributes]) in file order
+    nodes = {}
+    links = []
+    topology_file = os.path.join(test_golden_output.repo_dir, 'examples', example + '.dot')
+    for record in topology_converter.read_dot_records(topology_file):
+        if record[0] == 'node':
+            nodes[unquote(record[1])] = dict((key, unquote(value)) for key, value in record[2].items())
+            continue
+        link = {}
+        for side, end in [('left', record[1]), ('right', record[2])]:
+            device, interface = end.split(':')
+            link[side + '_device'] = unquote(device)
+            link[side + '_interface'] = unquote(interface)
+        link.update((key, unquote(value)) for key, value in record[3].items())
+        links.append(link)
+    return nodes, links
+
+
+def write_structured(example, format, directory):
+    # Writes the example in the given format and returns the file name
+    nodes, links = read_example(example)
+    topology_file = os.path.join(directory, "%s.%s" % (example, format))
+    if format == 'json':
+        with open(topology_file, 'w') as json_file:
+            json.dump({'nodes': nodes, 'links': links}, json_file, indent=2)
+    elif format == 'yaml':
+        yaml = pytest.importorskip('yaml')
+        # nodes as a list this time, to cover both spellings
+        document = {'nodes': [dict(attributes, name=name) for name, attributes in nodes.items()], 'links': links}
+        with open(topology_file, 'w') as yaml_file:
+            yaml.safe_dump(document, yaml_file, default_flow_style=False)
+    else:
+        write_csv(topology_file, topology_converter.link_end_columns, links)
+        write_csv(topology_converter.default_node_table(topology_file), ('name',),
+                  [dict(attributes, name=name) for name, attributes in nodes.items()])
+    return topology_file
+
+
+def write_csv(path, first_columns, rows):
+    columns = list(first_columns)
+    for row in rows:
+        columns.extend(sorted(key for key in row if key not in columns))
+    with open(path, 'w') as csv_file:
+        writer = csv.DictWriter(csv_file, columns, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def pytest_generate_tests(metafunc):
+    if 'case' in metafunc.fixturenames:
+        metafunc.parametrize('case', cases, ids=["%s-%s-%s" % case for case in cases])
+
+
+def test_structured_input_matches_dot(case, tmpdir):
+    example, provider, format = case
+    topology_file = write_structured(example, format, str(tmpdir))
+    outputs = convert(example, provider, 'default', str(tmpdir.mkdir('work')), topology_file=topology_file)
+    golden = read_golden(case_dir(example, provider, 'default'))
+    dot_file = "examples/%s.dot" % example
+    assert sorted(outputs) == sorted(golden)
+    for name in sorted(golden):
+        assert outputs[name].replace(topology_file, dot_file) == golden[name], "%s differs from the golden file" % name
+
+
+def convert_error(topology_file, **options):
+    with pytest.raises(topology_converter.ConversionError):
+        topology_converter.Converter(topology_file, **options).lint()
+
+
+def test_csv_without_node_table(tmpdir, capsys):
+    topology_file = write_structured('2switch', 'csv', str(tmpdir))
+    os.remove(topology_converter.default_node_table(topology_file))
+    convert_error(topology_file)
+    assert "give it with --nodes" in capsys.readouterr().out
+
+
+def test_csv_node_table_option(tmpdir):
+    topology_file = write_structured('2switch', 'csv', str(tmpdir))
+    node_table = str(tmpdir.join('devices.csv'))
+    os.rename(topology_converter.default_node_table(topology_file), node_table)
+    inventory, edges = topology_converter.Converter(topology_file, node_table=node_table).lint()
+    assert sorted(inventory) == ['leaf1', 'leaf2']
+
+
+def test_link_without_interface(tmpdir, capsys):
+    topology_file = str(tmpdir.join('broken.json'))
+    with open(topology_file, 'w') as json_file:
+        json.dump({'nodes': {'leaf1': {'function': 'leaf'}, 'leaf2': {'function': 'leaf'}},
+                   'links': [{'left_device': 'leaf1', 'left_interface': 'swp1', 'right_device': 'leaf2'}]}, json_file)
+    convert_error(topology_file)
+    assert "link 1: \"right_interface\" is missing" in capsys.readouterr().out
+
+
+def test_attribute_types(tmpdir):
+    topology_file = str(tmpdir.join('typed.json'))
+    with open(topology_file, 'w') as json_file:
+        json.dump({'nodes': {'leaf1': {'function': 'leaf', 'memory': 768, 'pxehost': False},
+                             'leaf2': {'function': 'leaf', 'memory': None}},
+                   'links': [{'left_device': 'leaf1', 'left_interface': 'swp1',
+                              'right_device': 'leaf2', 'right_interface': 'swp1', 'left_mtu': 9000}]}, json_file)
+    records = list(topology_converter.read_structured_records(topology_file))
+    assert records[0] == ('node', 'leaf1', {'function': 'leaf', 'memory': '768', 'pxehost': 'False'})
+    assert records[1] == ('node', 'leaf2', {'function': 'leaf'})
+    assert records[2] == ('edge', 'leaf1:swp1', 'leaf2:swp1', {'left_mtu': '9000'})
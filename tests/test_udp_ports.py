@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#
+#    UDP port allocation tests
+#       converts a libvirt topology with more links than port_gap and checks
+#       that the links past port_gap get ports of their own, that no port is
+#       used twice on a tunnel_ip, that ports set on a link are kept and
+#       never handed to another link, and that UdpPortAllocator keeps hosts
+#       apart and runs out cleanly.
+#
+#    Run from the root of the repository:
+#       python -m pytest -q ./tests/test_udp_ports.py
+#
+import topology_converter
+from conftest import captured_stdout
+
+
+def write_topology(link_count, tunnel_ip=None, attributes=None):
+    lines = ['graph dc1 {']
+    for leaf in ['leaf1', 'leaf2']:
+        tunnel = '' if tunnel_ip is None else ' tunnel_ip="%s"' % tunnel_ip[leaf]
+        lines.append(' "%s" [function="leaf" os="CumulusCommunity/cumulus-vx"%s]' % (leaf, tunnel))
+    for number in range(1, link_count + 1):
+        link = '   "leaf1":"swp%s" -- "leaf2":"swp%s"' % (number, number)
+        if attributes and number in attributes:
+            link += ' [%s]' % attributes[number]
+        lines.append(link)
+    with open('udp.dot', 'w') as dot:
+        dot.write('\n'.join(lines) + '\n}\n')
+
+
+def convert(**options):
+    with captured_stdout() as output:
+        converter = topology_converter.Converter('udp.dot', provider='libvirt', inventory_cache=False, **options)
+        converter.run()
+    return converter, output.getvalue()
+
+
+def host_ports(converter, host_of):
+    # [(tunnel_ip, port)] of every link end and unconnected port
+    ports = []
+    for (left, left_interface, right, right_interface, net_number) in converter.udp_links:
+        key = topology_converter.link_key(left, left_interface, right, right_interface)
+        ports.append((host_of[left], converter.link_ports[key][0]))
+        ports.append((host_of[right], converter.link_ports[key][1]))
+    for key, port in converter.unconnected_ports.items():
+        ports.append((host_of[key.split(':')[0]], port))
+    return ports
+
+
+def test_links_beyond_port_gap_get_unique_ports(simulation):
+    write_topology(12)
+    converter, output = convert(port_gap=5)
+    assert '7 beyond the start_port/port_gap layout' in output
+    ports = host_ports(converter, {'leaf1': '127.0.0.1', 'leaf2': '127.0.0.1'})
+    assert len(ports) == 2 * 12 + 2
+    assert len(set(ports)) == len(ports)
+    # the first port_gap links keep the classic layout
+    assert converter.link_ports['leaf1:swp1 -- leaf2:swp1'] == [8001, 8006]
+    assert all(port > 8000 for host, port in ports)
+
+
+def test_port_gap_on_separate_tunnel_ips(simulation):
+    write_topology(12, tunnel_ip={'leaf1': '10.0.0.1', 'leaf2': '10.0.0.2'})
+    converter, output = convert(port_gap=5)
+    ports = host_ports(converter, {'leaf1': '10.0.0.1', 'leaf2': '10.0.0.2'})
+    assert len(set(ports)) == len(ports) == 2 * 12 + 2
+
+
+def test_ports_set_on_the_link_are_kept(simulation):
+    write_topology(3, attributes={1: 'left_local_port="1234"',
+                                  2: 'right_local_port="9500" left_remote_port="9500"'})
+    converter, output = convert(port_gap=5)
+    # the far end of the tunnel sends to the port the link sets
+    assert converter.link_ports['leaf1:swp1 -- leaf2:swp1'] == [1234, 8006]
+    assert converter.link_ports['leaf1:swp2 -- leaf2:swp2'] == [8002, 9500]
+    with open('Vagrantfile') as vagrantfile:
+        rendered = vagrantfile.read()
+    assert ":libvirt__tunnel_local_port => '1234'" in rendered
+    assert ":libvirt__tunnel_port => '1234'" in rendered
+    assert ":libvirt__tunnel_local_port => '9500'" in rendered
+
+
+def test_ports_set_on_the_link_are_reserved(simulation):
+    # link 1 holds the classic ports of links 2 and 3
+    write_topology(3, attributes={1: 'left_local_port="8002" right_remote_port="8002" '
+                                     'right_local_port="8008" left_remote_port="8008"'})
+    converter, output = convert(port_gap=5)
+    assert converter.link_ports['leaf1:swp1 -- leaf2:swp1'] == [8002, 8008]
+    ports = host_ports(converter, {'leaf1': '127.0.0.1', 'leaf2': '127.0.0.1'})
+    assert len(set(ports)) == len(ports) == 2 * 3 + 2
+
+
+def test_allocator_runs_out_per_host():
+    allocator = topology_converter.UdpPortAllocator(8001, 8003)
+    assert allocator.capacity() == 3
+    assert allocator.reserve('a', 8002)
+    assert not allocator.reserve('a', 8002)
+    assert not allocator.reserve('a', 8004)
+    assert [allocator.allocate('a'), allocator.allocate('a'), allocator.allocate('a')] == [8001, 8003, None]
+    assert allocator.allocate('b') == 8001
+    assert allocator.allocate_top('b') == 8003
+    assert allocator.allocate_top('b') == 8002
+    assert allocator.allocate_top('b') is None
+    assert allocator.utilization() == [('a', 3, 3), ('b', 3, 3)]
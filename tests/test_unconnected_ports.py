@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+#    Unconnected port tests
+#       converts a switch with "ports=" and no management network and checks
+#       that the ports it adds and its dummy eth0 take no net_number, and with
+#       libvirt one UDP port each from the top of the range, while the real
+#       links keep the start_port/port_gap layout, and that with virtualbox
+#       templates which only know link.network still give each of them an
+#       internal network of its own.
+#
+#    Run from the root of the repository:
+#       python -m pytest -q ./tests/test_unconnected_ports.py
+#
+import pytest
+
+import topology_converter
+from conftest import captured_stdout
+
+topology = '''graph dc1 {
+ "leaf1" [function="leaf" os="CumulusCommunity/cumulus-vx" ports="32"]
+ "leaf2" [function="leaf" os="CumulusCommunity/cumulus-vx"]
+   "leaf1":"swp1" -- "leaf2":"swp1"
+   "leaf1":"swp2" -- "leaf2":"swp2"
+}
+'''
+
+
+@pytest.fixture
+def ports_simulation(simulation):
+    simulation.join('ports.dot').write(topology)
+    return simulation
+
+
+def convert(provider, **options):
+    # Returns (converter, Vagrantfile) of one run
+    with captured_stdout():
+        converter = topology_converter.Converter('ports.dot', provider=provider, inventory_cache=False, **options)
+        converter.run()
+    with open('Vagrantfile') as vagrantfile:
+        return converter, vagrantfile.read()
+
+
+def test_libvirt_unconnected_ports_stay_off_the_link_layout(ports_simulation):
+    converter, vagrantfile = convert('libvirt', port_gap=2, state_file='state.json')
+    assert [link[:4] for link in converter.udp_links] == [('leaf1', 'swp1', 'leaf2', 'swp1'),
+                                                          ('leaf1', 'swp2', 'leaf2', 'swp2')]
+    assert sorted(converter.link_ports.values()) == [[8001, 8003], [8002, 8004]]
+    assert sorted(converter.net_numbers.assigned) == ['leaf1:swp1 -- leaf2:swp1', 'leaf1:swp2 -- leaf2:swp2']
+    # swp3-swp32 on leaf1, eth0 on both
+    assert sorted(converter.unconnected_ports.values()) == list(range(65535 - 31, 65536))
+    assert vagrantfile.count(":libvirt__tunnel_port => '8000'") == 32
+    assert vagrantfile.count(":libvirt__tunnel_type => 'udp'") == 36
+
+
+def test_libvirt_unconnected_ports_are_saved(ports_simulation):
+    first, vagrantfile = convert('libvirt', state_file='state.json')
+    with open('ports.dot') as dot:
+        topology = dot.read()
+    with open('ports.dot', 'w') as dot:
+        # a new device ahead of leaf1 takes an eth0 of its own
+        dot.write(topology.replace(' "leaf1" [', ' "leaf0" [function="leaf" os="CumulusCommunity/cumulus-vx"]\n "leaf1" [', 1))
+    second, vagrantfile = convert('libvirt', state_file='state.json')
+    for key in first.unconnected_ports:
+        assert second.unconnected_ports[key] == first.unconnected_ports[key]
+    assert second.unconnected_ports['leaf0:eth0'] not in first.unconnected_ports.values()
+
+
+def test_virtualbox_unconnected_ports_use_no_net_numbers(ports_simulation):
+    converter, vagrantfile = convert('virtualbox', state_file='state.json')
+    assert sorted(converter.net_numbers.assigned.values()) == [1, 2]
+    assert 'virtualbox__intnet: "#{simid}_leaf1_swp32"' in vagrantfile
+    assert 'virtualbox__intnet: "#{simid}_leaf2_eth0"' in vagrantfile
+    assert '#{simid}_net3' not in vagrantfile
+
+
+def test_virtualbox_unconnected_ports_have_a_network_of_their_own(ports_simulation):
+    # a user template written before unconnected ports were told apart
+    ports_simulation.join('networks.j2').write(
+        '{% for device in devices %}{% for link in device.interfaces %}'
+        '{{ device.hostname }}:{{ link.local_interface }} {{ link.network }}\n'
+        '{% endfor %}{% endfor %}')
+    convert('virtualbox', templates=[['networks.j2', 'networks']])
+    with open('networks') as output:
+        networks = dict(line.split() for line in output)
+    assert networks['leaf1:swp32'] == 'leaf1_swp32'
+    assert networks['leaf2:eth0'] == 'leaf2_eth0'
+    assert networks['leaf1:swp1'] == networks['leaf2:swp1'] == 'net1'
+    unconnected = [network for network in networks.values() if not network.startswith('net')]
+    assert len(set(unconnected)) == len(unconnected) == 32
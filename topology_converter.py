@@ -15,16 +15,34 @@ version = "4.6.5"
 import os
 import re
 import sys
+import mmap
 import time
-import pprint
-import jinja2
+import json
+import locale
+import collections
+import bisect
+import hashlib
+import filecmp
+import shutil
 import argparse
-import importlib
-import pydotplus
-import ipaddress
-from operator import itemgetter
+# jinja2, pydotplus, ipaddress, pprint and multiprocessing are imported by the
+# functions that need them, so --version and --lint-only start quickly.
 
-pp = pprint.PrettyPrinter(depth=6)
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    unicode
+except NameError:
+    # Python 3, the ipaddress module takes str
+    unicode = str
+
+try:
+    intern
+except NameError:
+    from sys import intern
 
 class styles:
     # Use these for text colors
@@ -37,80 +55,98 @@ class styles:
     UNDERLINE = '\033[4m'
     ENDC = '\033[0m'
 
-parser = argparse.ArgumentParser(description='Topology Converter -- Convert topology.dot files into Vagrantfiles')
-parser.add_argument('topology_file',
-                   help='provide a topology file as input')
-parser.add_argument('-v','--verbose', action='store_true',
-                   help='enables verbose logging mode')
-parser.add_argument('-p','--provider', choices=["libvirt","virtualbox"],
-                   help='specifies the provider to be used in the Vagrantfile, script supports "virtualbox" or "libvirt", default is virtualbox.')
-parser.add_argument('-a','--ansible-hostfile', action='store_true',
-                   help='When specified, ansible hostfile will be generated from a dummy playbook run.')
-parser.add_argument('-c','--create-mgmt-network', action='store_true',
-                   help='When specified, a mgmt switch and server will be created. A /24 is assumed for the mgmt network. mgmt_ip=X.X.X.X will be read from each device to create a Static DHCP mapping for the oob-mgmt-server.')
-parser.add_argument('-cco','--create-mgmt-configs-only', action='store_true',
-                   help='Calling this option does NOT regenerate the Vagrantfile but it DOES regenerate the configuration files that come packaged with the mgmt-server in the "-c" option. This option is typically used after the "-c" has been called to generate a Vagrantfile with an oob-mgmt-server and oob-mgmt-switch to modify the configuraiton files placed on the oob-mgmt-server device. Useful when you do not want to regenerate the vagrantfile but you do want to make changes to the OOB-mgmt-server configuration templates.')
-parser.add_argument('-cmd','--create-mgmt-device', action='store_true',
-                   help='Calling this option creates the mgmt device and runs the auto_mgmt_network template engine to load configurations on to the mgmt device but it does not create the OOB-MGMT-SWITCH or associated connections. Useful when you are manually specifying the construction of the management network but still want to have the OOB-mgmt-server created automatically.')
-parser.add_argument('-t','--template', action='append', nargs=2,
-                   help='Specify an additional jinja2 template and a destination for that file to be rendered to.')
-parser.add_argument('-s','--start-port', type=int,
-                   help='FOR LIBVIRT PROVIDER: this option overrides the default starting-port 8000 with a new value. Use ports over 1024 to avoid permissions issues. If using this option with the virtualbox provider it will be ignored.')
-parser.add_argument('-g','--port-gap', type=int,
-                   help='FOR LIBVIRT PROVIDER: this option overrides the default port-gap of 1000 with a new value. This number is added to the start-port value to determine the port to be used by the remote-side. Port-gap also defines the max number of links that can exist in the topology. EX. If start-port is 8000 and port-gap is 1000 the first link will use ports 8001 and 9001 for the construction of the UDP tunnel. If using this option with the virtualbox provider it will be ignored.')
-parser.add_argument('-dd','--display-datastructures', action='store_true',
-                   help='When specified, the datastructures which are passed to the template are displayed to screen. Note: Using this option does not write a Vagrantfile and supercedes other options.')
-parser.add_argument('--synced-folder', action='store_true',
-                   help='Using this option enables the default Vagrant synced folder which we disable by default. See: https://www.vagrantup.com/docs/synced-folders/basic_usage.html')
-parser.add_argument('--version', action='version', version="Topology Converter version is v%s" % version,
-                   help='Using this option displays the version of Topology Converter')
-args = parser.parse_args()
-
-#Parse Arguments
+class ConversionError(Exception):
+    # Raised when a topology or an option cannot be converted. The message has
+    # already been printed by conversion_error() when this is raised, so the
+    # caller only decides what happens next: the command line exits with
+    # status 1 while --batch and --lint-only report the file and carry on.
+    pass
+
+def conversion_error(message):
+    # Prints message in the error colors and returns the ConversionError to
+    # raise for it
+    print(styles.FAIL + styles.BOLD + message + styles.ENDC)
+    return ConversionError(message.strip())
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Topology Converter -- Convert topology.dot files into Vagrantfiles')
+    parser.add_argument('topology_file', nargs='?',
+                       help='provide a topology file as input, a .dot file or a .json, .yaml/.yml or .csv topology')
+    parser.add_argument('more_topology_files', nargs='*', metavar='topology_file',
+                       help='further topology files to check, only with --lint-only')
+    parser.add_argument('-v','--verbose', action='store_true',
+                       help='enables verbose logging mode')
+    parser.add_argument('-p','--provider', choices=["libvirt","virtualbox"],
+                       help='specifies the provider to be used in the Vagrantfile, script supports "virtualbox" or "libvirt", default is virtualbox.')
+    parser.add_argument('-a','--ansible-hostfile', action='store_true',
+                       help='When specified, ansible hostfile will be generated from a dummy playbook run.')
+    parser.add_argument('-c','--create-mgmt-network', action='store_true',
+                       help='When specified, a mgmt switch and server will be created. A /24 is assumed for the mgmt network. mgmt_ip=X.X.X.X will be read from each device to create a Static DHCP mapping for the oob-mgmt-server.')
+    parser.add_argument('-cco','--create-mgmt-configs-only', action='store_true',
+                       help='Calling this option does NOT regenerate the Vagrantfile but it DOES regenerate the configuration files that come packaged with the mgmt-server in the "-c" option. This option is typically used after the "-c" has been called to generate a Vagrantfile with an oob-mgmt-server and oob-mgmt-switch to modify the configuraiton files placed on the oob-mgmt-server device. Useful when you do not want to regenerate the vagrantfile but you do want to make changes to the OOB-mgmt-server configuration templates.')
+    parser.add_argument('-cmd','--create-mgmt-device', action='store_true',
+                       help='Calling this option creates the mgmt device and runs the auto_mgmt_network template engine to load configurations on to the mgmt device but it does not create the OOB-MGMT-SWITCH or associated connections. Useful when you are manually specifying the construction of the management network but still want to have the OOB-mgmt-server created automatically.')
+    parser.add_argument('-t','--template', action='append', nargs=2,
+                       help='Specify an additional jinja2 template and a destination for that file to be rendered to.')
+    parser.add_argument('-s','--start-port', type=int,
+                       help='FOR LIBVIRT PROVIDER: this option overrides the default starting-port 8000 with a new value. Use ports over 1024 to avoid permissions issues. If using this option with the virtualbox provider it will be ignored.')
+    parser.add_argument('-g','--port-gap', type=int,
+                       help='FOR LIBVIRT PROVIDER: this option overrides the default port-gap of 1000 with a new value. This number is added to the start-port value to determine the port to be used by the remote-side. EX. If start-port is 8000 and port-gap is 1000 the first link will use ports 8001 and 9001 for the construction of the UDP tunnel. Links past the port-gap are not an error, they are given the lowest free ports on each hypervisor (tunnel_ip) instead. If using this option with the virtualbox provider it will be ignored.')
+    parser.add_argument('-dd','--display-datastructures', action='store_true',
+                       help='When specified, the datastructures which are passed to the template are displayed to screen. Note: Using this option does not write a Vagrantfile and supercedes other options.')
+    parser.add_argument('--synced-folder', action='store_true',
+                       help='Using this option enables the default Vagrant synced folder which we disable by default. See: https://www.vagrantup.com/docs/synced-folders/basic_usage.html')
+    parser.add_argument('--no-template-cache', action='store_true',
+                       help='Compile every template from scratch instead of reusing compiled templates cached on disk by previous runs.')
+    parser.add_argument('--render-jobs', type=int,
+                       help='Render the Vagrantfile, the auto_mgmt_network templates and any -t templates concurrently on this many threads, default is 1. Use -v to see how long each template took to render.')
+    parser.add_argument('--state-file',
+                       help='Keep the net_number, libvirt UDP ports and MAC address of every link, and the oob-mgmt-switch port and mgmt_ip of every device, in this JSON file. Allocations found in the file are reused on the next run so editing the topology only changes the links and devices that were added or removed.')
+    parser.add_argument('--diff',
+                       help='Compare the devices of this run with a state file written by an earlier run with --state-file and list the VMs that were added, removed or whose definition changed and need a reload. The same file can be given to --state-file to keep it up to date.')
+    parser.add_argument('--diff-json',
+                       help='Also write the --diff report to this file as JSON.')
+    parser.add_argument('--shard', action='store_true',
+                       help='FOR LIBVIRT PROVIDER: write one Vagrantfile per hypervisor (tunnel_ip) into ./hypervisor_<tunnel_ip>/ instead of a single Vagrantfile, together with a copy of helper_scripts. Links between hypervisors become UDP tunnels between them so every shard can be brought up on its own host in parallel.')
+    parser.add_argument('--hypervisors',
+                       help='FOR LIBVIRT PROVIDER: comma separated list of hypervisors as IP[:MEMORY_MB[:CPUS]]. Devices without a tunnel_ip are placed on these hypervisors within their memory and cpu limits, keeping linked devices on the same hypervisor where possible. Hypervisors without limits share the load evenly.')
+    parser.add_argument('--data-driven', action='store_true',
+                       help='Write the devices and links to Vagrantfile.json and a small fixed Vagrantfile that reads it and loops over them, instead of a Vagrantfile with a block for every device and interface. The output grows with the size of the topology data only, which keeps large simulations quick to generate and quick for Vagrant to load.')
+    parser.add_argument('--no-cache', action='store_true',
+                       help='Parse the topology from scratch instead of reusing the inventory cached by the previous run, and do not update the cache. The cache is only used when the topology, the options that affect parsing and topology_converter.py itself are unchanged.')
+    parser.add_argument('--force', action='store_true',
+                       help='Rewrite every generated file even when its content has not changed. By default files whose content is unchanged are left alone so their modification times are preserved.')
+    parser.add_argument('-o','--output-dir',
+                       help='Write the Vagrantfile and the other generated files into this directory instead of the current directory. With --batch each topology is written to a subdirectory named after the topology file, default is ./batch_output.')
+    parser.add_argument('-b','--batch',
+                       help='Convert every .dot file in the given directory, or every topology listed in the given file. Each line of a list file holds a topology file, optionally followed by an output directory and a provider. All other options apply to every topology in the batch.')
+    parser.add_argument('-j','--jobs', type=int,
+                       help='Number of worker processes used by --batch, default is the number of CPUs.')
+    parser.add_argument('--nodes',
+                       help='Node table for a .csv topology, default is the topology file name with .nodes.csv in place of .csv')
+    parser.add_argument('--timings', action='store_true',
+                       help='Print the wall time of each phase of the conversion along with counters such as nodes, edges, MACs allocated and bytes written.')
+    parser.add_argument('--timings-memory', action='store_true',
+                       help='Also trace the peak memory of each phase with tracemalloc (implies --timings). Tracing slows the conversion down a lot, so the times of such a run are only comparable with other runs using --timings-memory.')
+    parser.add_argument('--timings-json',
+                       help='Also write the --timings report to this file as JSON (implies --timings).')
+    parser.add_argument('--profile',
+                       help='Profile the whole run with cProfile and write the stats to this file, for use with pstats or snakeviz.')
+    parser.add_argument('--lint-only', action='store_true',
+                       help='Only check the given topology files for syntax errors and invalid devices, nothing is generated. Exits non-zero if any topology has errors.')
+    parser.add_argument('--version', action='version', version="Topology Converter version is v%s" % version,
+                       help='Using this option displays the version of Topology Converter')
+    return parser
+
 network_functions=['oob-switch','internet','exit','superspine','spine','leaf','tor']
-function_group={}
-provider="virtualbox"
-generate_ansible_hostfile=False
-create_mgmt_device=False
-create_mgmt_network=False
-create_mgmt_configs_only=False
-verbose=False
-start_port=8000
-port_gap=1000
-synced_folder=False
-display_datastructures=False
 VAGRANTFILE='Vagrantfile'
 VAGRANTFILE_template='templates/Vagrantfile.j2'
-customer = os.path.basename(os.path.dirname(os.getcwd()))
-TEMPLATES=[[VAGRANTFILE_template,VAGRANTFILE]]
-arg_string=" ".join(sys.argv)
-if args.topology_file: topology_file=args.topology_file
-if args.verbose: verbose=args.verbose
-if args.provider: provider=args.provider
-if args.ansible_hostfile: generate_ansible_hostfile=True
-if args.create_mgmt_device:
-    create_mgmt_device=True
-if args.create_mgmt_network:
-    create_mgmt_device=True
-    create_mgmt_network=True
-if args.create_mgmt_configs_only:
-    create_mgmt_configs_only=True
-
-if args.template:
-    for templatefile,destination in args.template:
-        TEMPLATES.append([templatefile,destination])
-for templatefile,destination in TEMPLATES:
-    if not os.path.isfile(templatefile):
-        print(styles.FAIL + styles.BOLD + " ### ERROR: provided template file-- \"" + templatefile + "\" does not exist!" + styles.ENDC)
-        exit(1)
-if args.start_port: start_port=args.start_port
-if args.port_gap: port_gap=args.port_gap
-if args.display_datastructures: display_datastructures=True
-if args.synced_folder: synced_folder=True
-
-if verbose:
-    print("Arguments:")
-    print(args)
+#With --data-driven a fixed Vagrantfile loops over the devices kept in a JSON
+#file beside it instead of spelling every device out
+VAGRANTFILE_data_template='templates/Vagrantfile.data.j2'
+VAGRANTFILE_data='Vagrantfile.json'
+#Header and provisioning script included by both Vagrantfile templates
+VAGRANTFILE_common_template='templates/Vagrantfile.common.j2'
 
 ###################################
 #### MAC Address Configuration ####
@@ -121,6 +157,17 @@ if verbose:
 start_mac="443839000000"
 #This file is generated to store the mapping between macs and mgmt interfaces
 dhcp_mac_file="./dhcp_mac_map"
+#With --shard each hypervisor's Vagrantfile goes in this directory
+shard_directory="./hypervisor_%s"
+#Hashes of the inputs of the last run, used to skip rewriting unchanged outputs
+manifest_file="./.topology_converter_manifest"
+#The parsed inventory of the last run, reused while its inputs are unchanged
+inventory_cache_file="./.topology_converter_cache"
+#Bump when the layout of the cached data changes
+inventory_cache_format=2
+#Converter state made by parse() that is kept in the inventory cache
+cached_attributes=['warning','mac_map','mgmt_ports','mgmt_ips','link_lefts','link_ports','udp_links',
+                   'unconnected_links','unconnected_ports','net_numbers','device_definitions','topology_size']
 
 ######################################################
 #############    Everything Else     #################
@@ -128,11 +175,14 @@ dhcp_mac_file="./dhcp_mac_map"
 
 #Hardcoded Variables
 script_storage="./helper_scripts"
-epoch_time = str(int(time.time()))
-mac_map={}
+mgmt_template_dir="./templates/auto_mgmt_network/"
+#Topology files at least this many bytes are read through mmap
+mmap_threshold=8*1024*1024
+#Compiled templates are kept here between runs, None uses jinja2's per-user
+#directory under the system temp dir
+template_cache_dir=None
 
 #Static Variables -- #Do not change!
-warning=[]
 libvirt_reuse_error="""
        When constructing a VAGRANTFILE for the libvirt provider
        interface reuse is not possible because the UDP tunnels
@@ -144,101 +194,1380 @@ libvirt_reuse_error="""
        allow you to avoid reusing interfaces here.
 """
 
+###### Classes
+class RangeSet(object):
+    # Set of integers stored as sorted, non-overlapping [start, end) ranges.
+    # Membership tests and next_free() are O(log n) in the number of ranges,
+    # so a long run of used values costs no more than a single one.
+    __slots__ = ('starts','ends')
+
+    def __init__(self):
+        self.starts=[]
+        self.ends=[]
+
+    def __contains__(self,value):
+        i=bisect.bisect_right(self.starts,value)-1
+        return i >= 0 and value < self.ends[i]
+
+    def next_free(self,value):
+        # Smallest value >= value that is not in the set
+        i=bisect.bisect_right(self.starts,value)-1
+        if i >= 0 and value < self.ends[i]: return self.ends[i]
+        return value
+
+    def prev_free(self,value):
+        # Largest value <= value that is not in the set
+        i=bisect.bisect_right(self.starts,value)-1
+        if i >= 0 and value < self.ends[i]: return self.starts[i]-1
+        return value
+
+    def next_used(self,value):
+        # Smallest value >= value that is in the set, None if there is none
+        i=bisect.bisect_right(self.starts,value)-1
+        if i >= 0 and value < self.ends[i]: return value
+        if i+1 < len(self.starts): return self.starts[i+1]
+        return None
+
+    def add(self,value):
+        # Returns False if the value was already in the set
+        if value in self: return False
+        self.add_range(value,value+1)
+        return True
+
+    def add_range(self,start,end):
+        # Adds [start, end) which must not overlap anything already in the set
+        i=bisect.bisect_right(self.starts,start)
+        merge_left = i > 0 and self.ends[i-1] == start
+        merge_right = i < len(self.starts) and self.starts[i] == end
+        if merge_left and merge_right:
+            self.ends[i-1]=self.ends[i]
+            del self.starts[i]
+            del self.ends[i]
+        elif merge_left:
+            self.ends[i-1]=end
+        elif merge_right:
+            self.starts[i]=start
+        else:
+            self.starts.insert(i,start)
+            self.ends.insert(i,end)
+
+class MacAllocator(object):
+    # Hands out MAC addresses as integers counting up from start_mac, jumping
+    # over anything reserved with reserve() (user specified left_mac/right_mac).
+    __slots__ = ('next_mac','used')
+
+    def __init__(self,start_mac):
+        self.next_mac=int(start_mac,16)+1
+        self.used=RangeSet()
+
+    def reserve(self,mac_address):
+        # Accepts a MAC in any of the formats allowed in the topology file
+        try:
+            mac=int(mac_address.replace('"','').replace(':',''),16)
+        except ValueError:
+            return False
+        return self.used.add(mac)
+
+    def fetch(self):
+        mac=self.used.next_free(self.next_mac)
+        self.used.add_range(mac,mac+1)
+        self.next_mac=mac+1
+        return mac
+
+    def fetch_block(self,count):
+        # Returns count MACs, taking whole free runs between reserved ranges
+        macs=[]
+        while len(macs) < count:
+            mac=self.used.next_free(self.next_mac)
+            limit=self.used.next_used(mac)
+            run=count-len(macs)
+            if limit is not None and limit-mac < run: run=limit-mac
+            macs.extend(range(mac,mac+run))
+            self.used.add_range(mac,mac+run)
+            self.next_mac=mac+run
+        return macs
+
+class AddressPool(object):
+    # Assignable host addresses of an ipaddress network. Addresses are kept as
+    # integers with the used ones in a RangeSet, so memory does not depend on
+    # the prefix length and reserve()/allocate() are O(log n).
+    __slots__ = ('network','first','last','used','next_address')
+
+    def __init__(self,network):
+        self.network=network
+        self.first=int(network.network_address)
+        self.last=int(network.broadcast_address)
+        # Same bounds as network.hosts()
+        if network.version == 4 and network.prefixlen < 31:
+            self.first += 1
+            self.last -= 1
+        elif network.version == 6 and network.prefixlen < 127:
+            self.first += 1
+        self.used=RangeSet()
+        self.next_address=self.first
+
+    def nth(self,index):
+        # Same as network[index], raises IndexError past the end of the network
+        import ipaddress
+        if index < 0 or index >= self.network.num_addresses: raise IndexError("address index out of range")
+        return ipaddress.ip_address(int(self.network.network_address)+index)
+
+    def reserve(self,address):
+        # Returns False if the address is not assignable or is already used
+        address=int(address)
+        if address < self.first or address > self.last: return False
+        return self.used.add(address)
+
+    def allocate(self):
+        # Lowest free address once every reservation has been made, None when
+        # the pool is exhausted
+        address=self.used.next_free(self.next_address)
+        if address > self.last: return None
+        self.used.add_range(address,address+1)
+        self.next_address=address+1
+        import ipaddress
+        return ipaddress.ip_address(address)
+
+class UdpPortAllocator(object):
+    # Tracks the UDP ports in use on each tunnel_ip (hypervisor) for the
+    # libvirt provider. Ports only have to be unique per host, so every
+    # hypervisor can use the whole first_port..last_port range.
+    __slots__ = ('first_port','last_port','used')
+
+    def __init__(self,first_port,last_port=65535):
+        self.first_port=first_port
+        self.last_port=last_port
+        self.used={}
+
+    def capacity(self):
+        return max(0,self.last_port-self.first_port+1)
+
+    def is_free(self,host,port):
+        if port < self.first_port or port > self.last_port: return False
+        return host not in self.used or port not in self.used[host]
+
+    def reserve(self,host,port):
+        # Returns False if the port is out of range or already used on host
+        if not self.is_free(host,port): return False
+        if host not in self.used: self.used[host]=RangeSet()
+        self.used[host].add(port)
+        return True
+
+    def allocate(self,host):
+        # Lowest free port on host, None when the host has run out
+        if host not in self.used: self.used[host]=RangeSet()
+        port=self.used[host].next_free(self.first_port)
+        if port > self.last_port: return None
+        self.used[host].add(port)
+        return port
+
+    def allocate_top(self,host):
+        # Highest free port on host, None when the host has run out
+        if host not in self.used: self.used[host]=RangeSet()
+        port=self.used[host].prev_free(self.last_port)
+        if port < self.first_port: return None
+        self.used[host].add(port)
+        return port
+
+    def utilization(self):
+        # [(host, ports used, capacity)] sorted by host
+        return [(host,sum(end-start for start,end in zip(self.used[host].starts,self.used[host].ends)),self.capacity())
+                for host in sorted(self.used)]
+
+class NetNumberAllocator(object):
+    # Hands out the net_number of each link. A link found in the saved
+    # allocation state keeps its old number, any other link gets the number
+    # it would have had without saved state or, when a saved link already
+    # holds that one, the next free number after it.
+    __slots__ = ('saved','used','assigned')
+
+    def __init__(self,saved=None):
+        self.saved={}
+        self.used=RangeSet()
+        self.assigned={}
+        if saved:
+            for key in sorted(saved):
+                number=saved[key]
+                if isinstance(number,int) and number > 0 and self.used.add(number): self.saved[key]=number
+
+    def assign(self,key,candidate):
+        if key in self.saved and key not in self.assigned:
+            number=self.saved[key]
+        else:
+            number=self.used.next_free(candidate)
+            self.used.add(number)
+        self.assigned[key]=number
+        return number
+
+    def cached(self):
+        # Plain JSON data for the inventory cache
+        return {'saved':self.saved,'used':[self.used.starts,self.used.ends],'assigned':self.assigned}
+
+    @classmethod
+    def from_cached(cls,cached):
+        allocator=cls()
+        allocator.saved=cached['saved']
+        allocator.used.starts,allocator.used.ends=cached['used']
+        allocator.assigned=cached['assigned']
+        return allocator
+
+_canonical_mac = re.compile(r'^[0-9a-f]{2}(:[0-9a-f]{2}){5}$')
+_unset = object()
+
+class Interface(object):
+    # One end of a link. The fields add_link() sets on every link end are
+    # slots, with the MAC, network number and UDP ports kept as integers, and
+    # passthrough attributes from the topology go into extra. Indexing works
+    # like the dict of strings it replaces, and dict(interface) gives the
+    # templates and the state file exactly that dict, same key order included.
+    __slots__ = ('mac','network','local_port','remote_port','remote_interface','remote_device','local_ip','remote_ip','extra')
+    fields = __slots__[:-1]
+    field_set = frozenset(fields)
+
+    def __init__(self,mac):
+        if _canonical_mac.match(mac): mac=int(mac.replace(':',''),16)
+        self.mac=mac
+        self.extra=None
+
+    def field(self,key):
+        # Raises AttributeError while the field is unset
+        value=getattr(self,key)
+        if key == 'mac' and isinstance(value,int):
+            mac="%012x" % value
+            return ':'.join([mac[i:i+2] for i in range(0,12,2)])
+        if key == 'network' and isinstance(value,int): return "net%s" % value
+        if (key == 'local_port' or key == 'remote_port') and isinstance(value,int): return str(value)
+        return value
+
+    def as_dict(self):
+        # Same as dict(interface). Link ends are built by add_link() in one of
+        # two shapes, virtualbox or libvirt, which are copied directly.
+        mac=self.mac
+        if mac.__class__ is int:
+            mac="%012x" % mac
+            mac="%s:%s:%s:%s:%s:%s" % (mac[0:2],mac[2:4],mac[4:6],mac[6:8],mac[8:10],mac[10:12])
+        network=getattr(self,'network',_unset)
+        try:
+            if network is not _unset:
+                if network.__class__ is int: network="net%s" % network
+                plain={'mac':mac,'network':network,'remote_interface':self.remote_interface,'remote_device':self.remote_device}
+            else:
+                local_port=self.local_port
+                remote_port=self.remote_port
+                if local_port.__class__ is int: local_port=str(local_port)
+                if remote_port.__class__ is int: remote_port=str(remote_port)
+                plain={'mac':mac,'local_port':local_port,'remote_port':remote_port,
+                       'remote_interface':self.remote_interface,'remote_device':self.remote_device,
+                       'local_ip':self.local_ip,'remote_ip':self.remote_ip}
+        except AttributeError:
+            plain=dict((key,self.field(key)) for key in self.fields if hasattr(self,key))
+        if self.extra: plain.update(self.extra)
+        return plain
+
+    def keys(self):
+        keys=[key for key in self.fields if hasattr(self,key)]
+        if self.extra: keys.extend(self.extra)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __contains__(self,key):
+        if key in self.field_set and hasattr(self,key): return True
+        return self.extra is not None and key in self.extra
+
+    def __getitem__(self,key):
+        if key in self.field_set:
+            try:
+                return self.field(key)
+            except AttributeError:
+                pass
+        if self.extra is not None and key in self.extra: return self.extra[key]
+        raise KeyError(key)
+
+    def get(self,key,default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self,key,value):
+        # A field that is already set keeps its place, anything else is
+        # appended after the fields like a new dict key would be
+        if key in self.field_set and hasattr(self,key): setattr(self,key,value)
+        else:
+            if self.extra is None: self.extra={}
+            self.extra[key]=value
+
+    def __delitem__(self,key):
+        if key in self.field_set and hasattr(self,key): delattr(self,key)
+        elif self.extra is not None and key in self.extra: del self.extra[key]
+        else: raise KeyError(key)
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+    def cached(self):
+        # The slots that are set, as plain JSON data for the inventory cache
+        return dict((key,getattr(self,key)) for key in self.__slots__ if hasattr(self,key))
+
+    @classmethod
+    def from_cached(cls,cached):
+        interface=cls.__new__(cls)
+        for key in cached: setattr(interface,key,cached[key])
+        return interface
+
+class OutputRecorder(object):
+    # Stands in for sys.stdout, passing everything through while keeping a
+    # copy so the output of a step can be replayed later.
+    def __init__(self,stream):
+        self.stream=stream
+        self.parts=[]
+
+    def write(self,text):
+        self.parts.append(text)
+        self.stream.write(text)
+
+    def getvalue(self):
+        return "".join(self.parts)
+
+    def __getattr__(self,name):
+        return getattr(self.stream,name)
+
+def file_hash(path):
+    digest=hashlib.sha1()
+    with open(path,'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(1024*1024),b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def plain_device(device):
+    # The device with its interfaces as plain dicts, as the state file and
+    # the verbose dumps expect
+    plain=dict(device)
+    if isinstance(device.get('interfaces'),dict):
+        plain['interfaces']=dict((name,interface.as_dict()) for name,interface in device['interfaces'].items())
+    return plain
+
+class PhaseTimings(object):
+    # Wall time and peak memory of each phase of a conversion plus counters,
+    # for --timings. The conversion runs its phases one after another, so
+    # mark(name) closes the phase that started at the previous mark. Peak
+    # memory comes from tracemalloc, which is only started for trace_memory
+    # since it slows everything down, and only covers Python allocations.
+    # When disabled every call is a no-op.
+    def __init__(self,enabled=False,trace_memory=False):
+        self.enabled=enabled
+        self.phases=[]
+        self.counters=collections.OrderedDict()
+        self.tracing=False
+        self.started=None
+        self.last=None
+        if not enabled: return
+        import threading
+        self.lock=threading.Lock()
+        if trace_memory:
+            try:
+                import tracemalloc
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    self.tracing=True
+            except ImportError:
+                pass
+        self.started=self.last=time.time()
+
+    def peak(self):
+        # Peak traced memory since the previous mark, None when not tracing
+        if not self.tracing: return None
+        import tracemalloc
+        peak=tracemalloc.get_traced_memory()[1]
+        if hasattr(tracemalloc,'reset_peak'): tracemalloc.reset_peak()
+        return peak
+
+    def mark(self,name):
+        if not self.enabled: return
+        now=time.time()
+        with self.lock:
+            self.phases.append((name,now-self.last,self.peak()))
+            self.last=now
+
+    def count(self,name,amount=1):
+        if not self.enabled: return
+        with self.lock:
+            self.counters[name]=self.counters.get(name,0)+amount
+
+    def stop(self):
+        if self.tracing:
+            import tracemalloc
+            tracemalloc.stop()
+            self.tracing=False
+
+    def report(self):
+        total=time.time()-self.started
+        print(styles.BOLD + "\n  TIMINGS:" + styles.ENDC)
+        print("    %-44s %10s %8s %10s" % ("phase","time(s)","share","peak(MB)"))
+        for name,seconds,peak in self.phases:
+            peak_text="-"
+            if peak is not None: peak_text="%.2f" % (peak/1048576.0)
+            print("    %-44s %10.4f %7.1f%% %10s" % (name,seconds,100.0*seconds/max(total,1e-9),peak_text))
+        print("    %-44s %10.4f" % ("total",total))
+        print(styles.BOLD + "  COUNTERS:" + styles.ENDC)
+        for name in self.counters:
+            print("    %-44s %10s" % (name,self.counters[name]))
+
+    def as_dict(self):
+        return {'total_seconds':time.time()-self.started,
+                'phases':[{'name':name,'seconds':seconds,'peak_bytes':peak} for name,seconds,peak in self.phases],
+                'counters':dict(self.counters)}
+
 ###### Functions
-def mac_fetch(hostname,interface):
-    global start_mac
-    global mac_map
-    global warning
-    global verbose
-    new_mac = ("%x" % (int(start_mac, 16)+1)).lower()
-    while new_mac in mac_map:
-        warning.append(styles.WARNING + styles.BOLD + "    WARNING: MF MAC Address Collision -- tried to use " + new_mac + " (on "+interface+") but it was already in use." + styles.ENDC)
-        start_mac = new_mac
-        new_mac = ("%x" % (int(start_mac, 16)+1)).lower()
-    start_mac = new_mac
-    if verbose: print("    Fetched new MAC ADDRESS: \"%s\"" % new_mac)
-    return add_mac_colon(new_mac)
-
-def add_mac_colon(mac_address):
-    global verbose
-    if verbose: print("MAC ADDRESS IS: \"%s\"" % mac_address)
-    return ':'.join(map(''.join, zip(*[iter(mac_address)]*2)))
+def parse_hypervisor(spec):
+    # "IP[:MEMORY_MB[:CPUS]]", IPv6 addresses go in brackets: "[fe80::1]:65536"
+    import ipaddress
+    spec=spec.strip()
+    if spec.startswith('['):
+        host,_,rest=spec[1:].partition(']')
+        fields=[host]+[field for field in rest.split(':') if field != ""]
+    else:
+        fields=spec.split(':')
+    try:
+        ipaddress.ip_address(unicode(fields[0]))
+        if len(fields) > 3: raise ValueError
+        limits=[int(field) for field in fields[1:]]
+        if any(limit <= 0 for limit in limits): raise ValueError
+    except ValueError:
+        raise conversion_error(" ### ERROR: hypervisor \"" + spec + "\" should be IP[:MEMORY_MB[:CPUS]] with positive numbers.")
+    limits+=[None]*(2-len(limits))
+    return (fields[0],limits[0],limits[1])
+
+def place_nodes(nodes,links,hosts,pinned_load=None):
+    # Assigns each node to a host. nodes is [(name, memory, cpus)], links is
+    # [(name, name)] and may mention nodes that are already placed, given as
+    # "@host" names, hosts is [(ip, memory, cpus)] where None means no limit
+    # and pinned_load is {ip: (memory, cpus)} already used on a host.
+    # A breadth first walk from the best connected node packs each node onto
+    # the host holding most of its neighbours, discounted by how full that
+    # host is (linear deterministic greedy), under the memory and cpu limits.
+    # A few refinement passes then move single nodes to the host holding more
+    # of their neighbours while capacity allows. Returns {name: ip}, or the
+    # name of the first node that did not fit anywhere.
+    pinned_load=pinned_load or {}
+    index=dict((node[0],i) for i,node in enumerate(nodes))
+    host_index=dict((host[0],h) for h,host in enumerate(hosts))
+    neighbors=[[] for node in nodes]
+    pinned_neighbors=[{} for node in nodes]
+    for a,b in links:
+        for x,y in ((a,b),(b,a)):
+            if x not in index: continue
+            if y in index: neighbors[index[x]].append(index[y])
+            elif y.startswith('@') and y[1:] in host_index:
+                h=host_index[y[1:]]
+                pinned_neighbors[index[x]][h]=pinned_neighbors[index[x]].get(h,0)+1
+
+    #Hosts without limits share the load evenly, with room for the biggest
+    #node. A host with only a memory limit has no limit on cpus.
+    total_memory=sum(node[1] for node in nodes)+sum(load[0] for load in pinned_load.values())
+    total_cpus=sum(node[2] for node in nodes)+sum(load[1] for load in pinned_load.values())
+    biggest_memory=max([node[1] for node in nodes]+[0])
+    biggest_cpus=max([node[2] for node in nodes]+[0])
+    memory_limit=[]
+    cpu_limit=[]
+    for ip,memory,cpus in hosts:
+        if memory is None and cpus is None:
+            memory_limit.append(total_memory*1.1/len(hosts)+biggest_memory)
+            cpu_limit.append(total_cpus*1.1/len(hosts)+biggest_cpus)
+        else:
+            memory_limit.append(memory if memory is not None else float('inf'))
+            cpu_limit.append(cpus if cpus is not None else float('inf'))
+    memory_used=[pinned_load.get(host[0],(0,0))[0] for host in hosts]
+    cpus_used=[pinned_load.get(host[0],(0,0))[1] for host in hosts]
+
+    def fill(h):
+        return max(memory_used[h]/float(max(memory_limit[h],1)),cpus_used[h]/float(max(cpu_limit[h],1)))
+    def fits(h,i):
+        return memory_used[h]+nodes[i][1] <= memory_limit[h] and cpus_used[h]+nodes[i][2] <= cpu_limit[h]
+    def neighbor_hosts(i,assignment):
+        counts=dict(pinned_neighbors[i])
+        for j in neighbors[i]:
+            if assignment[j] >= 0: counts[assignment[j]]=counts.get(assignment[j],0)+1
+        return counts
+
+    #Breadth first order, starting each component from its best connected node
+    order=[]
+    seen=[False]*len(nodes)
+    for start in sorted(range(len(nodes)),key=lambda i: (-len(neighbors[i]),i)):
+        if seen[start]: continue
+        seen[start]=True
+        queue=collections.deque([start])
+        while queue:
+            i=queue.popleft()
+            order.append(i)
+            for j in sorted(neighbors[i],key=lambda j: (-len(neighbors[j]),j)):
+                if not seen[j]:
+                    seen[j]=True
+                    queue.append(j)
+
+    assignment=[-1]*len(nodes)
+    for i in order:
+        counts=neighbor_hosts(i,assignment)
+        best=None
+        for h in range(len(hosts)):
+            if not fits(h,i): continue
+            score=(counts.get(h,0)*(1.0-fill(h)),-fill(h),-h)
+            if best is None or score > best[0]: best=(score,h)
+        if best is None: return nodes[i][0]
+        assignment[i]=best[1]
+        memory_used[best[1]]+=nodes[i][1]
+        cpus_used[best[1]]+=nodes[i][2]
+
+    for refinement in range(4):
+        moved=0
+        for i in order:
+            counts=neighbor_hosts(i,assignment)
+            current=assignment[i]
+            best=current
+            for h in sorted(counts,key=lambda h: (-counts[h],h)):
+                if counts[h] <= counts.get(current,0): break
+                if fits(h,i):
+                    best=h
+                    break
+            if best == current: continue
+            memory_used[current]-=nodes[i][1]
+            cpus_used[current]-=nodes[i][2]
+            memory_used[best]+=nodes[i][1]
+            cpus_used[best]+=nodes[i][2]
+            assignment[i]=best
+            moved+=1
+        if moved == 0: break
+
+    return dict((nodes[i][0],hosts[assignment[i]][0]) for i in range(len(nodes)))
+
+def diff_devices(previous,current):
+    # Compares two {device: definition} maps as saved in the allocation state
+    # and returns which VMs were added, removed or changed, and for each
+    # changed VM which attributes and interfaces differ.
+    report={'added':sorted(device for device in current if device not in previous),
+            'removed':sorted(device for device in previous if device not in current),
+            'changed':{}}
+    for device in sorted(current):
+        if device not in previous or current[device] == previous[device]: continue
+        old=previous[device]
+        new=current[device]
+        attributes=sorted(attribute for attribute in set(old) | set(new)
+                          if attribute != 'interfaces' and old.get(attribute) != new.get(attribute))
+        old_interfaces=old.get('interfaces',{})
+        new_interfaces=new.get('interfaces',{})
+        interfaces=sorted((interface for interface in set(old_interfaces) | set(new_interfaces)
+                           if old_interfaces.get(interface) != new_interfaces.get(interface)),key=natural_sort_key)
+        report['changed'][device]={'attributes':attributes,'interfaces':interfaces}
+    report['reload']=sorted(report['changed'])
+    report['unchanged']=len([device for device in current if device in previous and current[device] == previous[device]])
+    return report
+
+def link_key(left_device,left_interface,right_device,right_interface):
+    # Name of a link in the allocation state, the same whichever way round
+    # the link is written in the topology file
+    return " -- ".join(sorted(["%s:%s" % (left_device,left_interface),"%s:%s" % (right_device,right_interface)]))
+
+def topology_lines(topology_file):
+    # Yields the lines of the topology file one at a time. Files larger than
+    # mmap_threshold are read through a memory mapped buffer so they are paged
+    # in by the OS instead of being copied into the process. An empty file
+    # cannot be mapped.
+    size=os.path.getsize(topology_file)
+    if size == 0 or size < mmap_threshold:
+        with open(topology_file,"r") as topo_file:
+            for line in topo_file:
+                yield line
+        return
+    encoding=locale.getpreferredencoding(False)
+    with open(topology_file,"rb") as topo_file:
+        buffer=mmap.mmap(topo_file.fileno(),0,access=mmap.ACCESS_READ)
+        try:
+            for line in iter(buffer.readline, b''):
+                if not isinstance(line,str): line=line.decode(encoding)
+                yield line
+        finally:
+            buffer.close()
+
+def lint_topo_line(count,line):
+    #Try to encode into ascii
+    try:
+        line.encode('ascii','ignore')
+    except UnicodeDecodeError as e:
+        raise conversion_error(" ### ERROR: Line %s:\n %s\n         --> \"%s\" \n     Has hidden unicode characters in it which prevent it from being converted to ASCII cleanly. Try manually typing it instead of copying and pasting." % (count,line,re.sub(r'[^\x00-\x7F]+','?', line)))
+
+    if line.count("\"")%2 == 1:
+        raise conversion_error(" ### ERROR: Line %s: Has an odd number of quotation characters (\").\n     %s\n"%(count,line))
+    if line.count("'")%2 == 1:
+        raise conversion_error(" ### ERROR: Line %s: Has an odd number of quotation characters (').\n     %s\n"%(count,line))
+    if line.count(":") == 2:
+        if " -- " not in line:
+            raise conversion_error(" ### ERROR: Line %s: Does not contain the following sequence \" -- \" to seperate the different ends of the link.\n     %s\n"%(count,line))
 
 def lint_topo_file(topology_file):
-    with open(topology_file,"r") as topo_file:
-        line_list=topo_file.readlines()
-        count=0
-        for line in line_list:
-            count +=1
-            #Try to encode into ascii
-            try:
-                line.encode('ascii','ignore')
-            except UnicodeDecodeError as e:
-                print(styles.FAIL + styles.BOLD + " ### ERROR: Line %s:\n %s\n         --> \"%s\" \n     Has hidden unicode characters in it which prevent it from being converted to ASCII cleanly. Try manually typing it instead of copying and pasting." % (count,line,re.sub(r'[^\x00-\x7F]+','?', line)) + styles.ENDC)
-                exit(1)
-
-            if line.count("\"")%2 == 1:
-                print(styles.FAIL + styles.BOLD + " ### ERROR: Line %s: Has an odd number of quotation characters (\").\n     %s\n"%(count,line) + styles.ENDC)
-                exit(1)
-            if line.count("'")%2 == 1:
-                print(styles.FAIL + styles.BOLD + " ### ERROR: Line %s: Has an odd number of quotation characters (').\n     %s\n"%(count,line) + styles.ENDC)
-                exit(1)
-            if line.count(":") == 2:
-                if " -- " not in line:
-                    print(styles.FAIL + styles.BOLD + " ### ERROR: Line %s: Does not contain the following sequence \" -- \" to seperate the different ends of the link.\n     %s\n"%(count,line) + styles.ENDC)
-                    exit(1)
-
-def parse_topology(topology_file):
-    global provider
-    global verbose
-    global warning
-    lint_topo_file(topology_file)
+    # Standalone lint pass, the native parser lints each line as it reads it.
+    count=0
+    for line in topology_lines(topology_file):
+        count +=1
+        lint_topo_line(count,line)
+
+class DotSyntaxUnsupported(Exception):
+    # Raised by the native parser when the topology uses DOT syntax outside of
+    # the subset written by hand or by our generators. The caller falls back
+    # to pydotplus which understands the complete grammar.
+    pass
+
+# Token classes mirror the pydotplus grammar so raw values come out identical.
+_dot_token_re = re.compile(r'''
+    (?P<space>\s+)
+  | (?P<comment>(?://|\#).*)
+  | (?P<block_comment>/\*)
+  | (?P<string>"[^"]*")
+  | (?P<edge_op>--|->)
+  | (?P<punct>[\[\]{}=;,:])
+  | (?P<id>[A-Za-z0-9_.]+)
+  | (?P<number>-[0-9.]+)
+''', re.VERBOSE)
+_dot_keywords = ('strict','graph','digraph','subgraph','node','edge')
+_dot_eof = (None, 'eof', '')
+
+def dot_tokens(lines):
+    # Yields (line_number, kind, text) one line at a time so the whole file is
+    # never held in memory. Every line is linted before it is tokenized.
+    in_comment=False
+    line_number=0
+    for line in lines:
+        line_number += 1
+        lint_topo_line(line_number,line)
+        pos=0
+        if in_comment:
+            pos=line.find('*/')
+            if pos < 0: continue
+            pos += 2
+            in_comment=False
+        length=len(line)
+        while pos < length:
+            match=_dot_token_re.match(line,pos)
+            if match is None:
+                raise DotSyntaxUnsupported("Line %s: unsupported syntax near \"%s\"" % (line_number,line[pos:].strip()))
+            kind=match.lastgroup
+            pos=match.end()
+            if kind == 'space' or kind == 'comment': continue
+            if kind == 'block_comment':
+                end=line.find('*/',pos)
+                if end < 0:
+                    in_comment=True
+                    break
+                pos=end+2
+                continue
+            yield (line_number,kind,match.group(kind))
+
+def read_dot_records(topology_file):
+    # Native single-pass parser for the DOT subset used by topology files:
+    #   graph name {
+    #     "device" [attribute="value" ...]
+    #     "device":"interface" -- "device":"interface" [left_attribute="value" ...]
+    #   }
+    # Yields ('node', name, attributes) and ('edge', source, destination,
+    # attributes) records carrying the same raw strings pydotplus returns.
+    # Anything else raises DotSyntaxUnsupported.
+    tokens=dot_tokens(topology_lines(topology_file))
+
+    def advance():
+        return next(tokens,_dot_eof)
+
+    def unsupported(token):
+        if token[0] is None: return DotSyntaxUnsupported("Unexpected end of file")
+        return DotSyntaxUnsupported("Line %s: unsupported syntax near \"%s\"" % (token[0],token[2]))
+
+    def is_id(token):
+        if token[1] == 'string': return True
+        return token[1] == 'id' and token[2].lower() not in _dot_keywords
+
+    def read_attributes(token,attributes):
+        while token[2] == '[':
+            token=advance()
+            while token[2] != ']':
+                if token[1] not in ('id','string'): raise unsupported(token)
+                key=token[2]
+                token=advance()
+                if token[2] != '=': raise unsupported(token)
+                token=advance()
+                if token[1] not in ('id','string','number'): raise unsupported(token)
+                attributes[key]=token[2]
+                token=advance()
+                if token[2] == ',': token=advance()
+            token=advance()
+        return token
+
+    def read_port(device):
+        # Called with the ":" already consumed after the device name
+        token=advance()
+        if token[1] not in ('id','string'): raise unsupported(token)
+        return device+":"+token[2]
+
+    #Graph header: [strict] graph [name] {
+    token=advance()
+    if token[1] == 'id' and token[2].lower() == 'strict': token=advance()
+    if not (token[1] == 'id' and token[2].lower() == 'graph'): raise unsupported(token)
+    token=advance()
+    if is_id(token): token=advance()
+    if token[2] != '{': raise unsupported(token)
+
+    token=advance()
+    while token[2] != '}':
+        if token[2] == ';':
+            token=advance()
+            continue
+        if not is_id(token): raise unsupported(token)
+        first=token
+        token=advance()
+        if token[2] == '=':
+            #Graph level attribute, not used by topology_converter
+            token=advance()
+            if token[1] not in ('id','string','number'): raise unsupported(token)
+            token=advance()
+        elif token[2] == ':':
+            source=read_port(first[2])
+            token=advance()
+            if token[2] != '--': raise unsupported(token)
+            token=advance()
+            if not is_id(token): raise unsupported(token)
+            device=token[2]
+            token=advance()
+            if token[2] != ':': raise unsupported(token)
+            destination=read_port(device)
+            attributes={}
+            token=read_attributes(advance(),attributes)
+            if token[1] == 'edge_op': raise unsupported(token)
+            yield ('edge',source,destination,attributes)
+        else:
+            if token[1] == 'edge_op': raise unsupported(token)
+            attributes={}
+            token=read_attributes(token,attributes)
+            yield ('node',first[2],attributes)
+    token=advance()
+    if token[1] != 'eof': raise unsupported(token)
+
+def read_dot_records_pydotplus(topology_file):
+    # Fallback for topologies using DOT syntax the native parser does not
+    # handle. Yields the same records as read_dot_records().
+    import pydotplus
     try:
         topology = pydotplus.graphviz.graph_from_dot_file(topology_file)
     except Exception as e:
-        print(styles.FAIL + styles.BOLD + " ### ERROR: Cannot parse the provided topology.dot file (%s)\n     There is probably a syntax error of some kind, common causes include failing to close quotation marks and hidden characters from copy/pasting device names into the topology file." % (topology_file) + styles.ENDC)
-        exit(1)
+        raise conversion_error(" ### ERROR: Cannot parse the provided topology.dot file (%s)\n     There is probably a syntax error of some kind, common causes include failing to close quotation marks and hidden characters from copy/pasting device names into the topology file." % (topology_file))
 
-    inventory = {}
     try:
         nodes=topology.get_node_list()
     except Exception as e:
         print(e)
-        print(styles.FAIL + styles.BOLD + " ### ERROR: There is a syntax error in your topology file (%s). Read the error output above for any clues as to the source." %(topology_file) + styles.ENDC)
-        exit(1)
+        raise conversion_error(" ### ERROR: There is a syntax error in your topology file (%s). Read the error output above for any clues as to the source." %(topology_file))
     try:
         edges=topology.get_edge_list()
     except Exception as e:
         print(e)
-        print(styles.FAIL + styles.BOLD + " ### ERROR: There is a syntax error in your topology file (%s). Read the error output above for any clues as to the source." %(topology_file) + styles.ENDC)
-        exit(1)
+        raise conversion_error(" ### ERROR: There is a syntax error in your topology file (%s). Read the error output above for any clues as to the source." %(topology_file))
 
-    #Add Nodes to inventory
     for node in nodes:
-        node_name=node.get_name().replace('"','')
+        yield ('node',node.get_name(),node.get_attributes())
+    for edge in edges:
+        yield ('edge',edge.get_source(),edge.get_destination(),edge.get_attributes())
+
+# Topologies written by generators can skip DOT entirely
+structured_formats={'.json':'json','.yaml':'yaml','.yml':'yaml','.csv':'csv'}
+link_end_columns=('left_device','left_interface','right_device','right_interface')
+
+def topology_format(topology_file):
+    return structured_formats.get(os.path.splitext(topology_file)[1].lower(),'dot')
+
+def default_node_table(topology_file):
+    # topology.csv takes its devices from topology.nodes.csv unless told otherwise
+    return os.path.splitext(topology_file)[0]+".nodes.csv"
+
+def structured_error(topology_file,message):
+    raise conversion_error(" ### ERROR: %s: %s" % (topology_file,message))
+
+def structured_attributes(topology_file,where,attributes,skip=()):
+    # Attribute values as the strings a DOT file would carry. Empty values
+    # (an empty CSV cell or null) leave the attribute unset.
+    strings={}
+    for key in attributes:
+        if key in skip: continue
+        value=attributes[key]
+        if value is None or value == "": continue
+        if isinstance(value,bool): value=str(value)
+        elif isinstance(value,(int,float)): value=str(value)
+        elif not isinstance(value,(str,unicode)):
+            structured_error(topology_file,"%s: attribute \"%s\" must be a string, number or boolean" % (where,key))
+        strings[str(key)]=value
+    return strings
+
+def structured_link(topology_file,where,link):
+    # The ('edge', source, destination, attributes) record of one link
+    for column in link_end_columns:
+        if link.get(column) in (None,""):
+            structured_error(topology_file,"%s: \"%s\" is missing" % (where,column))
+    ends=structured_attributes(topology_file,where,dict((column,link[column]) for column in link_end_columns))
+    return ('edge',ends['left_device']+":"+ends['left_interface'],ends['right_device']+":"+ends['right_interface'],
+            structured_attributes(topology_file,where,link,skip=link_end_columns))
+
+def read_document_records(topology_file,document):
+    # A JSON/YAML topology:
+    #   {"nodes": {"leaf1": {"function": "leaf", ...}, ...},
+    #    "links": [{"left_device": "leaf1", "left_interface": "swp1",
+    #               "right_device": "leaf2", "right_interface": "swp1",
+    #               "left_mtu": 9000, ...}, ...]}
+    # nodes can also be a list of attribute objects that carry a "name".
+    if not isinstance(document,dict):
+        structured_error(topology_file,"the document must be an object with \"nodes\" and \"links\"")
+    nodes=document.get('nodes') or {}
+    if isinstance(nodes,dict):
+        nodes=[(name,nodes[name] or {}) for name in nodes]
+    elif isinstance(nodes,list):
+        named=[]
+        for index,node in enumerate(nodes):
+            if not isinstance(node,dict) or node.get('name') in (None,""):
+                structured_error(topology_file,"node %s needs a \"name\"" % (index+1))
+            named.append((node['name'],dict((key,node[key]) for key in node if key != 'name')))
+        nodes=named
+    else:
+        structured_error(topology_file,"\"nodes\" must be an object or a list")
+    for name,attributes in nodes:
+        if not isinstance(attributes,dict):
+            structured_error(topology_file,"node %s: attributes must be an object" % name)
+        yield ('node',str(name),structured_attributes(topology_file,"node %s" % name,attributes))
+    links=document.get('links') or []
+    if not isinstance(links,list):
+        structured_error(topology_file,"\"links\" must be a list")
+    for index,link in enumerate(links):
+        if not isinstance(link,dict):
+            structured_error(topology_file,"link %s must be an object" % (index+1))
+        yield structured_link(topology_file,"link %s" % (index+1),link)
+
+def read_json_records(topology_file):
+    try:
+        with open(topology_file,'r') as json_file:
+            document=json.load(json_file)
+    except ValueError as e:
+        structured_error(topology_file,"not valid JSON (%s)" % e)
+    return read_document_records(topology_file,document)
+
+def read_yaml_records(topology_file):
+    try:
+        import yaml
+    except ImportError:
+        structured_error(topology_file,"YAML topologies need the PyYAML module, install it with \"pip install pyyaml\"")
+    with open(topology_file,'r') as yaml_file:
+        try:
+            document=yaml.safe_load(yaml_file)
+        except yaml.YAMLError as e:
+            structured_error(topology_file,"not valid YAML (%s)" % e)
+    return read_document_records(topology_file,document)
+
+def csv_rows(path):
+    # Yields (line number, {column: value}) one row at a time, so large edge
+    # lists are never held in memory as a whole
+    import csv
+    with open(path,'r') as csv_file:
+        reader=csv.reader(csv_file)
+        header=None
+        for row in reader:
+            if not row or row[0].startswith('#'): continue
+            if header is None:
+                header=[column.strip() for column in row]
+                continue
+            if len(row) > len(header):
+                structured_error(path,"line %s has more columns than the header" % reader.line_num)
+            yield reader.line_num,dict(zip(header,[value.strip() for value in row]))
+
+def read_csv_records(topology_file,node_table=None):
+    # A CSV edge list with left_device, left_interface, right_device and
+    # right_interface columns plus a column per link attribute, and a node
+    # table with a name column plus a column per device attribute.
+    if node_table is None: node_table=default_node_table(topology_file)
+    if not os.path.isfile(node_table):
+        structured_error(topology_file,"the node table %s does not exist, give it with --nodes" % node_table)
+    for line,node in csv_rows(node_table):
+        if node.get('name') in (None,""): structured_error(node_table,"line %s has no name" % line)
+        yield ('node',node['name'],structured_attributes(node_table,"line %s" % line,node,skip=('name',)))
+    for line,link in csv_rows(topology_file):
+        yield structured_link(topology_file,"line %s" % line,link)
+
+def read_structured_records(topology_file,node_table=None):
+    format=topology_format(topology_file)
+    if format == 'json': return read_json_records(topology_file)
+    if format == 'yaml': return read_yaml_records(topology_file)
+    return read_csv_records(topology_file,node_table)
+
+def pretty_print(data):
+    import pprint
+    pprint.PrettyPrinter(depth=6).pprint(data)
+
+_nsre = re.compile('([0-9]+)')
+def natural_sort_key(s):
+    return [int(text) if text.isdigit() else text.lower()
+            for text in re.split(_nsre, s)]
+
+
+def getKeyDevices(device):
+    # Used to order the devices for printing into the vagrantfile
+    if device['function'] == "oob-server": return 1
+    elif device['function'] == "oob-switch": return 2
+    elif device['function'] == "exit": return 3
+    elif device['function'] == "superspine": return 4
+    elif device['function'] == "spine": return 5
+    elif device['function'] == "leaf": return 6
+    elif device['function'] == "tor": return 7
+    elif device['function'] == "host": return 8
+    else: return 9
+
+def sorted_interfaces(interface_dictionary):
+    sorted_list=[]
+    interface_list=[]
+    for link in interface_dictionary:
+        sorted_list.append(link)
+    sorted_list.sort(key=natural_sort_key)
+    for link in sorted_list:
+        interface=interface_dictionary[link].as_dict()
+        interface["local_interface"]= link
+        interface_list.append(interface)
+    return interface_list
+
+template_environments={}
+def template_environment(use_cache=True):
+    # One jinja2 Environment per process, so a template is compiled at most
+    # once no matter how many conversions render it. With use_cache the
+    # compiled code is also stored on disk, keyed by the template source hash,
+    # so later runs skip compilation entirely. The loader checks mtimes to
+    # pick up templates edited while the process is running. Templates are
+    # named by absolute path, so {% include %} names are taken relative to
+    # the directory of the including template.
+    if use_cache not in template_environments:
+        import jinja2
+        import posixpath
+        class Environment(jinja2.Environment):
+            def join_path(self,template,parent):
+                return posixpath.normpath(posixpath.join(posixpath.dirname(parent),template))
+        bytecode_cache=None
+        if use_cache:
+            if template_cache_dir is not None and not os.path.isdir(template_cache_dir):
+                os.makedirs(template_cache_dir)
+            bytecode_cache=jinja2.FileSystemBytecodeCache(template_cache_dir,"topology_converter_%s.cache")
+        template_environments[use_cache]=Environment(loader=jinja2.FileSystemLoader(os.path.abspath(os.sep)),
+                                                     bytecode_cache=bytecode_cache)
+    return template_environments[use_cache]
+
+def template_name(path):
+    # Templates are looked up by absolute path so -t templates can live anywhere
+    path=os.path.abspath(path)
+    return os.path.relpath(path,os.path.abspath(os.sep)).replace(os.sep,'/')
+
+class Converter(object):
+    # Converts one topology file. All of the state for a conversion lives on
+    # the instance so a single process can run any number of conversions.
+    def __init__(self,
+                 topology_file,
+                 provider="virtualbox",
+                 verbose=False,
+                 generate_ansible_hostfile=False,
+                 create_mgmt_device=False,
+                 create_mgmt_network=False,
+                 create_mgmt_configs_only=False,
+                 templates=None,
+                 start_port=8000,
+                 port_gap=1000,
+                 display_datastructures=False,
+                 synced_folder=False,
+                 arg_string=None,
+                 output_dir=None,
+                 template_cache=True,
+                 render_jobs=1,
+                 force=False,
+                 state_file=None,
+                 diff_file=None,
+                 diff_json=None,
+                 shard=False,
+                 hypervisors=None,
+                 timings=False,
+                 timings_json=None,
+                 timings_memory=False,
+                 node_table=None,
+                 inventory_cache=True,
+                 data_driven=False):
+        self.topology_file=topology_file
+        self.provider=provider
+        self.verbose=verbose
+        self.generate_ansible_hostfile=generate_ansible_hostfile
+        self.create_mgmt_device=create_mgmt_device or create_mgmt_network
+        self.create_mgmt_network=create_mgmt_network
+        self.create_mgmt_configs_only=create_mgmt_configs_only
+        self.start_port=start_port
+        self.port_gap=port_gap
+        self.display_datastructures=display_datastructures
+        self.synced_folder=synced_folder
+        if arg_string is None: arg_string="topology_converter.py "+topology_file
+        self.arg_string=arg_string
+        self.output_dir=output_dir
+        self.template_cache=template_cache
+        self.render_jobs=render_jobs
+        self.force=force
+        self.manifest=None
+        self.input_file_hashes={}
+        self.inventory_cache=inventory_cache
+        self.state_file=state_file
+        self.saved_state={}
+        self.saved_macs={}
+        self.net_numbers=NetNumberAllocator()
+        self.mgmt_ports={}
+        self.mgmt_ips={}
+        self.link_lefts={}
+        self.udp_links=[]
+        self.link_ports={}
+        self.unconnected_links=[]
+        self.unconnected_ports={}
+        self.diff_file=diff_file
+        self.diff_json=diff_json
+        self.device_definitions={}
+        self.shard=shard
+        self.hypervisors=None
+        if hypervisors: self.hypervisors=[parse_hypervisor(hypervisor) for hypervisor in hypervisors]
+        self.unplaced_devices=[]
+        self.topology_size=(0,0)
+        self.timings_json=timings_json
+        self.node_table=node_table
+        if node_table is None and topology_format(topology_file) == 'csv': self.node_table=default_node_table(topology_file)
+        self.timings=PhaseTimings(timings or timings_json is not None or timings_memory,timings_memory)
+        if (shard or hypervisors) and provider != "libvirt":
+            raise conversion_error(" ### ERROR: sharding across hypervisors is only supported with the libvirt provider.")
+        self.customer = os.path.basename(os.path.dirname(os.getcwd()))
+        self.epoch_time = str(int(time.time()))
+
+        self.data_driven=data_driven
+        self.templates=[[VAGRANTFILE_data_template if data_driven else VAGRANTFILE_template,VAGRANTFILE]]
+        if templates:
+            for templatefile,destination in templates:
+                self.templates.append([templatefile,destination])
+        for templatefile in [templatefile for templatefile,destination in self.templates]+[VAGRANTFILE_common_template]:
+            if not os.path.isfile(templatefile):
+                raise conversion_error(" ### ERROR: provided template file-- \"" + templatefile + "\" does not exist!")
+
+        self.function_group={}
+        self.mac_map={}
+        self.mac_allocator=MacAllocator(start_mac)
+        self.warning=[]
+        self.config_files={}
+
+    @classmethod
+    def from_args(cls,args,arg_string):
+        # Builds a Converter from the argparse namespace of the CLI
+        return cls(args.topology_file,arg_string=arg_string,**converter_options(args))
+
+    def output_path(self,path):
+        # Generated files land in output_dir when one was given, otherwise
+        # they are written relative to the current working directory.
+        if self.output_dir is None: return path
+        return os.path.join(self.output_dir,path)
+
+    def load_template(self,path):
+        return template_environment(self.template_cache).get_template(template_name(path))
+
+    def write_output(self,destination,write,binary=False):
+        # Calls write(outfile) on a temp file beside the destination and renames
+        # it into place, so an interrupted run never leaves a half-written
+        # file. Unless force is set a destination that already holds exactly
+        # the same content is left alone to keep its mtime. Returns True when
+        # the destination was rewritten. An existing destination keeps its
+        # mode, and a symlink is written through to the file it points at.
+        if os.path.exists(destination): destination=os.path.realpath(destination)
+        temp_destination="%s.%s.tmp" % (destination,os.getpid())
+        directory=os.path.dirname(destination)
+        if directory != "" and not os.path.isdir(directory): os.makedirs(directory)
+        try:
+            with open(temp_destination,'wb' if binary else 'w',buffering=1024*1024) as outfile:
+                write(outfile)
+            if os.path.isfile(destination):
+                if not self.force and filecmp.cmp(temp_destination,destination,shallow=False):
+                    os.remove(temp_destination)
+                    self.timings.count("files unchanged")
+                    return False
+                shutil.copymode(destination,temp_destination)
+            self.timings.count("files written")
+            self.timings.count("bytes written",os.path.getsize(temp_destination))
+            if hasattr(os,'replace'): os.replace(temp_destination,destination)
+            else: os.rename(temp_destination,destination)
+        except:
+            if os.path.isfile(temp_destination): os.remove(temp_destination)
+            raise
+        return True
+
+    def write_template(self,template,destination,**context):
+        # Streams the render straight to disk so memory use does not grow
+        # with the size of the output.
+        return self.write_output(destination,lambda outfile: template.stream(**context).dump(outfile))
+
+    def input_hash(self,path):
+        # Each input is hashed once per run, for the inventory cache and the
+        # manifest alike
+        if path not in self.input_file_hashes: self.input_file_hashes[path]=file_hash(path)
+        return self.input_file_hashes[path]
+
+    def input_hashes(self,template_files):
+        # Content hashes of everything that feeds the rendered output
+        arguments=[version,self.provider,self.start_port,self.port_gap,self.synced_folder,
+                   self.generate_ansible_hostfile,self.create_mgmt_device,self.create_mgmt_network,
+                   self.create_mgmt_configs_only,self.templates,self.arg_string,self.customer]
+        hashes={'topology':self.input_hash(self.topology_file),
+                'arguments':hashlib.sha1(json.dumps(arguments).encode('utf-8')).hexdigest(),
+                'templates':dict((path,file_hash(path)) for path in template_files)}
+        if self.node_table is not None: hashes['node_table']=self.input_hash(self.node_table)
+        return hashes
+
+    def cache_key(self):
+        # Everything parse() depends on: the topology (and node table), the
+        # options it reads, the allocation state it reuses and the converter
+        # itself, so an upgraded or edited converter never sees stale data.
+        # Config files named in the topology are only known once it has been
+        # parsed, so they are checked separately by read_cache().
+        state_path=None
+        if self.state_file is not None: state_path=self.output_path(self.state_file)
+        inputs=[inventory_cache_format,version,self.input_hash(os.path.abspath(__file__)),
+                self.input_hash(self.topology_file),self.node_table and self.input_hash(self.node_table),
+                state_path,state_path and os.path.isfile(state_path) and file_hash(state_path),
+                self.provider,self.start_port,self.port_gap,self.create_mgmt_device,self.create_mgmt_network,
+                self.hypervisors,self.verbose,self.diff_file is not None]
+        return hashlib.sha1(json.dumps(inputs).encode('utf-8')).hexdigest()
+
+    def cached_parse(self):
+        # parse(), or its result from the previous run when none of its inputs
+        # changed. The cache holds the inventory together with the allocations
+        # and warnings made while parsing and the output printed meanwhile,
+        # which is replayed so a cached run looks the same as a full one.
+        if not self.inventory_cache: return self.parse()
+        key=self.cache_key()
+        if not self.force:
+            inventory=self.read_cache(key)
+            self.timings.mark("read inventory cache")
+            if inventory is not None: return inventory
+        recorder=OutputRecorder(sys.stdout)
+        sys.stdout=recorder
+        try:
+            inventory=self.parse()
+        finally:
+            sys.stdout=recorder.stream
+        self.write_cache(key,inventory,recorder.getvalue())
+        self.timings.mark("write inventory cache")
+        return inventory
+
+    def config_exists(self,path):
+        # os.path.isfile() for the config attribute of a node, remembered so
+        # a cached inventory is only reused while the answers still hold
+        exists=os.path.isfile(path)
+        self.config_files[os.path.abspath(path)]=exists
+        return exists
+
+    def read_cache(self,key):
+        # Returns the cached inventory, or None when there is no usable cache.
+        # The cache is plain text: the key, then the config files checked
+        # while parsing, then the data as JSON, so a stale cache is rejected
+        # without reading the rest of it and nothing in it is ever executed.
+        try:
+            with open(self.output_path(inventory_cache_file),'r') as cache:
+                if cache.readline().rstrip('\n') != key: return None
+                config_files=json.loads(cache.readline())
+                if any(os.path.isfile(path) != exists for path,exists in config_files.items()): return None
+                cached=json.load(cache)
+        except Exception as e:
+            if self.verbose and os.path.exists(self.output_path(inventory_cache_file)):
+                print("  INFO: ignoring unreadable inventory cache %s (%s)" % (self.output_path(inventory_cache_file),e))
+            return None
+        sys.stdout.write(cached['output'])
+        for name in cached_attributes:
+            setattr(self,name,cached[name])
+        self.net_numbers=NetNumberAllocator.from_cached(self.net_numbers)
+        self.config_files=config_files
+        self.timings.count("nodes",self.topology_size[0])
+        self.timings.count("edges",self.topology_size[1])
+        inventory=cached['inventory']
+        for device in inventory:
+            interfaces=inventory[device]['interfaces']
+            for name in interfaces: interfaces[name]=Interface.from_cached(interfaces[name])
+        return inventory
+
+    def write_cache(self,key,inventory,output):
+        cached=dict((name,getattr(self,name)) for name in cached_attributes)
+        cached['net_numbers']=self.net_numbers.cached()
+        cached['inventory']=dict((device,dict(inventory[device],interfaces=dict((name,interface.cached()) for name,interface in inventory[device]['interfaces'].items())))
+                                 for device in inventory)
+        cached['output']=output
+        def write(outfile):
+            outfile.write(key+"\n")
+            outfile.write(json.dumps(self.config_files,sort_keys=True)+"\n")
+            json.dump(cached,outfile,separators=(',',':'))
+        self.write_output(self.output_path(inventory_cache_file),write)
+
+    def check_manifest(self,template_files):
+        # When the topology, arguments and templates all match the manifest of
+        # the previous run, reuse its epoch_time so the rendered output comes
+        # out identical and write_output() can leave it untouched.
+        self.manifest=self.input_hashes(template_files)
+        if self.force: return
+        try:
+            with open(self.output_path(manifest_file),'r') as manifest:
+                previous=json.load(manifest)
+        except (IOError,OSError,ValueError):
+            return
+        if all(previous.get(key) == self.manifest[key] for key in self.manifest):
+            if self.verbose: print("Inputs are unchanged since the last run, reusing epoch_time " + str(previous['epoch_time']))
+            self.epoch_time=previous['epoch_time']
+
+    def write_manifest(self):
+        if self.manifest is None: return
+        self.manifest['epoch_time']=self.epoch_time
+        self.write_output(self.output_path(manifest_file),
+                          lambda outfile: outfile.write(json.dumps(self.manifest,indent=2,sort_keys=True)+"\n"))
+
+    def mac_fetch(self,hostname,interface):
+        saved_mac=self.saved_macs.pop(hostname+","+interface,None)
+        if saved_mac is not None:
+            if self.verbose: print("    Reusing saved MAC ADDRESS: \"%s\"" % saved_mac)
+            return self.add_mac_colon(saved_mac)
+        new_mac = "%012x" % self.mac_allocator.fetch()
+        self.timings.count("MACs allocated")
+        if self.verbose: print("    Fetched new MAC ADDRESS: \"%s\"" % new_mac)
+        return self.add_mac_colon(new_mac)
+
+    def mac_fetch_block(self,interfaces):
+        # Bulk version of mac_fetch() for loops that know which interfaces
+        # they are about to create, takes a list of (hostname,interface).
+        saved_macs=[self.saved_macs.pop(hostname+","+interface,None) for hostname,interface in interfaces]
+        count=saved_macs.count(None)
+        self.timings.count("MACs allocated",count)
+        fetched=iter(["%012x" % mac for mac in self.mac_allocator.fetch_block(count)])
+        new_macs=[]
+        for saved_mac in saved_macs:
+            if saved_mac is None: new_macs.append(next(fetched))
+            else: new_macs.append(saved_mac)
+        if self.verbose: print("    Fetched %s new MAC ADDRESSES: %s" % (count,new_macs))
+        return [self.add_mac_colon(new_mac) for new_mac in new_macs]
+
+    def load_state(self):
+        # Reads the allocations saved by a previous run so links keep their
+        # net_number (and with it their libvirt UDP ports), interfaces keep
+        # their MACs and devices keep their oob-mgmt-switch port and mgmt_ip.
+        if self.state_file is None: return
+        state_path=self.output_path(self.state_file)
+        if not os.path.isfile(state_path): return
+        try:
+            with open(state_path,'r') as state:
+                self.saved_state=json.load(state)
+        except ValueError:
+            raise conversion_error(" ### ERROR: allocation state file \"" + state_path + "\" is not valid JSON.")
+        if self.verbose: print("Loaded allocation state from " + state_path)
+        saved_links=self.saved_state.get('links',{})
+        for key in list(saved_links):
+            if not isinstance(saved_links[key],dict): del saved_links[key]
+        self.net_numbers=NetNumberAllocator(dict((key,saved_links[key].get('net_number')) for key in saved_links))
+        for interface,mac in sorted(self.saved_state.get('macs',{}).items()):
+            #Saved MACs now pinned to another interface are handed out fresh
+            if self.mac_allocator.reserve(mac): self.saved_macs[interface]=mac.replace(':','')
+
+    def save_state(self):
+        if self.state_file is None: return
+        if '' in self.mac_map: del self.mac_map['']
+        links={}
+        for key in self.net_numbers.assigned:
+            links[key]={'net_number':self.net_numbers.assigned[key],'left':self.link_lefts[key]}
+            if key in self.link_ports: links[key]['ports']=self.link_ports[key]
+        state={'version':version,
+               'links':links,
+               'macs':dict((self.mac_map[mac],mac) for mac in self.mac_map),
+               'mgmt_ports':self.mgmt_ports,
+               'mgmt_ips':self.mgmt_ips,
+               'unconnected_ports':self.unconnected_ports,
+               'devices':self.device_definitions}
+        self.write_output(self.output_path(self.state_file),
+                          lambda outfile: outfile.write(json.dumps(state,indent=2,sort_keys=True)+"\n"))
+
+    def diff_state(self):
+        # Compares the VM definitions of this run with those saved in the
+        # state file given to --diff, before that file can be overwritten.
+        if self.diff_file is None: return None
+        try:
+            with open(self.diff_file,'r') as previous_state:
+                previous=json.load(previous_state)
+        except (IOError,OSError):
+            raise conversion_error(" ### ERROR: previous state file \"" + self.diff_file + "\" could not be read.")
+        except ValueError:
+            raise conversion_error(" ### ERROR: previous state file \"" + self.diff_file + "\" is not valid JSON.")
+        if 'devices' not in previous:
+            raise conversion_error(" ### ERROR: previous state file \"" + self.diff_file + "\" has no device definitions, it must be written by --state-file.")
+        report=diff_devices(previous['devices'],self.device_definitions)
+        report['previous_state']=self.diff_file
+        if self.diff_json is not None:
+            self.write_output(self.diff_json,lambda outfile: outfile.write(json.dumps(report,indent=2,sort_keys=True)+"\n"))
+        return report
+
+    def print_diff(self,report):
+        if report is None: return
+        print(styles.HEADER + styles.BOLD + "\nCHANGES SINCE %s:" % report['previous_state'] + styles.ENDC)
+        print("    added:     %s" % (" ".join(report['added']) or "(none)"))
+        print("    removed:   %s" % (" ".join(report['removed']) or "(none)"))
+        print("    unchanged: %s" % report['unchanged'])
+        for device in report['reload']:
+            changes=[]
+            if report['changed'][device]['attributes']: changes.append("attributes: " + ", ".join(report['changed'][device]['attributes']))
+            if report['changed'][device]['interfaces']: changes.append("interfaces: " + ", ".join(report['changed'][device]['interfaces']))
+            print("    changed:   %s (%s)" % (device,"; ".join(changes)))
+        print(styles.BOLD + "    VMs to reload: %s" % (" ".join(report['reload']) or "(none)") + styles.ENDC)
+
+    def mgmt_switch_ports(self,mgmt_devices):
+        # oob-mgmt-switch port number for each device, swp1 is the link to the
+        # oob-mgmt-server. Devices keep the port saved in the allocation state,
+        # the others take the lowest free ports in order.
+        saved_ports=self.saved_state.get('mgmt_ports',{})
+        used=RangeSet()
+        used.add(1)
+        for device in mgmt_devices:
+            port=saved_ports.get(device)
+            if isinstance(port,int) and port > 1 and used.add(port): self.mgmt_ports[device]=port
+        next_port=2
+        for device in mgmt_devices:
+            if device in self.mgmt_ports: continue
+            next_port=used.next_free(next_port)
+            used.add(next_port)
+            self.mgmt_ports[device]=next_port
+        return [self.mgmt_ports[device] for device in mgmt_devices]
+
+    def add_mac_colon(self,mac_address):
+        if self.verbose: print("MAC ADDRESS IS: \"%s\"" % mac_address)
+        return ':'.join(map(''.join, zip(*[iter(mac_address)]*2)))
+
+    def add_node(self,inventory,node_name,node_attr_list):
+        node_name=intern(node_name.replace('"',''))
         if node_name.startswith(".") or node_name.startswith("-"):
-            print(styles.FAIL + styles.BOLD + " ### ERROR: Node name cannot start with a hyphen or period. '%s' is not valid!\n"%(node_name) + styles.ENDC)
-            exit(1)
+            raise conversion_error(" ### ERROR: Node name cannot start with a hyphen or period. '%s' is not valid!\n"%(node_name))
         reg=re.compile('^[A-Za-z0-9\.-]+$')
         if not reg.match(node_name):
-            print(styles.FAIL + styles.BOLD + " ### ERROR: Node name for the VM should only contain letters, numbers, hyphens or dots. It cannot start with a hyphen or dot.  '%s' is not valid!\n"%(node_name) + styles.ENDC)
-            exit(1)
+            raise conversion_error(" ### ERROR: Node name for the VM should only contain letters, numbers, hyphens or dots. It cannot start with a hyphen or dot.  '%s' is not valid!\n"%(node_name))
 
         #Try to encode into ascii
         try:
             node_name.encode('ascii','ignore')
         except UnicodeDecodeError as e:
-            print(styles.FAIL + styles.BOLD + " ### ERROR: Node name \"%s\" --> \"%s\" has hidden unicode characters in it which prevent it from being converted to Ascii cleanly. Try manually typing it instead of copying and pasting." % (node_name,re.sub(r'[^\x00-\x7F]+',' ', node_name)) + styles.ENDC)
-            exit(1)
+            raise conversion_error(" ### ERROR: Node name \"%s\" --> \"%s\" has hidden unicode characters in it which prevent it from being converted to Ascii cleanly. Try manually typing it instead of copying and pasting." % (node_name,re.sub(r'[^\x00-\x7F]+',' ', node_name)))
 
         if node_name not in inventory:
             inventory[node_name] = {}
             inventory[node_name]['interfaces'] = {}
-        node_attr_list=node.get_attributes()
 
         #Define Functional Defaults
         if 'function' in node_attr_list:
-            value=node.get('function')
+            value=node_attr_list['function']
             if value.startswith('"') or value.startswith("'"): value=value[1:].lower()
             if value.endswith('"') or value.endswith("'"): value=value[:-1].lower()
 
@@ -261,696 +1590,1308 @@ def parse_topology(topology_file):
                 inventory[node_name]['memory']="512"
                 inventory[node_name]['config'] = "./helper_scripts/extra_server_config.sh"
 
-        if provider == 'libvirt' and 'pxehost' in node_attr_list:
-            if node.get('pxehost').replace('"','') == "True": inventory[node_name]['os']="N/A (PXEBOOT)"
+        if self.provider == 'libvirt' and 'pxehost' in node_attr_list:
+            if node_attr_list['pxehost'].replace('"','') == "True": inventory[node_name]['os']="N/A (PXEBOOT)"
 
         #Add attributes to node inventory
         for attribute in node_attr_list:
-            if verbose: print(attribute + " = " + node.get(attribute))
-            value=node.get(attribute)
+            if self.verbose: print(attribute + " = " + node_attr_list[attribute])
+            value=node_attr_list[attribute]
             if value.startswith('"') or value.startswith("'"): value=value[1:]
             if value.endswith('"') or value.endswith("'"): value=value[:-1]
             inventory[node_name][attribute] = value
-            if (attribute == "config") and (not os.path.isfile(value)):
-                warning.append(styles.WARNING + styles.BOLD + "    WARNING: Node \""+node_name+"\" Config file for device does not exist" + styles.ENDC)
+            if (attribute == "config") and (not self.config_exists(value)):
+                self.warning.append(styles.WARNING + styles.BOLD + "    WARNING: Node \""+node_name+"\" Config file for device does not exist" + styles.ENDC)
 
-        if provider == 'libvirt':
+        if self.provider == 'libvirt':
             if 'os' in inventory[node_name]:
                 if inventory[node_name]['os'] =='boxcutter/ubuntu1604' or inventory[node_name]['os'] =='bento/ubuntu-16.04' or inventory[node_name]['os'] =='ubuntu/xenial64':
-                    print(styles.FAIL + styles.BOLD + " ### ERROR: device " + node_name + " -- Incompatible OS for libvirt provider.")
-                    print("              Do not attempt to use a mutated image for Ubuntu16.04 on Libvirt")
-                    print("              use an ubuntu1604 image which is natively built for libvirt")
-                    print("              like yk0/ubuntu-xenial.")
-                    print("              See https://github.com/CumulusNetworks/topology_converter/tree/master/documentation#vagrant-box-selection")
-                    print("              See https://github.com/vagrant-libvirt/vagrant-libvirt/issues/607")
-                    print("              See https://github.com/vagrant-libvirt/vagrant-libvirt/issues/609" + styles.ENDC)
-                    exit(1)
+                    raise conversion_error(" ### ERROR: device " + node_name + " -- Incompatible OS for libvirt provider.\n"
+                                           "              Do not attempt to use a mutated image for Ubuntu16.04 on Libvirt\n"
+                                           "              use an ubuntu1604 image which is natively built for libvirt\n"
+                                           "              like yk0/ubuntu-xenial.\n"
+                                           "              See https://github.com/CumulusNetworks/topology_converter/tree/master/documentation#vagrant-box-selection\n"
+                                           "              See https://github.com/vagrant-libvirt/vagrant-libvirt/issues/607\n"
+                                           "              See https://github.com/vagrant-libvirt/vagrant-libvirt/issues/609")
 
         #Make sure mandatory attributes are present.
         mandatory_attributes=['os',]
         for attribute in mandatory_attributes:
             if attribute not in inventory[node_name]:
-                print(styles.FAIL + styles.BOLD + " ### ERROR: MANDATORY DEVICE ATTRIBUTE \""+attribute+"\" not specified for "+ node_name + styles.ENDC)
-                exit(1)
+                raise conversion_error(" ### ERROR: MANDATORY DEVICE ATTRIBUTE \""+attribute+"\" not specified for "+ node_name)
 
         #Extra Massaging for specific attributes.
         #   light sanity checking.
         if 'function' not in inventory[node_name]: inventory[node_name]['function'] = "Unknown"
         if 'memory' in inventory[node_name]:
             if int(inventory[node_name]['memory']) <= 0:
-                print(styles.FAIL + styles.BOLD + " ### ERROR -- Memory must be greater than 0mb on " + node_name + styles.ENDC)
-                exit(1)
-        if provider == "libvirt":
-            if 'tunnel_ip' not in inventory[node_name]: inventory[node_name]['tunnel_ip']='127.0.0.1'
-
-
-    #Add All the Edges to Inventory
-    net_number = 1
-    for edge in edges:
-        #if provider=="virtualbox":
-        network_string="net"+str(net_number)
-
-        #elifprovider=="libvirt":
-        PortA=str(start_port+net_number)
-        PortB=str(start_port+port_gap+net_number)
-
-
-        #Set Devices/interfaces/MAC Addresses
-        left_device=edge.get_source().split(":")[0].replace('"','')
-        left_interface=edge.get_source().split(":")[1].replace('"','')
-        if "/" in left_interface:
-            new_left_interface = left_interface.replace('/','-')
-            warning.append(styles.WARNING + styles.BOLD + "    WARNING: Device %s interface %s has bad characters altering to this %s."%(left_device,left_interface,new_left_interface) + styles.ENDC)
-            left_interface = new_left_interface
-        right_device=edge.get_destination().split(":")[0].replace('"','')
-        right_interface=edge.get_destination().split(":")[1].replace('"','')
-        if "/" in right_interface:
-            new_right_interface = right_interface.replace('/','-')
-            warning.append(styles.WARNING + styles.BOLD + "    WARNING: Device %s interface %s has bad characters altering to this %s."%(right_device,right_interface,new_right_interface) + styles.ENDC)
-            right_interface = new_right_interface
-
-        for value in [left_device,left_interface,right_device,right_interface]:
-            #Try to encode into ascii
-            try:
-                value.encode('ascii','ignore')
-            except UnicodeDecodeError as e:
-                print(styles.FAIL + styles.BOLD + " ### ERROR: in line --> \"%s\":\"%s\" -- \"%s\":\"%s\"\n        Link component: \"%s\" has hidden unicode characters in it which prevent it from being converted to Ascii cleanly. Try manually typing it instead of copying and pasting." % (left_device,left_interface,right_device,right_interface,re.sub(r'[^\x00-\x7F]+',' ', value)) + styles.ENDC)
-                exit(1)
-
-
-        left_mac_address=""
-        if edge.get('left_mac') != None :
-            temp_left_mac=edge.get('left_mac').replace('"','').replace(':','').lower()
-            left_mac_address=add_mac_colon(temp_left_mac)
-        else: left_mac_address=mac_fetch(left_device,left_interface)
-        right_mac_address=""
-        if edge.get('right_mac') != None :
-            temp_right_mac=edge.get('right_mac').replace('"','').replace(':','').lower()
-            right_mac_address=add_mac_colon(temp_right_mac)
-        else: right_mac_address=mac_fetch(right_device,right_interface)
-
-        #Check to make sure each device in the edge already exists in inventory
-        if left_device not in inventory:
-            print(styles.FAIL + styles.BOLD + " ### ERROR: device " + left_device + " is referred to in list of edges/links but not defined as a node." + styles.ENDC)
-            exit(1)
-        if right_device not in inventory:
-            print(styles.FAIL + styles.BOLD + " ### ERROR: device " + right_device + " is referred to in list of edges/links but not defined as a node." + styles.ENDC)
-            exit(1)
-
-        #Adds link to inventory datastructure
-        add_link(inventory,
-                 left_device,
-                 right_device,
-                 left_interface,
-                 right_interface,
-                 left_mac_address,
-                 right_mac_address,
-                 net_number,)
-
-        #Handle Link-based Passthrough Attributes
-        edge_attributes={}
-        for attribute in edge.get_attributes():
-            if attribute=="left_mac" or attribute=="right_mac": continue
-            if attribute in edge_attributes:
-                warning.append(styles.WARNING + styles.BOLD + "    WARNING: Attribute \""+attribute+"\" specified twice. Using second value." + styles.ENDC)
-            value=edge.get(attribute)
-            if value.startswith('"') or value.startswith("'"): value=value[1:]
-            if value.endswith('"') or value.endswith("'"): value=value[:-1]
-            if attribute.startswith('left_'):
-                inventory[left_device]['interfaces'][left_interface][attribute[5:]]=value
-            elif attribute.startswith('right_'):
-                inventory[right_device]['interfaces'][right_interface][attribute[6:]]=value
+                raise conversion_error(" ### ERROR -- Memory must be greater than 0mb on " + node_name)
+        if self.provider == "libvirt":
+            if 'tunnel_ip' not in inventory[node_name]:
+                inventory[node_name]['tunnel_ip']='127.0.0.1'
+                self.unplaced_devices.append(node_name)
+
+    def build_inventory(self,records):
+        # Nodes go straight into the inventory as they are read. Edges are kept as
+        # light (source, destination, attributes) tuples because a link may be
+        # listed before the nodes it refers to.
+        inventory = {}
+        edges = []
+        for record in records:
+            if record[0] == 'node':
+                self.add_node(inventory,record[1],record[2])
             else:
-                inventory[left_device]['interfaces'][left_interface][attribute]=value
-                inventory[right_device]['interfaces'][right_interface][attribute]=value
-                #edge_attributes[attribute]=value
-        net_number += 1
-
-    #Remove PXEbootinterface attribute from hosts which are not set to PXEboot=True
-    for device in inventory:
-        count=0
-        for link in inventory[device]['interfaces']:
-            if 'pxebootinterface' in inventory[device]['interfaces'][link]:
-                count += 1 #increment count to make sure more than one interface doesn't try to set nicbootprio
-                if 'pxehost' not in inventory[device]: del inventory[device]['interfaces'][link]['pxebootinterface']
-                elif 'pxehost' in inventory[device]:
-                    if inventory[device]['pxehost'] != "True": del inventory[device]['interfaces'][link]['pxebootinterface']
-    #Make sure no host has PXEbootinterface set more than once
-    # Have to make two passes here because doing it in one pass could have
-    # side effects.
-    for device in inventory:
-        count=0
-        for link in inventory[device]['interfaces']:
-            if 'pxebootinterface' in inventory[device]['interfaces'][link]:
-                count += 1 #increment count to make sure more than one interface doesn't try to set nicbootprio
-        if count > 1:
-            print(styles.FAIL + styles.BOLD + " ### ERROR -- Device " + device + " sets pxebootinterface more than once." + styles.ENDC)
-            exit(1)
-
-    #######################
-    #Add Mgmt Network Links
-    #######################
-    if create_mgmt_device:
-        mgmt_server=None
-        mgmt_switch=None
-        # Look for Managment Server/Switch
+                edges.append(record[1:])
+        return inventory, edges
+
+    def lint(self):
+        # The checks parse() makes while reading the topology, without
+        # allocating or rendering anything. Returns the inventory and edges.
+        inventory, edges = self.read_inventory()
+        for source, destination, attributes in edges:
+            self.check_link_device(inventory,source.split(":")[0].replace('"',''))
+            self.check_link_device(inventory,destination.split(":")[0].replace('"',''))
+        return inventory, edges
+
+    def check_link_device(self,inventory,device):
+        if device not in inventory:
+            raise conversion_error(" ### ERROR: device " + device + " is referred to in list of edges/links but not defined as a node.")
+
+    def read_inventory(self):
+        # Builds the inventory from whichever topology format was given
+        format=topology_format(self.topology_file)
+        if format != 'dot':
+            records=read_structured_records(self.topology_file,self.node_table)
+            if self.timings.enabled: records=list(records)
+            self.timings.mark("parse topology (%s)" % format)
+            inventory, edges = self.build_inventory(records)
+            self.timings.mark("node loop")
+            return inventory, edges
+
+        warning_count=len(self.warning)
+        unplaced_count=len(self.unplaced_devices)
+        try:
+            records=read_dot_records(self.topology_file)
+            # Reading ahead separates parsing from the node loop in --timings
+            if self.timings.enabled: records=list(records)
+            self.timings.mark("parse topology (native, with lint)")
+            inventory, edges = self.build_inventory(records)
+        except DotSyntaxUnsupported as e:
+            if self.verbose: print("  INFO: %s -- falling back to the pydotplus parser." % e)
+            del self.warning[warning_count:]
+            del self.unplaced_devices[unplaced_count:]
+            self.timings.mark("native parser (unsupported syntax)")
+            lint_topo_file(self.topology_file)
+            self.timings.mark("lint_topo_file")
+            records=read_dot_records_pydotplus(self.topology_file)
+            if self.timings.enabled: records=list(records)
+            self.timings.mark("parse topology (pydotplus)")
+            inventory, edges = self.build_inventory(records)
+        self.timings.mark("node loop")
+        return inventory, edges
+
+    def parse(self):
+        inventory, edges = self.read_inventory()
+        self.topology_size=(len(inventory),len(edges))
+        self.timings.count("nodes",len(inventory))
+        self.timings.count("edges",len(edges))
+
+        if self.hypervisors:
+            self.place_devices(inventory,edges)
+            self.timings.mark("place devices")
+
+
+        #Reserve user specified MACs so generated ones never collide with them
+        for source, destination, attributes in edges:
+            for attribute in ('left_mac','right_mac'):
+                if attributes.get(attribute) != None: self.mac_allocator.reserve(attributes[attribute])
+
+        self.load_state()
+        self.timings.mark("reserve MACs, load state")
+
+        #Add All the Edges to Inventory
+        net_number = 1
+        #Interfaces given a pxebootinterface, by device
+        pxeboot_interfaces={}
+        for source, destination, attributes in edges:
+            #if provider=="virtualbox":
+            network_string="net"+str(net_number)
+
+            #elifprovider=="libvirt":
+            PortA=str(self.start_port+net_number)
+            PortB=str(self.start_port+self.port_gap+net_number)
+
+
+            #Set Devices/interfaces/MAC Addresses
+            left_device=source.split(":")[0].replace('"','')
+            left_interface=source.split(":")[1].replace('"','')
+            if "/" in left_interface:
+                new_left_interface = left_interface.replace('/','-')
+                self.warning.append(styles.WARNING + styles.BOLD + "    WARNING: Device %s interface %s has bad characters altering to this %s."%(left_device,left_interface,new_left_interface) + styles.ENDC)
+                left_interface = new_left_interface
+            right_device=destination.split(":")[0].replace('"','')
+            right_interface=destination.split(":")[1].replace('"','')
+            if "/" in right_interface:
+                new_right_interface = right_interface.replace('/','-')
+                self.warning.append(styles.WARNING + styles.BOLD + "    WARNING: Device %s interface %s has bad characters altering to this %s."%(right_device,right_interface,new_right_interface) + styles.ENDC)
+                right_interface = new_right_interface
+
+            for value in [left_device,left_interface,right_device,right_interface]:
+                #Try to encode into ascii
+                try:
+                    value.encode('ascii','ignore')
+                except UnicodeDecodeError as e:
+                    raise conversion_error(" ### ERROR: in line --> \"%s\":\"%s\" -- \"%s\":\"%s\"\n        Link component: \"%s\" has hidden unicode characters in it which prevent it from being converted to Ascii cleanly. Try manually typing it instead of copying and pasting." % (left_device,left_interface,right_device,right_interface,re.sub(r'[^\x00-\x7F]+',' ', value)))
+
+
+            left_mac_address=""
+            if attributes.get('left_mac') != None :
+                temp_left_mac=attributes['left_mac'].replace('"','').replace(':','').lower()
+                left_mac_address=self.add_mac_colon(temp_left_mac)
+            else: left_mac_address=self.mac_fetch(left_device,left_interface)
+            right_mac_address=""
+            if attributes.get('right_mac') != None :
+                temp_right_mac=attributes['right_mac'].replace('"','').replace(':','').lower()
+                right_mac_address=self.add_mac_colon(temp_right_mac)
+            else: right_mac_address=self.mac_fetch(right_device,right_interface)
+
+            #Check to make sure each device in the edge already exists in inventory
+            self.check_link_device(inventory,left_device)
+            self.check_link_device(inventory,right_device)
+
+            #Adds link to inventory datastructure
+            key=link_key(left_device,left_interface,right_device,right_interface)
+            if self.saved_state.get('links',{}).get(key,{}).get('left') == right_device+":"+right_interface:
+                #Link was written the other way round when it was saved, keep its UDP port direction
+                self.add_link(inventory,
+                         right_device,
+                         left_device,
+                         right_interface,
+                         left_interface,
+                         right_mac_address,
+                         left_mac_address,
+                         self.net_numbers.assign(key,net_number),)
+            else:
+                self.add_link(inventory,
+                         left_device,
+                         right_device,
+                         left_interface,
+                         right_interface,
+                         left_mac_address,
+                         right_mac_address,
+                         self.net_numbers.assign(key,net_number),)
+
+            #Handle Link-based Passthrough Attributes
+            edge_attributes={}
+            for attribute in attributes:
+                if attribute=="left_mac" or attribute=="right_mac": continue
+                if attribute in edge_attributes:
+                    self.warning.append(styles.WARNING + styles.BOLD + "    WARNING: Attribute \""+attribute+"\" specified twice. Using second value." + styles.ENDC)
+                value=attributes[attribute]
+                if value.startswith('"') or value.startswith("'"): value=value[1:]
+                if value.endswith('"') or value.endswith("'"): value=value[:-1]
+                if attribute.startswith('left_'):
+                    ends=[(left_device,left_interface,attribute[5:])]
+                elif attribute.startswith('right_'):
+                    ends=[(right_device,right_interface,attribute[6:])]
+                else:
+                    ends=[(left_device,left_interface,attribute),(right_device,right_interface,attribute)]
+                    #edge_attributes[attribute]=value
+                for device,interface,name in ends:
+                    inventory[device]['interfaces'][interface][name]=value
+                    if name == 'pxebootinterface': pxeboot_interfaces.setdefault(device,set()).add(interface)
+            net_number += 1
+
+        # One pass over the devices, working from what the edge loop indexed
+        # instead of rescanning every interface:
+        #   -only PXE hosts keep pxebootinterface, and on one interface at most
+        #   -the oob devices and the switches with a "ports" range are noted
+        #    for the mgmt network and port range steps below
+        devices_by_function={}
+        port_range_devices=[]
         for device in inventory:
-            if inventory[device]["function"] == "oob-switch": mgmt_switch=device
-            elif inventory[device]["function"] == "oob-server": mgmt_server=device
-
-        if verbose:
-            print(" detected mgmt_server: %s" % mgmt_server)
-            print("          mgmt_switch: %s" % mgmt_switch)
-        # Hardcode mgmt server parameters
-        if mgmt_server == None:
-            if "oob-mgmt-server" in inventory:
-                print(styles.FAIL + styles.BOLD + ' ### ERROR: oob-mgmt-server must be set to function = "oob-server"' + styles.ENDC)
-                exit(1)
-            inventory["oob-mgmt-server"] = {}
-            inventory["oob-mgmt-server"]["function"] = "oob-server"
-
-            intf = ipaddress.ip_interface(u'192.168.200.254/24')
-
-            inventory["oob-mgmt-server"]["interfaces"] = {}
-            mgmt_server="oob-mgmt-server"
-            if provider == "libvirt":
-                if 'tunnel_ip' not in inventory["oob-mgmt-server"]: inventory["oob-mgmt-server"]['tunnel_ip']='127.0.0.1'
-
-            inventory["oob-mgmt-server"]["mgmt_ip"] = ("%s"%intf.ip)
-            inventory["oob-mgmt-server"]["mgmt_network"] = ("%s"%intf.network[0])
-            inventory["oob-mgmt-server"]["mgmt_cidrmask"] = ("/%s"%intf.network.prefixlen)
-            inventory["oob-mgmt-server"]["mgmt_netmask"] = ("%s"%intf.netmask)
-            mgmt_server == "oob-mgmt-server"
+            devices_by_function.setdefault(inventory[device]["function"],[]).append(device)
+            if "ports" in inventory[device] and inventory[device]["function"] in network_functions: port_range_devices.append(device)
+            if device not in pxeboot_interfaces: continue
+            if inventory[device].get('pxehost') != "True":
+                for link in pxeboot_interfaces[device]:
+                    del inventory[device]['interfaces'][link]['pxebootinterface']
+            elif len(pxeboot_interfaces[device]) > 1:
+                raise conversion_error(" ### ERROR -- Device " + device + " sets pxebootinterface more than once.")
+
+        self.timings.mark("edge loop")
+
+        #######################
+        #Add Mgmt Network Links
+        #######################
+        if self.create_mgmt_device:
+            import ipaddress
+            # Look for Managment Server/Switch, the last one listed wins
+            mgmt_server=(devices_by_function.get("oob-server") or [None])[-1]
+            mgmt_switch=(devices_by_function.get("oob-switch") or [None])[-1]
+
+            if self.verbose:
+                print(" detected mgmt_server: %s" % mgmt_server)
+                print("          mgmt_switch: %s" % mgmt_switch)
+            # Hardcode mgmt server parameters
+            if mgmt_server == None:
+                if "oob-mgmt-server" in inventory:
+                    raise conversion_error(' ### ERROR: oob-mgmt-server must be set to function = "oob-server"')
+                inventory["oob-mgmt-server"] = {}
+                inventory["oob-mgmt-server"]["function"] = "oob-server"
 
-        else:
-            if "mgmt_ip" not in inventory[mgmt_server]:
                 intf = ipaddress.ip_interface(u'192.168.200.254/24')
 
+                inventory["oob-mgmt-server"]["interfaces"] = {}
+                mgmt_server="oob-mgmt-server"
+                if self.provider == "libvirt":
+                    if 'tunnel_ip' not in inventory["oob-mgmt-server"]: inventory["oob-mgmt-server"]['tunnel_ip']=self.default_tunnel_ip()
+
+                inventory["oob-mgmt-server"]["mgmt_ip"] = ("%s"%intf.ip)
+                inventory["oob-mgmt-server"]["mgmt_network"] = ("%s"%intf.network[0])
+                inventory["oob-mgmt-server"]["mgmt_cidrmask"] = ("/%s"%intf.network.prefixlen)
+                inventory["oob-mgmt-server"]["mgmt_netmask"] = ("%s"%intf.netmask)
+                mgmt_server == "oob-mgmt-server"
+
             else:
-                if "/" in inventory[mgmt_server]["mgmt_ip"]:
-                    intf = ipaddress.ip_interface(unicode(inventory[mgmt_server]["mgmt_ip"]))
+                if "mgmt_ip" not in inventory[mgmt_server]:
+                    intf = ipaddress.ip_interface(u'192.168.200.254/24')
 
                 else:
-                    intf = ipaddress.ip_interface(unicode(inventory[mgmt_server]["mgmt_ip"]+"/24"))
+                    if "/" in inventory[mgmt_server]["mgmt_ip"]:
+                        intf = ipaddress.ip_interface(unicode(inventory[mgmt_server]["mgmt_ip"]))
 
-            inventory[mgmt_server]["mgmt_ip"] = ("%s"%intf.ip)
-            inventory[mgmt_server]["mgmt_network"] = ("%s"%intf.network[0])
-            inventory[mgmt_server]["mgmt_cidrmask"] = ("/%s"%intf.network.prefixlen)
-            inventory[mgmt_server]["mgmt_netmask"] = ("%s"%intf.netmask)
+                    else:
+                        intf = ipaddress.ip_interface(unicode(inventory[mgmt_server]["mgmt_ip"]+"/24"))
 
-        try:
-            inventory[mgmt_server]["mgmt_dhcp_start"] = ("%s"%intf.network[10])
-            inventory[mgmt_server]["mgmt_dhcp_stop"] = ("%s"%intf.network[50])
-        except IndexError:
-            print(styles.FAIL + styles.BOLD + " ### ERROR: Prefix Length on the Out Of Band Server is not big enough to support usage of the 10th-50th IP addresses being used for DHCP")
-            exit(1)
+                inventory[mgmt_server]["mgmt_ip"] = ("%s"%intf.ip)
+                inventory[mgmt_server]["mgmt_network"] = ("%s"%intf.network[0])
+                inventory[mgmt_server]["mgmt_cidrmask"] = ("/%s"%intf.network.prefixlen)
+                inventory[mgmt_server]["mgmt_netmask"] = ("%s"%intf.netmask)
 
+            mgmt_pool=AddressPool(intf.network)
+            try:
+                inventory[mgmt_server]["mgmt_dhcp_start"] = ("%s"%mgmt_pool.nth(10))
+                inventory[mgmt_server]["mgmt_dhcp_stop"] = ("%s"%mgmt_pool.nth(50))
+            except IndexError:
+                raise conversion_error(" ### ERROR: Prefix Length on the Out Of Band Server is not big enough to support usage of the 10th-50th IP addresses being used for DHCP")
 
 
-        inventory[mgmt_server]["os"] = "yk0/ubuntu-xenial"
-        if provider=="libvirt":
-            inventory[mgmt_server]["os"] = "yk0/ubuntu-xenial"
-        if "memory" not in inventory[mgmt_server]:
-            inventory[mgmt_server]["memory"] = "512"
-        inventory[mgmt_server]["config"] = "./helper_scripts/auto_mgmt_network/OOB_Server_Config_auto_mgmt.sh"
-
-        # Hardcode mgmt switch parameters
-        if mgmt_switch == None and create_mgmt_network:
-            if "oob-mgmt-switch" in inventory:
-                print(styles.FAIL + styles.BOLD + ' ### ERROR: oob-mgmt-switch must be set to function = "oob-switch"' + styles.ENDC)
-                exit(1)
-            inventory["oob-mgmt-switch"] = {}
-            inventory["oob-mgmt-switch"]["function"] = "oob-switch"
-            inventory["oob-mgmt-switch"]["interfaces"] = {}
-            if provider == "libvirt":
-                if 'tunnel_ip' not in inventory["oob-mgmt-switch"]: inventory["oob-mgmt-switch"]['tunnel_ip']='127.0.0.1'
-
-            mgmt_switch="oob-mgmt-switch"
-
-        if create_mgmt_network:
-            inventory[mgmt_switch]["os"] = "CumulusCommunity/cumulus-vx"
-            inventory[mgmt_switch]["memory"] = "512"
-            inventory[mgmt_switch]["config"] = "./helper_scripts/oob_switch_config.sh"
-
-            #Add Link between oob-mgmt-switch oob-mgmt-server
-            net_number+=1
-            left_mac=mac_fetch(mgmt_switch,"swp1")
-            right_mac=mac_fetch(mgmt_server,"eth1")
-            print("  adding mgmt links:")
-            if provider=="virtualbox":
-               print("    %s:%s (mac: %s) --> %s:%s (mac: %s)     network_string:%s" % (mgmt_switch,"swp1",left_mac,mgmt_server,"eth1",right_mac,network_string))
-            elif provider=="libvirt":
-                print("    %s:%s udp_port %s (mac: %s) --> %s:%s udp_port %s (mac: %s)" % (mgmt_switch,"swp1",left_mac,PortA,mgmt_server,"eth1",PortB,right_mac))
-            add_link(inventory,
-                     mgmt_switch,
-                     mgmt_server,
-                     "swp1",
-                     "eth1",
-                     left_mac,
-                     right_mac,
-                     net_number)
-            mgmt_switch_swp=1
-
-            #Add Eth0 MGMT Link for every device that is is not oob-switch or oob-server
-            for device in inventory:
-                if inventory[device]["function"]=="oob-server" or inventory[device]["function"]=="oob-switch": continue
-                elif inventory[device]["function"] in network_functions:
-                    if "config" not in inventory[device]:
-                        inventory[device]["config"] = "./helper_scripts/extra_switch_config.sh"
-                mgmt_switch_swp+=1
-                net_number+=1
-                if int(PortA) > int(start_port+port_gap) and provider=="libvirt":
-                    print(styles.FAIL + styles.BOLD + " ### ERROR: Configured Port_Gap: ("+str(port_gap)+") exceeds the number of links in the topology. Read the help options to fix.\n\n" + styles.ENDC)
-                    parser.print_help()
-                    exit(1)
-                mgmt_switch_swp_val="swp"+str(mgmt_switch_swp)
-                left_mac=mac_fetch(mgmt_switch,mgmt_switch_swp_val)
-                right_mac=mac_fetch(device,"eth0")
-
-                half1_exists=False
-                half2_exists=False
-                #Check to see if components of the link already exist
-                if "eth0" in inventory[device]['interfaces']:
-                    if inventory[device]['interfaces']['eth0']['remote_interface'] != mgmt_switch_swp_val:
-                        print(styles.FAIL + styles.BOLD + " ### ERROR: %s:eth0 interface already exists but not connected to %s:%s" %(device,mgmt_switch,mgmt_switch_swp_val) + styles.ENDC)
-                        exit(1)
-                    if inventory[device]['interfaces']['eth0']['remote_device'] != mgmt_switch:
-                        print(styles.FAIL + styles.BOLD + " ### ERROR: %s:eth0 interface already exists but not connected to %s:%s" %(device,mgmt_switch,mgmt_switch_swp_val) + styles.ENDC)
-                        exit(1)
-                    if verbose: print("        mgmt link on %s already exists and is good." % (mgmt_switch))
-                    half1_exists=True
-
-                if mgmt_switch_swp_val in inventory[mgmt_switch]['interfaces']:
-                    if inventory[mgmt_switch]['interfaces'][mgmt_switch_swp_val]['remote_interface'] != "eth0":
-                        print(styles.FAIL + styles.BOLD + " ### ERROR: %s:%s-- link already exists but not connected to %s:eth0" %(mgmt_switch,mgmt_switch_swp_val,device) + styles.ENDC)
-                        exit(1)
-                    if inventory[mgmt_switch]['interfaces'][mgmt_switch_swp_val]['remote_device'] != device:
-                        print(styles.FAIL + styles.BOLD + " ### ERROR: %s:%s-- link already exists but not connected to %s:eth0" %(mgmt_switch,mgmt_switch_swp_val,device) + styles.ENDC)
-                        exit(1)
-                    if verbose: print("        mgmt link on %s already exists and is good." % (mgmt_switch))
-                    half2_exists=True
-
-                if not half1_exists and not half2_exists:
-                    #Display add message
-                    if provider=="virtualbox":
-                        print("    %s:%s (mac: %s) --> %s:%s (mac: %s)     network_string:net%s" % (mgmt_switch,mgmt_switch_swp_val,left_mac,device,"eth0",right_mac,net_number))
-                    elif provider=="libvirt":
-                        print("    %s:%s udp_port %s (mac: %s) --> %s:%s udp_port %s (mac: %s)" % (mgmt_switch,mgmt_switch_swp_val,PortA,left_mac,device,"eth0",PortB,right_mac))
-
-                    add_link(inventory,
-                             mgmt_switch,
-                             device,
-                             mgmt_switch_swp_val,
-                             "eth0",
-                             left_mac,
-                             right_mac,
-                             net_number,)
-
-        # Determine Used MGMT IPs
-        print("  MGMT_IP ADDRESS for OOB_SERVER IS: %s%s"%(inventory[mgmt_server]["mgmt_ip"],inventory["oob-mgmt-server"]["mgmt_cidrmask"]))
-        intf = ipaddress.ip_interface(unicode("%s%s"%(inventory[mgmt_server]["mgmt_ip"],inventory["oob-mgmt-server"]["mgmt_cidrmask"])))
-        network = ipaddress.ip_network(unicode("%s"%(intf.network)))
-        acceptable_host_addresses=list(intf.network.hosts())
-        for device in inventory:
-            if 'mgmt_ip' in inventory[device]:
-                node_mgmt_ip=ipaddress.ip_address(unicode(inventory[device]['mgmt_ip']))
-                # Check that Defined Mgmt_IP is in same Subnet as OOB-SERVER
-                if node_mgmt_ip not in network:
-                    print(styles.FAIL + styles.BOLD + " ### ERROR: IP address (%s) is not in the Management Server subnet %s"%(node_mgmt_ip,network))
-                    exit(1)
-                # Remove Address from Valid Assignable Address Pool
-                try:
-                    acceptable_host_addresses.remove(node_mgmt_ip)
-                    if verbose: print("  INFO: Removing MGMT_IP Address %s from Assignable Pool. Address already assigned to %s"%(node_mgmt_ip,device))
-                except:
-                    print(styles.FAIL + styles.BOLD + " ### ERROR: Cannot mark the mgmt_ip (%s) as used."%(node_mgmt_ip))
-                    exit(1)
-
-        # Add Mgmt_IP if not configured
-        for device in inventory:
-            if 'mgmt_ip' not in inventory[device]:
-                new_mgmt_ip=acceptable_host_addresses.pop(0)
-                inventory[device]['mgmt_ip']="%s"%(new_mgmt_ip)
-                print("    Device: \"%s\" was assigned mgmt_ip %s"%(device,new_mgmt_ip))
 
-    else:
-        # Add Dummy Eth0 Link
-        for device in inventory:
-            if inventory[device]["function"] not in network_functions: continue
-            if 'vagrant' in inventory[device]:
-                if inventory[device]['vagrant'] == 'eth0': continue
-            # Check to see if components of the link already exist
-            if "eth0" not in inventory[device]['interfaces']:
+            inventory[mgmt_server]["os"] = "yk0/ubuntu-xenial"
+            if self.provider=="libvirt":
+                inventory[mgmt_server]["os"] = "yk0/ubuntu-xenial"
+            if "memory" not in inventory[mgmt_server]:
+                inventory[mgmt_server]["memory"] = "512"
+            inventory[mgmt_server]["config"] = "./helper_scripts/auto_mgmt_network/OOB_Server_Config_auto_mgmt.sh"
+
+            # Hardcode mgmt switch parameters
+            if mgmt_switch == None and self.create_mgmt_network:
+                if "oob-mgmt-switch" in inventory:
+                    raise conversion_error(' ### ERROR: oob-mgmt-switch must be set to function = "oob-switch"')
+                inventory["oob-mgmt-switch"] = {}
+                inventory["oob-mgmt-switch"]["function"] = "oob-switch"
+                inventory["oob-mgmt-switch"]["interfaces"] = {}
+                if self.provider == "libvirt":
+                    if 'tunnel_ip' not in inventory["oob-mgmt-switch"]: inventory["oob-mgmt-switch"]['tunnel_ip']=self.default_tunnel_ip()
+
+                mgmt_switch="oob-mgmt-switch"
+
+            if self.create_mgmt_network:
+                inventory[mgmt_switch]["os"] = "CumulusCommunity/cumulus-vx"
+                inventory[mgmt_switch]["memory"] = "512"
+                inventory[mgmt_switch]["config"] = "./helper_scripts/oob_switch_config.sh"
+
+                #Add Link between oob-mgmt-switch oob-mgmt-server
                 net_number+=1
+                left_mac=self.mac_fetch(mgmt_switch,"swp1")
+                right_mac=self.mac_fetch(mgmt_server,"eth1")
+                print("  adding mgmt links:")
+                if self.provider=="virtualbox":
+                   print("    %s:%s (mac: %s) --> %s:%s (mac: %s)     network_string:%s" % (mgmt_switch,"swp1",left_mac,mgmt_server,"eth1",right_mac,network_string))
+                elif self.provider=="libvirt":
+                    print("    %s:%s udp_port %s (mac: %s) --> %s:%s udp_port %s (mac: %s)" % (mgmt_switch,"swp1",left_mac,PortA,mgmt_server,"eth1",PortB,right_mac))
+                self.add_link(inventory,
+                         mgmt_switch,
+                         mgmt_server,
+                         "swp1",
+                         "eth1",
+                         left_mac,
+                         right_mac,
+                         self.net_numbers.assign(link_key(mgmt_switch,"swp1",mgmt_server,"eth1"),net_number))
+
+                #Add Eth0 MGMT Link for every device that is is not oob-switch or oob-server
+                mgmt_devices=[device for device in inventory if inventory[device]["function"]!="oob-server" and inventory[device]["function"]!="oob-switch"]
+                mgmt_switch_swps=self.mgmt_switch_ports(mgmt_devices)
+                mgmt_interfaces=[]
+                for device, mgmt_switch_swp in zip(mgmt_devices,mgmt_switch_swps):
+                    mgmt_interfaces+=[(mgmt_switch,"swp"+str(mgmt_switch_swp)),(device,"eth0")]
+                mgmt_macs=self.mac_fetch_block(mgmt_interfaces)
+                for index, device in enumerate(mgmt_devices):
+                    if inventory[device]["function"] in network_functions:
+                        if "config" not in inventory[device]:
+                            inventory[device]["config"] = "./helper_scripts/extra_switch_config.sh"
+                    mgmt_switch_swp=mgmt_switch_swps[index]
+                    net_number+=1
+                    mgmt_switch_swp_val="swp"+str(mgmt_switch_swp)
+                    left_mac=mgmt_macs[2*index]
+                    right_mac=mgmt_macs[2*index+1]
+
+                    half1_exists=False
+                    half2_exists=False
+                    #Check to see if components of the link already exist
+                    if "eth0" in inventory[device]['interfaces']:
+                        if inventory[device]['interfaces']['eth0']['remote_interface'] != mgmt_switch_swp_val:
+                            raise conversion_error(" ### ERROR: %s:eth0 interface already exists but not connected to %s:%s" %(device,mgmt_switch,mgmt_switch_swp_val))
+                        if inventory[device]['interfaces']['eth0']['remote_device'] != mgmt_switch:
+                            raise conversion_error(" ### ERROR: %s:eth0 interface already exists but not connected to %s:%s" %(device,mgmt_switch,mgmt_switch_swp_val))
+                        if self.verbose: print("        mgmt link on %s already exists and is good." % (mgmt_switch))
+                        half1_exists=True
+
+                    if mgmt_switch_swp_val in inventory[mgmt_switch]['interfaces']:
+                        if inventory[mgmt_switch]['interfaces'][mgmt_switch_swp_val]['remote_interface'] != "eth0":
+                            raise conversion_error(" ### ERROR: %s:%s-- link already exists but not connected to %s:eth0" %(mgmt_switch,mgmt_switch_swp_val,device))
+                        if inventory[mgmt_switch]['interfaces'][mgmt_switch_swp_val]['remote_device'] != device:
+                            raise conversion_error(" ### ERROR: %s:%s-- link already exists but not connected to %s:eth0" %(mgmt_switch,mgmt_switch_swp_val,device))
+                        if self.verbose: print("        mgmt link on %s already exists and is good." % (mgmt_switch))
+                        half2_exists=True
+
+                    if not half1_exists and not half2_exists:
+                        link_number=self.net_numbers.assign(link_key(mgmt_switch,mgmt_switch_swp_val,device,"eth0"),net_number)
+                        #Display add message
+                        if self.provider=="virtualbox":
+                            print("    %s:%s (mac: %s) --> %s:%s (mac: %s)     network_string:net%s" % (mgmt_switch,mgmt_switch_swp_val,left_mac,device,"eth0",right_mac,link_number))
+                        elif self.provider=="libvirt":
+                            print("    %s:%s udp_port %s (mac: %s) --> %s:%s udp_port %s (mac: %s)" % (mgmt_switch,mgmt_switch_swp_val,PortA,left_mac,device,"eth0",PortB,right_mac))
+
+                        self.add_link(inventory,
+                                 mgmt_switch,
+                                 device,
+                                 mgmt_switch_swp_val,
+                                 "eth0",
+                                 left_mac,
+                                 right_mac,
+                                 link_number,)
+
+            # Determine Used MGMT IPs
+            print("  MGMT_IP ADDRESS for OOB_SERVER IS: %s%s"%(inventory[mgmt_server]["mgmt_ip"],inventory["oob-mgmt-server"]["mgmt_cidrmask"]))
+            network = mgmt_pool.network
+            for device in inventory:
+                if 'mgmt_ip' in inventory[device]:
+                    node_mgmt_ip=ipaddress.ip_address(unicode(inventory[device]['mgmt_ip']))
+                    # Check that Defined Mgmt_IP is in same Subnet as OOB-SERVER
+                    if node_mgmt_ip not in network:
+                        raise conversion_error(" ### ERROR: IP address (%s) is not in the Management Server subnet %s"%(node_mgmt_ip,network))
+                    # Remove Address from Valid Assignable Address Pool
+                    if not mgmt_pool.reserve(node_mgmt_ip):
+                        raise conversion_error(" ### ERROR: Cannot mark the mgmt_ip (%s) as used."%(node_mgmt_ip))
+                    if self.verbose: print("  INFO: Removing MGMT_IP Address %s from Assignable Pool. Address already assigned to %s"%(node_mgmt_ip,device))
+
+            # Reuse Mgmt_IPs assigned by a previous run
+            saved_mgmt_ips=self.saved_state.get('mgmt_ips',{})
+            for device in inventory:
+                if 'mgmt_ip' not in inventory[device] and device in saved_mgmt_ips:
+                    try:
+                        saved_mgmt_ip=ipaddress.ip_address(unicode(saved_mgmt_ips[device]))
+                    except ValueError:
+                        continue
+                    if saved_mgmt_ip not in network or not mgmt_pool.reserve(saved_mgmt_ip): continue
+                    inventory[device]['mgmt_ip']="%s"%(saved_mgmt_ip)
+                    self.mgmt_ips[device]=inventory[device]['mgmt_ip']
+                    print("    Device: \"%s\" was assigned mgmt_ip %s"%(device,saved_mgmt_ip))
+
+            # Add Mgmt_IP if not configured
+            for device in inventory:
+                if 'mgmt_ip' not in inventory[device]:
+                    new_mgmt_ip=mgmt_pool.allocate()
+                    if new_mgmt_ip is None:
+                        raise conversion_error(" ### ERROR: No free addresses left in the Management Server subnet %s for device %s"%(network,device))
+                    inventory[device]['mgmt_ip']="%s"%(new_mgmt_ip)
+                    self.mgmt_ips[device]=inventory[device]['mgmt_ip']
+                    print("    Device: \"%s\" was assigned mgmt_ip %s"%(device,new_mgmt_ip))
 
-                add_link(inventory,
-                         device,
-                         "NOTHING",
-                         "eth0",
-                         "NOTHING",
-                         mac_fetch(device,"eth0"),
-                         "NOTHING",
-                         net_number,)
-
-    # Add Extra Port Ranges (if needed)
-    for device in inventory:
-        if "ports" in inventory[device] and inventory[device]["function"] in network_functions:
-            if provider!="libvirt":
-                warning.append(styles.WARNING + styles.BOLD + "    WARNING: 'ports' setting on node %s will be ignored when not using the libvirt hypervisor."%(device) + styles.ENDC)
+        else:
+            # Add Dummy Eth0 Link
+            for device in inventory:
+                if inventory[device]["function"] not in network_functions: continue
+                if 'vagrant' in inventory[device]:
+                    if inventory[device]['vagrant'] == 'eth0': continue
+                # Check to see if components of the link already exist
+                if "eth0" not in inventory[device]['interfaces']:
+                    self.add_unconnected(inventory,device,"eth0",self.mac_fetch(device,"eth0"))
+
+        self.timings.mark("mgmt network")
+
+        # Add Extra Port Ranges (if needed)
+        only_nums = re.compile(r'[^\d]+')
+        for device in port_range_devices:
+            if self.provider!="libvirt":
+                self.warning.append(styles.WARNING + styles.BOLD + "    WARNING: 'ports' setting on node %s will be ignored when not using the libvirt hypervisor."%(device) + styles.ENDC)
             port_range = int(inventory[device]["ports"])
-            existing_port_list=[]
-            ports_to_create=[]
-            only_nums = re.compile(r'[^\d]+')
-            for port in inventory[device]['interfaces']:
-                existing_port_list.append(int(only_nums.sub('', port)))
+            existing_port_list=[int(only_nums.sub('', port)) for port in inventory[device]['interfaces']]
             print(existing_port_list)
-            for i in range(0,port_range+1):
-                if i not in existing_port_list: ports_to_create.append(i)
-            if verbose:
+            existing_ports=set(existing_port_list)
+            ports_to_create=[i for i in range(0,port_range+1) if i not in existing_ports]
+            if self.verbose:
                 print("  INFO: On %s will create the following ports:" %(device))
                 print(ports_to_create)
             #exit(1)
-            for i in ports_to_create:
-                net_number+=1
-                add_link(inventory,
-                         device,
-                         "NOTHING",
-                         "swp%s"%(i),
-                         "NOTHING",
-                         mac_fetch(device,"swp%s"%(i)),
-                         "NOTHING",
-                         net_number,)
-
-    if verbose:
-        print("\n\n ### Inventory Datastructure: ###")
-        pp.pprint(inventory)
-
-    return inventory
-
-def add_link(inventory,left_device,right_device,left_interface,right_interface,left_mac_address,right_mac_address,net_number):
-    network_string="net"+str(net_number)
-    PortA=str(start_port+net_number)
-    PortB=str(start_port+port_gap+net_number)
-    if int(PortA) > int(start_port+port_gap) and provider=="libvirt":
-        print(styles.FAIL + styles.BOLD + " ### ERROR: Configured Port_Gap: ("+str(port_gap)+") exceeds the number of links in the topology. Read the help options to fix.\n\n" + styles.ENDC)
-        parser.print_help()
-        exit(1)
-
-    global mac_map
-    #Add a Link to the Inventory for both switches
-
-    #Add left host switchport to inventory
-    if left_interface not in inventory[left_device]['interfaces']:
-        inventory[left_device]['interfaces'][left_interface] = {}
-        inventory[left_device]['interfaces'][left_interface]['mac']=left_mac_address
-        if left_mac_address in mac_map:
-            print(styles.FAIL + styles.BOLD + " ### ERROR -- MAC Address Collision - tried to use "+left_mac_address+" on "+left_device+":"+left_interface+"\n                 but it is already in use. Check your Topology File!" + styles.ENDC)
-            exit(1)
-        mac_map[left_mac_address]=left_device+","+left_interface
-        if provider=="virtualbox":
-            inventory[left_device]['interfaces'][left_interface]['network'] = network_string
-        elif provider=="libvirt":
-            inventory[left_device]['interfaces'][left_interface]['local_port'] = PortA
-            inventory[left_device]['interfaces'][left_interface]['remote_port'] = PortB
-    else:
-        print(styles.FAIL + styles.BOLD + " ### ERROR -- Interface " + left_interface + " Already used on device: " + left_device + styles.ENDC)
-        exit(1)
-
-    #Add right host switchport to inventory
-    if right_device == "NOTHING":
-        pass
-    elif right_interface not in inventory[right_device]['interfaces']:
-        inventory[right_device]['interfaces'][right_interface] = {}
-        inventory[right_device]['interfaces'][right_interface]['mac']=right_mac_address
-        if right_mac_address in mac_map:
-            print(styles.FAIL + styles.BOLD + " ### ERROR -- MAC Address Collision - tried to use "+right_mac_address+" on "+right_device+":"+right_interface+"\n                 but it is already in use. Check your Topology File!" + styles.ENDC)
-            exit(1)
-        mac_map[right_mac_address]=right_device+","+right_interface
-        if provider=="virtualbox":
-            inventory[right_device]['interfaces'][right_interface]['network'] = network_string
-        elif provider=="libvirt":
-            inventory[right_device]['interfaces'][right_interface]['local_port'] = PortB
-            inventory[right_device]['interfaces'][right_interface]['remote_port'] = PortA
-    else:
-        print(styles.FAIL + styles.BOLD + " ### ERROR -- Interface " + right_interface + " Already used on device: " + right_device + styles.ENDC)
-        exit(1)
-    inventory[left_device]['interfaces'][left_interface]['remote_interface'] = right_interface
-    inventory[left_device]['interfaces'][left_interface]['remote_device'] = right_device
-
-    if right_device != "NOTHING":
-        inventory[right_device]['interfaces'][right_interface]['remote_interface'] = left_interface
-        inventory[right_device]['interfaces'][right_interface]['remote_device'] = left_device
-
-    if provider == 'libvirt':
-        if right_device != "NOTHING":
-            inventory[left_device]['interfaces'][left_interface]['local_ip'] = inventory[left_device]['tunnel_ip']
-            inventory[left_device]['interfaces'][left_interface]['remote_ip'] = inventory[right_device]['tunnel_ip']
-            inventory[right_device]['interfaces'][right_interface]['local_ip'] = inventory[right_device]['tunnel_ip']
-            inventory[right_device]['interfaces'][right_interface]['remote_ip'] = inventory[left_device]['tunnel_ip']
-        elif right_device == "NOTHING":
-            inventory[left_device]['interfaces'][left_interface]['local_ip'] = "127.0.0.1"
-            inventory[left_device]['interfaces'][left_interface]['remote_ip'] = "127.0.0.1"
-
-
-def clean_datastructure(devices):
-    #Sort the devices by function
-    devices.sort(key=getKeyDevices)
-    for device in devices:
-        device['interfaces']=sorted_interfaces(device['interfaces'])
-
-    if display_datastructures: return devices
-    for device in devices:
-        print(styles.GREEN + styles.BOLD + ">> DEVICE: " + device['hostname'] + styles.ENDC)
-        print("     code: " + device['os'])
-        if 'memory' in device:
-            print("     memory: " + device['memory'])
-        for attribute in device:
-            if attribute == 'memory' or attribute == 'os' or attribute == 'interfaces': continue
-            print("     "+str(attribute)+": "+ str(device[attribute]))
-        for interface_entry in device['interfaces']:
-            print("       LINK: " + interface_entry["local_interface"])
-            for attribute in interface_entry:
-                if attribute != "local_interface":
-                    print("               " + attribute +": " + interface_entry[attribute])
-
-    #Remove Fake Devices
-    indexes_to_remove=[]
-    for i in range(0,len(devices)):
-        if 'function' in devices[i]:
-            if devices[i]['function'] == 'fake':
-                indexes_to_remove.append(i)
-    for index in sorted(indexes_to_remove, reverse=True):
-        del devices[index]
-    return devices
-
-def remove_generated_files():
-    if display_datastructures: return
-    if verbose: print("Removing existing DHCP FILE...")
-    if os.path.isfile(dhcp_mac_file):  os.remove(dhcp_mac_file)
-
-
-_nsre = re.compile('([0-9]+)')
-def natural_sort_key(s):
-    return [int(text) if text.isdigit() else text.lower()
-            for text in re.split(_nsre, s)]
+            port_macs=self.mac_fetch_block([(device,"swp%s"%(i)) for i in ports_to_create])
+            for i, port_mac in zip(ports_to_create,port_macs):
+                self.add_unconnected(inventory,device,"swp%s"%(i),port_mac)
 
+        self.timings.mark("extra port ranges")
 
-def getKeyDevices(device):
-    # Used to order the devices for printing into the vagrantfile
-    if device['function'] == "oob-server": return 1
-    elif device['function'] == "oob-switch": return 2
-    elif device['function'] == "exit": return 3
-    elif device['function'] == "superspine": return 4
-    elif device['function'] == "spine": return 5
-    elif device['function'] == "leaf": return 6
-    elif device['function'] == "tor": return 7
-    elif device['function'] == "host": return 8
-    else: return 9
+        if self.provider=="libvirt":
+            self.assign_udp_ports(inventory)
+            self.timings.mark("assign UDP ports")
+            self.timings.count("UDP tunnels",len(self.udp_links))
 
-def sorted_interfaces(interface_dictionary):
-    sorted_list=[]
-    interface_list=[]
-    for link in interface_dictionary:
-        sorted_list.append(link)
-    sorted_list.sort(key=natural_sort_key)
-    for link in sorted_list:
-        interface_dictionary[link]["local_interface"]= link
-        interface_list.append(interface_dictionary[link])
-    return interface_list
+        if self.verbose:
+            print("\n\n ### Inventory Datastructure: ###")
+            pretty_print(dict((device,plain_device(inventory[device])) for device in inventory))
 
-def generate_dhcp_mac_file(mac_map):
-    if verbose: print("GENERATING DHCP MAC FILE...")
-    mac_file = open(dhcp_mac_file,"a")
-    if '' in mac_map: del mac_map['']
-    dhcp_display_list=[]
-    for line in mac_map:
-        dhcp_display_list.append(mac_map[line]+","+line)
-    dhcp_display_list.sort()
-    for line in dhcp_display_list:
-        mac_file.write(line+"\n")
-    mac_file.close()
-
-def populate_data_structures(inventory):
-    global function_group
-    devices = []
-    for device in inventory:
-        inventory[device]['hostname']=device
-        devices.append(inventory[device])
-    devices_clean = clean_datastructure(devices)
-
-    #Create Functional Group Map
-    for device in devices_clean:
-        if device['function'] not in function_group: function_group[device['function']] = []
-        function_group[device['function']].append(device['hostname'])
-
-    return devices_clean
-
-def render_jinja_templates(devices):
-    global function_group
-    if display_datastructures: print_datastructures(devices)
-    if verbose: print("RENDERING JINJA TEMPLATES...")
-
-    #Render the MGMT Network stuff
-    if create_mgmt_device:
+        #Snapshot of every VM definition for the allocation state and --diff
+        if self.state_file is not None or self.diff_file is not None:
+            for device in inventory:
+                if inventory[device].get('function') == 'fake': continue
+                self.device_definitions[device]=json.loads(json.dumps(plain_device(inventory[device])))
+            self.timings.mark("snapshot devices")
+
+        return inventory
+
+    def default_tunnel_ip(self):
+        # tunnel_ip for devices the converter creates itself (oob-mgmt-server/switch)
+        if self.hypervisors: return self.hypervisors[0][0]
+        return '127.0.0.1'
+
+    def place_devices(self,inventory,edges):
+        # Fills in tunnel_ip for every device that has none of its own using
+        # place_nodes(), keeping linked devices on the same hypervisor as far
+        # as the memory and cpu of each hypervisor allow.
+        def usage(device):
+            if inventory[device].get('function') == 'fake': return (0,0)
+            try:
+                return (int(inventory[device].get('memory',"512")),int(inventory[device].get('cpus',"1")))
+            except ValueError:
+                return (512,1)
+        unplaced=set(self.unplaced_devices)
+        nodes=[(device,)+usage(device) for device in self.unplaced_devices]
+        pinned_load={}
+        #The generated oob-mgmt-server/switch land on the first hypervisor
+        if self.create_mgmt_device: pinned_load[self.hypervisors[0][0]]=(512*(1+int(self.create_mgmt_network)),1+int(self.create_mgmt_network))
+        for device in inventory:
+            if device in unplaced: continue
+            memory,cpus=usage(device)
+            load=pinned_load.get(inventory[device]['tunnel_ip'],(0,0))
+            pinned_load[inventory[device]['tunnel_ip']]=(load[0]+memory,load[1]+cpus)
+        links=[]
+        for source, destination, attributes in edges:
+            ends=[]
+            for end in (source,destination):
+                device=end.split(":")[0].replace('"','')
+                if device not in inventory: break
+                if device in unplaced: ends.append(device)
+                else: ends.append("@"+inventory[device]['tunnel_ip'])
+            if len(ends) == 2: links.append(tuple(ends))
+
+        for position,resource in ((1,"MB of memory"),(2,"cpus")):
+            if any(host[position] is None for host in self.hypervisors): continue
+            demand=sum(node[position] for node in nodes)+sum(load[position-1] for load in pinned_load.values())
+            capacity=sum(host[position] for host in self.hypervisors)
+            if demand > capacity:
+                raise conversion_error(" ### ERROR: the topology needs %s %s but the hypervisors only have %s." % (demand,resource,capacity))
+        placement=place_nodes(nodes,links,self.hypervisors,pinned_load)
+        if not isinstance(placement,dict):
+            raise conversion_error(" ### ERROR: device %s does not fit on any hypervisor, add hypervisors or raise their memory/cpu limits." % placement)
+        for device in self.unplaced_devices:
+            inventory[device]['tunnel_ip']=placement[device]
+            if self.verbose: print("  INFO: placed %s on hypervisor %s" % (device,placement[device]))
+
+        #Per-host load
+        cross_links=0
+        for source, destination, attributes in edges:
+            left_device=source.split(":")[0].replace('"','')
+            right_device=destination.split(":")[0].replace('"','')
+            if left_device in inventory and right_device in inventory and inventory[left_device]['tunnel_ip'] != inventory[right_device]['tunnel_ip']: cross_links+=1
+        print("  PLACEMENT: %s devices on %s hypervisors, %s of %s links cross hypervisors" % (len(inventory),len(self.hypervisors),cross_links,len(edges)))
+        load={}
+        for device in inventory:
+            memory,cpus=usage(device)
+            host_load=load.get(inventory[device]['tunnel_ip'],(0,0,0))
+            load[inventory[device]['tunnel_ip']]=(host_load[0]+1,host_load[1]+memory,host_load[2]+cpus)
+        for host,memory_limit,cpu_limit in self.hypervisors:
+            devices,memory,cpus=load.get(host,(0,0,0))
+            memory_text="%s MB" % memory
+            if memory_limit: memory_text="%s/%s MB (%.1f%%)" % (memory,memory_limit,100.0*memory/memory_limit)
+            cpu_text="%s cpus" % cpus
+            if cpu_limit: cpu_text="%s/%s cpus" % (cpus,cpu_limit)
+            print("    %-15s %6s devices  %-26s %s" % (host,devices,memory_text,cpu_text))
+
+    def shards(self,devices):
+        # [(tunnel_ip, devices on it)] in the order the hypervisors first appear
+        shards=[]
+        shard_index={}
+        for device in devices:
+            host=device['tunnel_ip']
+            if host not in shard_index:
+                shard_index[host]=len(shards)
+                shards.append((host,[]))
+            shards[shard_index[host]][1].append(device)
+        return shards
+
+    def assign_udp_ports(self,inventory):
+        # Gives both ends of every libvirt UDP tunnel a port. A link keeps the
+        # ports saved in the allocation state; otherwise it gets the classic
+        # start_port+net_number / start_port+port_gap+net_number pair while
+        # that fits inside port_gap and is free, and past that the lowest free
+        # port on each end's tunnel_ip. Unconnected ports send to start_port
+        # on their own tunnel_ip, which this simulation never hands out. Their
+        # local ports are counted down from the top of the range, after every
+        # link has its ports, so they never move a link off the
+        # start_port/port_gap layout.
+        # Ports set on the link with left_local_port, left_remote_port,
+        # right_local_port or right_remote_port are kept and reserved on their
+        # tunnel_ip first, and the other end of the tunnel sends to them.
+        allocator=UdpPortAllocator(self.start_port+1)
+        endpoints=[]
+        pinned=[]
+        demand={}
+        for left_device,left_interface,right_device,right_interface,net_number in self.udp_links:
+            left_host=inventory[left_device]['tunnel_ip']
+            right_host=inventory[right_device]['tunnel_ip']
+            endpoints.append((left_host,right_host))
+            demand[left_host]=demand.get(left_host,0)+1
+            demand[right_host]=demand.get(right_host,0)+1
+            left=inventory[left_device]['interfaces'][left_interface]
+            right=inventory[right_device]['interfaces'][right_interface]
+            #port_a is the port of the tunnel on left_host, port_b the one on right_host
+            pin_a=left.local_port if left.local_port is not None else right.remote_port
+            pin_b=right.local_port if right.local_port is not None else left.remote_port
+            if pin_a is not None and str(pin_a).isdigit(): pin_a=int(pin_a)
+            if pin_b is not None and str(pin_b).isdigit(): pin_b=int(pin_b)
+            pinned.append((pin_a,pin_b))
+        for (left_host,right_host),(pin_a,pin_b) in zip(endpoints,pinned):
+            if isinstance(pin_a,int): allocator.reserve(left_host,pin_a)
+            if isinstance(pin_b,int): allocator.reserve(right_host,pin_b)
+        for device,interface in self.unconnected_links:
+            host=inventory[device]['tunnel_ip']
+            demand[host]=demand.get(host,0)+1
+
+        #Validate the whole plan before handing out any ports
+        overloaded=[" ### ERROR: tunnel_ip %s needs %s UDP ports but only %s are available between start_port+1 (%s) and %s. Spread the devices over more hypervisors with tunnel_ip or lower --start-port." % (host,demand[host],allocator.capacity(),self.start_port+1,allocator.last_port)
+                    for host in sorted(demand) if demand[host] > allocator.capacity()]
+        if overloaded: raise conversion_error("\n".join(overloaded))
+
+        saved_links=self.saved_state.get('links',{})
+        overflow=0
+        for (left_device,left_interface,right_device,right_interface,net_number),(left_host,right_host),(pin_a,pin_b) in zip(self.udp_links,endpoints,pinned):
+            key=link_key(left_device,left_interface,right_device,right_interface)
+            candidates=[]
+            saved_ports=saved_links.get(key,{}).get('ports')
+            if isinstance(saved_ports,list) and len(saved_ports) == 2 and saved_links[key].get('left') == left_device+":"+left_interface:
+                candidates.append(saved_ports)
+            if net_number <= self.port_gap:
+                candidates.append([self.start_port+net_number,self.start_port+self.port_gap+net_number])
+            ports=None
+            if pin_a is not None and pin_b is not None:
+                ports=[pin_a,pin_b]
+            for port_a,port_b in candidates:
+                if ports is not None: break
+                if not isinstance(port_a,int) or not isinstance(port_b,int): continue
+                if pin_a is not None: port_a=pin_a
+                if pin_b is not None: port_b=pin_b
+                if left_host == right_host and port_a == port_b: continue
+                if (pin_a is not None or allocator.is_free(left_host,port_a)) and (pin_b is not None or allocator.is_free(right_host,port_b)):
+                    if pin_a is None: allocator.reserve(left_host,port_a)
+                    if pin_b is None: allocator.reserve(right_host,port_b)
+                    ports=[port_a,port_b]
+            if ports is None:
+                overflow+=1
+                ports=[pin_a if pin_a is not None else allocator.allocate(left_host),
+                       pin_b if pin_b is not None else allocator.allocate(right_host)]
+            self.link_ports[key]=ports
+
+            #Only the ports the link does not set itself
+            left=inventory[left_device]['interfaces'][left_interface]
+            if left.local_port is None: left.local_port=ports[0]
+            if left.remote_port is None: left.remote_port=ports[1]
+            right=inventory[right_device]['interfaces'][right_interface]
+            if right.local_port is None: right.local_port=ports[1]
+            if right.remote_port is None: right.remote_port=ports[0]
+
+        saved_ports=self.saved_state.get('unconnected_ports')
+        if not isinstance(saved_ports,dict): saved_ports={}
+        #Saved ports first so new interfaces cannot take them
+        for device,interface in self.unconnected_links:
+            key=device+":"+interface
+            port=saved_ports.get(key)
+            if isinstance(port,int) and allocator.reserve(inventory[device]['tunnel_ip'],port): self.unconnected_ports[key]=port
+        for device,interface in self.unconnected_links:
+            key=device+":"+interface
+            if key not in self.unconnected_ports: self.unconnected_ports[key]=allocator.allocate_top(inventory[device]['tunnel_ip'])
+            port=self.unconnected_ports[key]
+            unconnected=inventory[device]['interfaces'][interface]
+            unconnected.local_port=port
+            unconnected.remote_port=self.start_port
+
+        if self.verbose or overflow:
+            print("  UDP port utilization (%s links, %s beyond the start_port/port_gap layout, %s unconnected ports):" % (len(self.udp_links),overflow,len(self.unconnected_links)))
+            for host,used,capacity in allocator.utilization():
+                print("    tunnel_ip %-15s %6s of %s ports used (%.1f%%)" % (host,used,capacity,100.0*used/max(capacity,1)))
+
+    def add_link(self,inventory,left_device,right_device,left_interface,right_interface,left_mac_address,right_mac_address,net_number):
+        left_device=intern(left_device)
+        right_device=intern(right_device)
+        left_interface=intern(left_interface)
+        right_interface=intern(right_interface)
+        self.link_lefts[link_key(left_device,left_interface,right_device,right_interface)]=left_device+":"+left_interface
+        #libvirt UDP ports are handed out by assign_udp_ports() once every link is known
+        if self.provider=="libvirt": self.udp_links.append((left_device,left_interface,right_device,right_interface,net_number))
+
+        #Add a Link to the Inventory for both switches
+
+        #Add left host switchport to inventory
+        left=self.add_interface(inventory,left_device,left_interface,left_mac_address)
+        if self.provider=="virtualbox":
+            left.network = net_number
+        elif self.provider=="libvirt":
+            left.local_port = None
+            left.remote_port = None
+
+        #Add right host switchport to inventory
+        right=self.add_interface(inventory,right_device,right_interface,right_mac_address)
+        if self.provider=="virtualbox":
+            right.network = net_number
+        elif self.provider=="libvirt":
+            right.local_port = None
+            right.remote_port = None
+
+        left.remote_interface = right_interface
+        left.remote_device = right_device
+        right.remote_interface = left_interface
+        right.remote_device = left_device
+
+        if self.provider == 'libvirt':
+            left.local_ip = inventory[left_device]['tunnel_ip']
+            left.remote_ip = inventory[right_device]['tunnel_ip']
+            right.local_ip = inventory[right_device]['tunnel_ip']
+            right.remote_ip = inventory[left_device]['tunnel_ip']
+
+    def add_unconnected(self,inventory,device,interface,mac_address):
+        # An interface with nothing on the far side (the dummy eth0 links and
+        # the ports= expansion). It takes no net_number; with virtualbox it gets
+        # an internal network of its own named after the device and interface,
+        # and with libvirt a UDP tunnel from its own tunnel_ip back to the same
+        # address, whose port assign_udp_ports() hands out apart from those of
+        # the links.
+        device=intern(device)
+        interface=intern(interface)
+        port=self.add_interface(inventory,device,interface,mac_address)
+        port.remote_interface = "NOTHING"
+        port.remote_device = "NOTHING"
+        if self.provider == 'virtualbox':
+            port.network = "%s_%s" % (device,interface)
+        elif self.provider == 'libvirt':
+            port.local_port = None
+            port.remote_port = None
+            port.local_ip = inventory[device]['tunnel_ip']
+            port.remote_ip = inventory[device]['tunnel_ip']
+            self.unconnected_links.append((device,interface))
+
+    def add_interface(self,inventory,device,interface,mac_address):
+        if interface in inventory[device]['interfaces']:
+            raise conversion_error(" ### ERROR -- Interface " + interface + " Already used on device: " + device)
+        if mac_address in self.mac_map:
+            raise conversion_error(" ### ERROR -- MAC Address Collision - tried to use "+mac_address+" on "+device+":"+interface+"\n                 but it is already in use. Check your Topology File!")
+        self.mac_map[mac_address]=device+","+interface
+        port=inventory[device]['interfaces'][interface] = Interface(mac_address)
+        return port
+
+    def clean_datastructure(self,devices):
+        #Sort the devices by function
+        devices.sort(key=getKeyDevices)
+        for device in devices:
+            device['interfaces']=sorted_interfaces(device['interfaces'])
+
+        if self.display_datastructures: return devices
+        for device in devices:
+            print(styles.GREEN + styles.BOLD + ">> DEVICE: " + device['hostname'] + styles.ENDC)
+            print("     code: " + device['os'])
+            if 'memory' in device:
+                print("     memory: " + device['memory'])
+            for attribute in device:
+                if attribute == 'memory' or attribute == 'os' or attribute == 'interfaces': continue
+                print("     "+str(attribute)+": "+ str(device[attribute]))
+            for interface_entry in device['interfaces']:
+                print("       LINK: " + interface_entry["local_interface"])
+                for attribute in interface_entry:
+                    if attribute != "local_interface":
+                        print("               " + attribute +": " + interface_entry[attribute])
+
+        #Remove Fake Devices
+        indexes_to_remove=[]
+        for i in range(0,len(devices)):
+            if 'function' in devices[i]:
+                if devices[i]['function'] == 'fake':
+                    indexes_to_remove.append(i)
+        for index in sorted(indexes_to_remove, reverse=True):
+            del devices[index]
+        return devices
+
+    def remove_generated_files(self):
+        if self.display_datastructures: return
+        if not self.force: return
+        if self.verbose: print("Removing existing DHCP FILE...")
+        if os.path.isfile(self.output_path(dhcp_mac_file)):  os.remove(self.output_path(dhcp_mac_file))
+
+    def generate_dhcp_mac_file(self):
+        if self.verbose: print("GENERATING DHCP MAC FILE...")
+        if '' in self.mac_map: del self.mac_map['']
+        dhcp_display_list=[]
+        for line in self.mac_map:
+            dhcp_display_list.append(self.mac_map[line]+","+line)
+        dhcp_display_list.sort()
+        self.write_output(self.output_path(dhcp_mac_file),
+                          lambda mac_file: mac_file.writelines(line+"\n" for line in dhcp_display_list))
+
+    def populate(self,inventory):
+        devices = []
+        for device in inventory:
+            inventory[device]['hostname']=device
+            devices.append(inventory[device])
+        devices_clean = self.clean_datastructure(devices)
+
+        #Create Functional Group Map
+        for device in devices_clean:
+            if device['function'] not in self.function_group: self.function_group[device['function']] = []
+            self.function_group[device['function']].append(device['hostname'])
+
+        return devices_clean
+
+    def render(self,devices):
+        if self.verbose: print("RENDERING JINJA TEMPLATES...")
+        if self.output_dir is not None and not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        template_files=[templatefile for templatefile,destination in self.templates]+[VAGRANTFILE_common_template]
+        if self.create_mgmt_device: template_files+=[os.path.join(mgmt_template_dir,template) for template in self.mgmt_templates()]
+        self.check_manifest(template_files)
+
+        #Built once and shared read-only by every render
+        context=dict(devices=devices,
+                     synced_folder=self.synced_folder,
+                     provider=self.provider,
+                     version=version,
+                     topology_file=self.topology_file,
+                     arg_string=self.arg_string,
+                     epoch_time=self.epoch_time,
+                     script_storage=script_storage,
+                     generate_ansible_hostfile=self.generate_ansible_hostfile,
+                     create_mgmt_device=self.create_mgmt_device,
+                     function_group=self.function_group,
+                     network_functions=network_functions,
+                     data_file=VAGRANTFILE_data)
+        render_jobs=[]
+
+        #Render the MGMT Network stuff
+        if self.create_mgmt_device:
+            mgmt_templates=self.mgmt_templates()
+            if self.verbose:
+                print(" detected mgmt_templates:")
+                print(mgmt_templates)
+
+            #Create output location for MGMT template files
+            mgmt_destination_dir=self.output_path("./helper_scripts/auto_mgmt_network/")
+            if not os.path.isdir(mgmt_destination_dir):
+                if self.verbose: print("Making Directory for MGMT Helper Files: " + mgmt_destination_dir)
+                try:
+                    os.makedirs(mgmt_destination_dir)
+                except:
+                    raise conversion_error("ERROR: Could not create output directory for mgmt template renders!")
+
+            #Queue up the templates
+            mgmt_context=dict(context,customer=self.customer)
+            for template in mgmt_templates:
+                render_destination=os.path.join(mgmt_destination_dir,template[0:-3])
+                template_source=os.path.join(mgmt_template_dir,template)
+                if self.verbose: print("    Rendering: " + template + " --> " + render_destination)
+                render_jobs.append([self.load_template(template_source),render_destination,mgmt_context])
+
+       #Queue up the main Vagrantfile
+        if not (self.create_mgmt_device and self.create_mgmt_configs_only):
+            for templatefile,destination in self.templates:
+                if self.shard and templatefile == self.templates[0][0]:
+                    #One Vagrantfile per hypervisor, cross-shard links are already remote UDP tunnels
+                    for host,shard_devices in self.shards(devices):
+                        shard_destination=self.output_path(os.path.join(shard_directory % host,destination))
+                        shard_function_group={}
+                        for device in shard_devices:
+                            shard_function_group.setdefault(device['function'],[]).append(device['hostname'])
+                        if self.data_driven: self.write_vagrant_data(shard_destination,shard_devices,shard_function_group)
+                        if self.verbose: print("    Rendering: " + templatefile + " --> " + shard_destination)
+                        render_jobs.append([self.load_template(templatefile),shard_destination,
+                                            dict(context,devices=shard_devices,function_group=shard_function_group)])
+                    continue
+                destination=self.output_path(destination)
+                if self.data_driven and templatefile == self.templates[0][0]:
+                    self.write_vagrant_data(destination,devices,self.function_group)
+                if self.verbose: print("    Rendering: " + templatefile + " --> " + destination)
+                render_jobs.append([self.load_template(templatefile),destination,context])
+
+        self.timings.mark("load templates")
+        render_results=self.render_templates(render_jobs)
+        self.timings.count("templates rendered",len(render_jobs))
+        if self.verbose:
+            for render_job,(render_time,rewritten) in zip(render_jobs,render_results):
+                if rewritten: print("    Rendered: %s in %.4f seconds" % (render_job[1],render_time))
+                else: print("    Rendered: %s in %.4f seconds (unchanged, not rewritten)" % (render_job[1],render_time))
+
+    def vagrant_data(self,devices,function_group):
+        # What Vagrantfile.data.j2 reads for each device, with the tests
+        # Vagrantfile.j2 makes on the device attributes settled up front.
+        ansible_groups=collections.OrderedDict()
+        for function in function_group: ansible_groups[function]=function_group[function]
+        ansible_groups["network:children"]=[function for function in function_group if function in network_functions]
+        vms=[]
+        for device in devices:
+            pxehost=device.get('pxehost') == "True"
+            vm=collections.OrderedDict([('hostname',device['hostname']),('os',device['os']),('function',device['function'])])
+            if 'legacy' in device: vm['legacy']=True
+            if pxehost: vm['pxehost']=True
+            for attribute in ['version','vagrant_user']:
+                if device.get(attribute): vm[attribute]=device[attribute]
+            for attribute in ['memory','ssh_port']:
+                #Written into the Vagrantfile as bare Ruby literals
+                if attribute in device: vm[attribute]=int(device[attribute]) if str(device[attribute]).isdigit() else device[attribute]
+            for attribute in ['config','playbook']:
+                if attribute in device: vm[attribute]=device[attribute]
+            vm['remap']=not (pxehost and self.provider == 'libvirt') and device.get('remap') != "False"
+            vm['vagrant']=device.get('vagrant') or "vagrant"
+            interfaces=[]
+            for link in device['interfaces']:
+                if self.provider == 'libvirt': keys=['local_interface','mac','local_ip','local_port','remote_ip','remote_port']
+                else: keys=['local_interface','mac','network','pxebootinterface']
+                interface=collections.OrderedDict((key,link[key]) for key in keys if key in link)
+                interfaces.append(interface)
+            vm['interfaces']=interfaces
+            vms.append(vm)
+        return collections.OrderedDict([('version',version),
+                                        ('simid',int(self.epoch_time)),
+                                        ('topology_file',self.topology_file),
+                                        ('script_storage',script_storage),
+                                        ('synced_folder',self.synced_folder),
+                                        ('create_mgmt_device',self.create_mgmt_device),
+                                        ('generate_ansible_hostfile',self.generate_ansible_hostfile),
+                                        ('ansible_groups',ansible_groups),
+                                        ('devices',vms)])
+
+    def write_vagrant_data(self,destination,devices,function_group):
+        data_destination=os.path.join(os.path.dirname(destination),VAGRANTFILE_data)
+        data=self.vagrant_data(devices,function_group)
+        if self.verbose: print("    Writing: " + data_destination)
+        def write(outfile):
+            #One device per line keeps diffs between runs readable
+            outfile.write('{')
+            for key in data:
+                if key == 'devices': continue
+                outfile.write('%s:%s,' % (json.dumps(key),json.dumps(data[key],separators=(',',':'))))
+            outfile.write('"devices":[\n')
+            outfile.write(',\n'.join(json.dumps(vm,separators=(',',':')) for vm in data['devices']))
+            outfile.write('\n]}\n')
+        self.write_output(data_destination,write)
+        self.timings.mark("write " + data_destination)
+
+    def mgmt_templates(self):
         #Check that MGMT Template Dir exists
-        mgmt_template_dir="./templates/auto_mgmt_network/"
         if not os.path.isdir("./templates/auto_mgmt_network"):
-            print(styles.FAIL + styles.BOLD + "ERROR: " + mgmt_template_dir + " does not exist. Cannot populate templates!" + styles.ENDC)
-            exit(1)
+            raise conversion_error("ERROR: " + mgmt_template_dir + " does not exist. Cannot populate templates!")
 
         #Scan MGMT Template Dir for .j2 files
         mgmt_templates=[]
         for file in os.listdir(mgmt_template_dir):
             if file.endswith(".j2"): mgmt_templates.append(file)
-        if verbose:
-            print(" detected mgmt_templates:")
-            print(mgmt_templates)
-
-        #Create output location for MGMT template files
-        mgmt_destination_dir="./helper_scripts/auto_mgmt_network/"
-        if not os.path.isdir(mgmt_destination_dir):
-            if verbose: print("Making Directory for MGMT Helper Files: " + mgmt_destination_dir)
+        return mgmt_templates
+
+    def render_template(self,render_job):
+        template,destination,context=render_job
+        start=time.time()
+        rewritten=self.write_template(template,destination,**context)
+        return time.time()-start,rewritten
+
+    def render_templates(self,render_jobs):
+        # None of the renders depend on each other, so with render_jobs > 1
+        # they run on a thread pool. Returns the render time of each template
+        # and whether its output was rewritten, in the same order as
+        # render_jobs.
+        if self.render_jobs > 1 and len(render_jobs) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool=ThreadPool(min(self.render_jobs,len(render_jobs)))
             try:
-                os.mkdir(mgmt_destination_dir)
-            except:
-                print(styles.FAIL + styles.BOLD + "ERROR: Could not create output directory for mgmt template renders!" + styles.ENDC)
-                exit(1)
-
-        #Render out the templates
-        for template in mgmt_templates:
-            render_destination=os.path.join(mgmt_destination_dir,template[0:-3])
-            template_source=os.path.join(mgmt_template_dir,template)
-            if verbose: print("    Rendering: " + template + " --> " + render_destination)
-            template = jinja2.Template(open(template_source).read())
-            with open(render_destination, 'w') as outfile:
-                outfile.write(template.render(devices=devices,
-                                              synced_folder=synced_folder,
-                                              provider=provider,
-                                              version=version,
-                                              customer=customer,
-                                              topology_file=topology_file,
-                                              arg_string=arg_string,
-                                              epoch_time=epoch_time,
-                                              script_storage=script_storage,
-                                              generate_ansible_hostfile=generate_ansible_hostfile,
-                                              create_mgmt_device=create_mgmt_device,
-                                              function_group=function_group,
-                                              network_functions=network_functions,)
-                             )
-   #Render the main Vagrantfile
-    if create_mgmt_device and create_mgmt_configs_only:
-        return 0
-    for templatefile,destination in TEMPLATES:
-        if verbose: print("    Rendering: " + templatefile + " --> " + destination)
-        template = jinja2.Template(open(templatefile).read())
-        with open(destination, 'w') as outfile:
-            outfile.write(template.render(devices=devices,
-                                          synced_folder=synced_folder,
-                                          provider=provider,
-                                          version=version,
-                                          topology_file=topology_file,
-                                          arg_string=arg_string,
-                                          epoch_time=epoch_time,
-                                          script_storage=script_storage,
-                                          generate_ansible_hostfile=generate_ansible_hostfile,
-                                          create_mgmt_device=create_mgmt_device,
-                                          function_group=function_group,
-                                          network_functions=network_functions,)
-                         )
-
-def print_datastructures(devices):
-    print("\n\n######################################")
-    print("   DATASTRUCTURES SENT TO TEMPLATE:")
-    print("######################################\n")
-    print("provider=" + provider)
-    print("synced_folder=" + str(synced_folder))
-    print("version=" + str(version))
-    print("topology_file=" + topology_file)
-    print("arg_string=" + arg_string)
-    print("epoch_time=" + str(epoch_time))
-    print("script_storage=" + script_storage)
-    print("generate_ansible_hostfile=" + str(generate_ansible_hostfile))
-    print("create_mgmt_device=" + str(create_mgmt_device))
-    print("function_group=")
-    pp.pprint(function_group)
-    print("network_functions=")
-    pp.pprint(network_functions)
-    print("devices=")
-    pp.pprint(devices)
-    exit(0)
-
-def generate_ansible_files():
-    if not generate_ansible_hostfile: return
-    if verbose: print("Generating Ansible Files...")
-    with open("./helper_scripts/empty_playbook.yml","w") as playbook:
-        playbook.write("""---
+                results=pool.map(self.render_template,render_jobs,chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+            self.timings.mark("render %s templates on %s threads" % (len(render_jobs),min(self.render_jobs,len(render_jobs))))
+            return results
+        results=[]
+        for render_job in render_jobs:
+            results.append(self.render_template(render_job))
+            self.timings.mark("render " + render_job[1])
+        return results
+
+    def print_datastructures(self,devices):
+        print("\n\n######################################")
+        print("   DATASTRUCTURES SENT TO TEMPLATE:")
+        print("######################################\n")
+        print("provider=" + self.provider)
+        print("synced_folder=" + str(self.synced_folder))
+        print("version=" + str(version))
+        print("topology_file=" + self.topology_file)
+        print("arg_string=" + self.arg_string)
+        print("epoch_time=" + str(self.epoch_time))
+        print("script_storage=" + script_storage)
+        print("generate_ansible_hostfile=" + str(self.generate_ansible_hostfile))
+        print("create_mgmt_device=" + str(self.create_mgmt_device))
+        print("function_group=")
+        pretty_print(self.function_group)
+        print("network_functions=")
+        pretty_print(network_functions)
+        print("devices=")
+        pretty_print(devices)
+
+    def generate_ansible_files(self):
+        if not self.generate_ansible_hostfile: return
+        if self.verbose: print("Generating Ansible Files...")
+        if not os.path.isdir(self.output_path("./helper_scripts")):
+            os.makedirs(self.output_path("./helper_scripts"))
+        playbook="""---
 - hosts: all
   user: vagrant
   gather_facts: no
   tasks:
     - command: "uname -a"
-""")
-    with open("./ansible.cfg","w") as ansible_cfg:
-        ansible_cfg.write("""[defaults]
+"""
+        ansible_cfg="""[defaults]
 inventory = ./.vagrant/provisioners/ansible/inventory/vagrant_ansible_inventory
 hostfile= ./.vagrant/provisioners/ansible/inventory/vagrant_ansible_inventory
 host_key_checking=False
 callback_whitelist = profile_tasks
-jinja2_extensions=jinja2.ext.do""")
+jinja2_extensions=jinja2.ext.do"""
+        self.write_output(self.output_path("./helper_scripts/empty_playbook.yml"),lambda outfile: outfile.write(playbook))
+        self.write_output(self.output_path("./ansible.cfg"),lambda outfile: outfile.write(ansible_cfg))
 
+    def run(self):
+        print(styles.HEADER + "\n######################################")
+        print(styles.HEADER + "          Topology Converter")
+        print(styles.HEADER + "######################################")
+        print(styles.BLUE + "           originally written by Eric Pulvino")
 
+        inventory = self.cached_parse()
 
-def main():
-    global mac_map
-    print(styles.HEADER + "\n######################################")
-    print(styles.HEADER + "          Topology Converter")
-    print(styles.HEADER + "######################################")
-    print(styles.BLUE + "           originally written by Eric Pulvino")
+        diff_report=self.diff_state()
+
+        devices=self.populate(inventory)
+        self.timings.mark("clean_datastructure")
+
+        self.remove_generated_files()
 
-    inventory = parse_topology(topology_file)
+        #-dd shows what the templates would get instead of rendering them
+        if self.display_datastructures:
+            self.print_datastructures(devices)
+            return
 
-    devices=populate_data_structures(inventory)
+        self.render(devices)
 
-    remove_generated_files()
+        self.generate_dhcp_mac_file()
+        self.timings.mark("generate_dhcp_mac_file")
 
-    render_jinja_templates(devices)
+        self.save_state()
 
-    generate_dhcp_mac_file(mac_map)
+        self.generate_ansible_files()
 
-    generate_ansible_files()
+        self.copy_helper_scripts(devices)
 
-    if create_mgmt_configs_only:
-        print(styles.GREEN + styles.BOLD + "\n############\nSUCCESS: MGMT Network Templates have been regenerated!\n############" + styles.ENDC)
+        self.write_manifest()
+        self.timings.mark("state, ansible files, manifest")
+
+        if self.create_mgmt_configs_only:
+            print(styles.GREEN + styles.BOLD + "\n############\nSUCCESS: MGMT Network Templates have been regenerated!\n############" + styles.ENDC)
+        else:
+            print(styles.GREEN + styles.BOLD + "\n############\nSUCCESS: Vagrantfile has been generated!\n############" + styles.ENDC)
+            print(styles.GREEN + styles.BOLD + "\n            %s devices under simulation." %(len(devices)) + styles.ENDC)
+        for device in inventory:
+            print(styles.GREEN + styles.BOLD + "                %s" %(inventory[device]['hostname']) + styles.ENDC)
+
+        self.print_diff(diff_report)
+
+        if self.shard and not self.create_mgmt_configs_only:
+            print(styles.GREEN + styles.BOLD + "\n            %s hypervisors:" % len(self.shards(devices)) + styles.ENDC)
+            for host,shard_devices in self.shards(devices):
+                print(styles.GREEN + styles.BOLD + "                %s: %s devices --> %s" % (host,len(shard_devices),self.output_path(os.path.join(shard_directory % host,VAGRANTFILE))) + styles.ENDC)
+
+        for warn_msg in self.warning:
+            print(warn_msg)
+        self.report_timings()
+        print("\nDONE!\n")
+
+    def copy_helper_scripts(self,devices):
+        # The Vagrantfile provisions from ./helper_scripts, so an output
+        # directory ("-o" and every --batch topology) gets a copy of the stock
+        # helper_scripts next to its generated ones, and each hypervisor_*
+        # directory gets its own copy of both (and ansible.cfg) so it can be
+        # copied to its hypervisor on its own. Unchanged files are left alone
+        # as usual.
+        if self.create_mgmt_configs_only: return
+        output_scripts=self.output_path(script_storage)
+        separate=os.path.realpath(output_scripts) != os.path.realpath(script_storage)
+        if not separate and not self.shard: return
+        stock={}
+        generated={}
+        for source,files in [(script_storage,stock)]+([(output_scripts,generated)] if separate else []):
+            for directory,subdirectories,names in os.walk(source):
+                #A stale auto_mgmt_network in the working directory is not part of this run
+                if source == script_storage and separate and 'auto_mgmt_network' in subdirectories:
+                    subdirectories.remove('auto_mgmt_network')
+                for name in names:
+                    path=os.path.join(directory,name)
+                    files[os.path.normpath(os.path.join(script_storage,os.path.relpath(path,source)))]=path
+        copies=[]
+        if separate:
+            for destination in sorted(stock):
+                if destination not in generated: copies.append((stock[destination],self.output_path(destination)))
+        if self.shard:
+            files=dict(stock)
+            files.update(generated)
+            if self.generate_ansible_hostfile: files["ansible.cfg"]=self.output_path("./ansible.cfg")
+            for host,shard_devices in self.shards(devices):
+                for destination in sorted(files):
+                    copies.append((files[destination],self.output_path(os.path.join(shard_directory % host,destination))))
+        for source,destination in copies:
+            with open(source,'rb') as infile:
+                content=infile.read()
+            if self.write_output(destination,lambda outfile: outfile.write(content),binary=True):
+                shutil.copymode(source,destination)
+        self.timings.mark("copy helper_scripts")
+
+    def report_timings(self):
+        if not self.timings.enabled: return
+        self.timings.stop()
+        self.timings.report()
+        if self.timings_json is not None:
+            report=dict(self.timings.as_dict(),topology_file=self.topology_file,provider=self.provider,version=version)
+            with open(self.output_path(self.timings_json),"w") as outfile:
+                outfile.write(json.dumps(report,indent=2,sort_keys=True)+"\n")
+
+
+###### Batch Conversion
+def converter_options(args):
+    # Converter keyword arguments for the options given on the command line,
+    # the topology file itself is passed separately.
+    options={}
+    if args.provider: options['provider']=args.provider
+    if args.start_port: options['start_port']=args.start_port
+    if args.port_gap: options['port_gap']=args.port_gap
+    if args.output_dir: options['output_dir']=args.output_dir
+    if args.render_jobs: options['render_jobs']=args.render_jobs
+    options['verbose']=args.verbose
+    options['generate_ansible_hostfile']=args.ansible_hostfile
+    options['create_mgmt_device']=args.create_mgmt_device
+    options['create_mgmt_network']=args.create_mgmt_network
+    options['create_mgmt_configs_only']=args.create_mgmt_configs_only
+    options['templates']=args.template
+    options['display_datastructures']=args.display_datastructures
+    options['synced_folder']=args.synced_folder
+    options['template_cache']=not args.no_template_cache
+    options['force']=args.force
+    options['inventory_cache']=not args.no_cache
+    options['data_driven']=args.data_driven
+    if args.state_file: options['state_file']=args.state_file
+    if args.diff: options['diff_file']=args.diff
+    if args.diff_json: options['diff_json']=args.diff_json
+    if args.shard: options['shard']=args.shard
+    if args.hypervisors: options['hypervisors']=[host.strip() for host in args.hypervisors.split(',') if host.strip()]
+    if args.timings: options['timings']=args.timings
+    if args.timings_json: options['timings_json']=args.timings_json
+    if args.timings_memory: options['timings_memory']=args.timings_memory
+    if args.nodes: options['node_table']=args.nodes
+    return options
+
+_batch_comment_re = re.compile(r'(^|\s)#.*')
+
+def read_batch_jobs(batch,output_root,options):
+    # Returns one dict of Converter keyword arguments per topology, in the
+    # order they were listed (or sorted by name for a directory).
+    entries=[]
+    if os.path.isdir(batch):
+        for name in sorted(os.listdir(batch)):
+            if name.endswith(".dot"): entries.append([os.path.join(batch,name)])
+    elif os.path.isfile(batch):
+        with open(batch,"r") as batch_file:
+            for line in batch_file:
+                #A comment starts the line or follows whitespace, so paths may hold a #
+                line=_batch_comment_re.sub('',line).strip()
+                if line != "": entries.append(line.split())
     else:
-        print(styles.GREEN + styles.BOLD + "\n############\nSUCCESS: Vagrantfile has been generated!\n############" + styles.ENDC)
-        print(styles.GREEN + styles.BOLD + "\n            %s devices under simulation." %(len(devices)) + styles.ENDC)
-    for device in inventory:
-        print(styles.GREEN + styles.BOLD + "                %s" %(inventory[device]['hostname']) + styles.ENDC)
+        raise conversion_error(" ### ERROR: batch source \"" + batch + "\" is not a file or directory!")
+
+    jobs=[]
+    output_dirs={}
+    for entry in entries:
+        if len(entry) > 3:
+            raise conversion_error(" ### ERROR: batch entry \"" + " ".join(entry) + "\" should be: topology_file [output_dir [provider]]")
+        job=dict(options)
+        job['topology_file']=entry[0]
+        if len(entry) > 1: job['output_dir']=entry[1]
+        else: job['output_dir']=os.path.join(output_root,os.path.splitext(os.path.basename(entry[0]))[0])
+        if len(entry) > 2:
+            if entry[2] not in ["libvirt","virtualbox"]:
+                raise conversion_error(" ### ERROR: batch entry \"" + " ".join(entry) + "\" uses unsupported provider \"" + entry[2] + "\"")
+            job['provider']=entry[2]
+        output_dir=os.path.normpath(job['output_dir'])
+        if output_dir in output_dirs:
+            raise conversion_error(" ### ERROR: topologies \"" + output_dirs[output_dir] + "\" and \"" + entry[0] + "\" would both be written to \"" + job['output_dir'] + "\"")
+        output_dirs[output_dir]=entry[0]
+        jobs.append(job)
+    return jobs
+
+def convert_job(job):
+    # Runs one batch job and captures everything it prints. A failed
+    # conversion becomes an ERROR result instead of ending the batch.
+    captured=StringIO()
+    real_stdout=sys.stdout
+    sys.stdout=captured
+    status="OK"
+    try:
+        Converter(**job).run()
+    except ConversionError:
+        status="ERROR"
+    except Exception as e:
+        status="ERROR"
+        print(styles.FAIL + styles.BOLD + " ### ERROR: " + repr(e) + styles.ENDC)
+    finally:
+        sys.stdout=real_stdout
+    return status,captured.getvalue()
+
+def run_batch(jobs,workers=None):
+    # Converts every job across a pool of worker processes. Results come back
+    # in the same order as the jobs no matter which worker finishes first.
+    import multiprocessing
+    if workers is None: workers=multiprocessing.cpu_count()
+    workers=max(1,min(workers,len(jobs)))
+    if workers == 1: return [convert_job(job) for job in jobs]
+    pool=multiprocessing.Pool(workers)
+    try:
+        results=pool.map(convert_job,jobs,chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+def batch_error_message(output):
+    # The last error printed by a failed conversion, without terminal colors
+    lines=[re.sub(r'\033\[[0-9;]*m','',line).strip() for line in output.splitlines()]
+    lines=[line for line in lines if line != ""]
+    for line in reversed(lines):
+        if "ERROR" in line: return line
+    if lines: return lines[-1]
+    return "no output"
+
+def batch_main(args):
+    output_root=args.output_dir
+    if output_root is None: output_root="./batch_output"
+    options=converter_options(args)
+    options['arg_string']=" ".join(sys.argv)
+    try:
+        jobs=read_batch_jobs(args.batch,output_root,options)
+    except ConversionError:
+        return 1
+    if len(jobs) == 0:
+        conversion_error(" ### ERROR: no topology files found in \"" + args.batch + "\"")
+        return 1
+
+    start=time.time()
+    results=run_batch(jobs,args.jobs)
+    elapsed=time.time()-start
+
+    failed=0
+    print(styles.HEADER + "\n######################################")
+    print(styles.HEADER + "          Batch Summary")
+    print(styles.HEADER + "######################################" + styles.ENDC)
+    for job,(status,output) in zip(jobs,results):
+        if args.verbose: print(output)
+        provider=job.get('provider',"virtualbox")
+        if status == "OK":
+            print(styles.GREEN + "    OK     %s --> %s (%s)" % (job['topology_file'],job['output_dir'],provider) + styles.ENDC)
+        else:
+            failed+=1
+            print(styles.FAIL + "    ERROR  %s --> %s (%s): %s" % (job['topology_file'],job['output_dir'],provider,batch_error_message(output)) + styles.ENDC)
+    print(styles.BOLD + "\n%s of %s topologies converted in %.1f seconds." % (len(jobs)-failed,len(jobs),elapsed) + styles.ENDC)
+    if failed: return 1
+    return 0
+
+###### Lint Only
+def lint_main(args,topology_files):
+    # Checks every topology even after one fails, so a single run reports all
+    # of the broken files.
+    options=converter_options(args)
+    failed=0
+    for topology_file in topology_files:
+        if not os.path.isfile(topology_file):
+            print(styles.FAIL + styles.BOLD + " ### ERROR: topology file \"" + topology_file + "\" does not exist!" + styles.ENDC)
+            failed+=1
+            continue
+        try:
+            converter=Converter(topology_file,**options)
+            inventory, edges = converter.lint()
+        except ConversionError:
+            print(styles.FAIL + "    ERROR  %s" % topology_file + styles.ENDC)
+            failed+=1
+            continue
+        except Exception as e:
+            print(styles.FAIL + styles.BOLD + " ### ERROR: " + repr(e) + styles.ENDC)
+            print(styles.FAIL + "    ERROR  %s" % topology_file + styles.ENDC)
+            failed+=1
+            continue
+        for warn_msg in converter.warning:
+            print(warn_msg)
+        print(styles.GREEN + "    OK     %s (%s devices, %s links)" % (topology_file,len(inventory),len(edges)) + styles.ENDC)
+    if failed: return 1
+    return 0
 
-    for warn_msg in warning:
-        print(warn_msg)
-    print("\nDONE!\n")
+def main():
+    parser=build_parser()
+    args=parser.parse_args()
+    if args.profile is None: return run_main(parser,args)
+    import cProfile
+    profiler=cProfile.Profile()
+    profiler.enable()
+    try:
+        run_main(parser,args)
+    finally:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        print("  INFO: cProfile stats written to %s, view them with: python -m pstats %s" % (args.profile,args.profile))
+
+def run_main(parser,args):
+    if args.lint_only:
+        if args.topology_file is None:
+            parser.error("--lint-only needs at least one topology_file")
+        sys.exit(lint_main(args,[args.topology_file]+args.more_topology_files))
+    if args.more_topology_files:
+        parser.error("only one topology_file can be converted at a time, use --batch for more")
+    if args.batch:
+        sys.exit(batch_main(args))
+    if args.topology_file is None:
+        parser.error("a topology_file is required unless --batch is used")
+    try:
+        converter=Converter.from_args(args," ".join(sys.argv))
+        if converter.verbose:
+            print("Arguments:")
+            print(args)
+        converter.run()
+    except ConversionError:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
-exit(0)